@@ -1,9 +1,12 @@
 import os
 from os import PathLike
-from typing import List
+from typing import IO, List
 import zipfile
 import tempfile
-import glob
+import fnmatch
+import shutil
+import threading
+import weakref
 from .defs import *
 from .utils import *
 import logging
@@ -12,6 +15,52 @@ logger = logging.getLogger(__name__)
 logger.setLevel(logging.DEBUG)
 logger.addHandler(logging.StreamHandler())
 
+# Packs extracted in "temp" and "memory" mode go to directories named after the
+# process, so the ones of a process that crashed are found and removed later
+EXTRACTION_PREFIX = "chatavatar_pack_"
+SHARED_MEMORY_DIRECTORY = "/dev/shm"
+# Bytes of packs extracted in "memory" mode at once in this process, more are read from their zip
+MEMORY_LIMIT = 2 << 30
+
+_memory_lock = threading.Lock()
+_memory_used = 0
+# Directories already cleared of stale extractions by this process
+_swept_directories = set()
+
+def _reserve_memory(size: int) -> bool:
+    global _memory_used
+    with _memory_lock:
+        if _memory_used + size > MEMORY_LIMIT:
+            return False
+        _memory_used += size
+        return True
+
+def _release_memory(size: int):
+    global _memory_used
+    with _memory_lock:
+        _memory_used -= size
+
+def _remove_extraction(extraction_dir: str, memory_reserved: int):
+    shutil.rmtree(extraction_dir, ignore_errors=True)
+    if memory_reserved:
+        _release_memory(memory_reserved)
+
+def remove_stale_extractions(directory: str):
+    """Remove extractions of processes that are gone without closing their packs."""
+    if directory in _swept_directories:
+        return
+    _swept_directories.add(directory)
+    try:
+        entries = list(os.scandir(directory))
+    except OSError:
+        return
+    for entry in entries:
+        if not entry.name.startswith(EXTRACTION_PREFIX):
+            continue
+        pid = entry.name[len(EXTRACTION_PREFIX):].split("_")[0]
+        if pid.isdigit() and int(pid) != os.getpid() and not process_alive(int(pid)):
+            shutil.rmtree(entry.path, ignore_errors=True)
+
 class Pack:
     """Main Package Class"""
     #region Basic Package Info
@@ -80,17 +129,21 @@ class Pack:
     # endregion
 
     def __init__(self, fp: PathLike, unpack_mode):
-        assert unpack_mode in {"temp", "local"}
+        """unpack_mode: "temp" or "local" extract the zip to a temp dir or next to it,
+        "memory" to RAM (tmpfs), "zip" extracts nothing, file paths are then names of zip members.
+        A pack in "memory" mode that does not fit in MEMORY_LIMIT or tmpfs falls back to "zip".
+        What "temp" and "memory" mode extract is removed by close(), use the pack as a context
+        manager or close it once done. Such packs are imported from their zip (member_name), so
+        nothing generated by an import lands in the extraction or counts against MEMORY_LIMIT.
+        """
+        assert unpack_mode in {"temp", "local", "memory", "zip"}
         self.unpack_mode = unpack_mode
         self.original_zip_filepath = fp
         basename_without_suffix = str_remove_suffix(os.path.basename(fp), ".zip")
         self.pack_name = make_safe_pack_name(basename_without_suffix)
-
-        if unpack_mode == "temp":
-            self.temp_dir = tempfile.TemporaryDirectory()
-            self.unpack_path = os.path.join(self.temp_dir.name, basename_without_suffix)
-        elif unpack_mode == "local":
-            self.unpack_path = os.path.join(os.path.dirname(self.original_zip_filepath), basename_without_suffix)
+        self.unpack_path = None
+        self._holds = 1
+        self._finalizer = None
 
         # Get metadata of package
         try:
@@ -99,25 +152,32 @@ class Pack:
                 # Available packs
                 ## Flags
                 self.available_packs = Pack.list_packs(self.file_list)
-                if self.available_packs:
+                if not self.available_packs:
+                    raise InvalidPack
+                if unpack_mode == "local":
+                    self.unpack_path = os.path.join(os.path.dirname(self.original_zip_filepath), basename_without_suffix)
+                elif unpack_mode in {"temp", "memory"}:
+                    self.unpack_path = self._make_extraction_dir(z, basename_without_suffix)
+                if self.unpack_path is not None:
                     os.makedirs(self.unpack_path, exist_ok=True)
                     # Overwrite logic
                     self.unpack_path = safe_extractall(z, self.unpack_path)
                     logger.debug(f"{fp} is extracted to {self.unpack_path}")
-                else:
-                    raise InvalidPack
         except zipfile.BadZipFile:
+            self.close()
             raise InvalidPack
+        except BaseException:
+            self.close()
+            raise
 
         # Base metadata
         ## Prompt
         if "prompt.txt" in self.file_list:
-            with open(os.path.join(self.unpack_path, "prompt.txt"), encoding="utf8") as f:
-                self.prompt_txt = f.read().strip().replace(chr(160), " ")
+            self.prompt_txt = self.read_file("prompt.txt").decode("utf8").strip().replace(chr(160), " ")
         else:
             self.prompt_txt = ""
         ## Preview Image
-        self.preview_image_path = os.path.join(self.unpack_path, "image.png")
+        self.preview_image_path = self.file_path("image.png")
 
         # Additional elements
         ## Flags
@@ -127,34 +187,133 @@ class Pack:
             (AdditionalElements.BlendShapes if Pack.has_blendshapes(self.file_list)       else AdditionalElements.Nothing) | \
             (AdditionalElements.BackHeadTex if Pack.has_back_head_texture(self.file_list) else AdditionalElements.Nothing)
 
+    def _make_extraction_dir(self, z: zipfile.ZipFile, basename_without_suffix: str):
+        """Directory a "temp" or "memory" mode pack is extracted to, None when it is read from the zip."""
+        parent = tempfile.gettempdir()
+        memory_reserved = 0
+        if self.unpack_mode == "memory":
+            size = sum(info.file_size for info in z.infolist())
+            if os.path.isdir(SHARED_MEMORY_DIRECTORY) and _reserve_memory(size):
+                if shutil.disk_usage(SHARED_MEMORY_DIRECTORY).free > size:
+                    parent = SHARED_MEMORY_DIRECTORY
+                    memory_reserved = size
+                else:
+                    _release_memory(size)
+            if not memory_reserved:
+                logger.debug(f"{self.original_zip_filepath} does not fit in memory, it is read from the zip")
+                self.unpack_mode = "zip"
+                return None
+        remove_stale_extractions(parent)
+        extraction_dir = tempfile.mkdtemp(prefix=f"{EXTRACTION_PREFIX}{os.getpid()}_", dir=parent)
+        # Also run at exit, for packs never closed
+        self._finalizer = weakref.finalize(self, _remove_extraction, extraction_dir, memory_reserved)
+        return os.path.join(extraction_dir, basename_without_suffix)
+
+    @property
+    def ephemeral(self) -> bool:
+        """Extracted files are removed by close(), "temp" and "memory" mode."""
+        return self._finalizer is not None
+
+    def member_name(self, path: str) -> str:
+        """Zip member name of a path given by file_path()."""
+        if self.unpack_mode == "zip":
+            return path
+        return os.path.relpath(path, self.unpack_path).replace(os.sep, "/")
+
+    def retain(self):
+        """Keep the pack open for one more close(), e.g. while an import of it is queued."""
+        self._holds += 1
+        return self
+
+    def close(self):
+        """Remove what "temp" and "memory" mode extracted, once every retain() has been matched."""
+        if self._holds == 0:
+            return
+        self._holds -= 1
+        if self._holds == 0 and self._finalizer is not None:
+            self._finalizer()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def file_path(self, name: str) -> str:
+        """Path of a pack file, the member name itself in zip mode."""
+        if self.unpack_mode == "zip":
+            return name
+        return os.path.join(self.unpack_path, name)
+
+    def open_file(self, name: str) -> IO[bytes]:
+        """Binary stream of a pack file, decompressed while it is read in zip mode."""
+        if self.unpack_mode == "zip":
+            # The member stays readable after the zip is closed
+            with zipfile.ZipFile(self.original_zip_filepath, 'r') as z:
+                return z.open(name)
+        return open(self.file_path(name), "rb")
+
+    def read_file(self, name: str) -> bytes:
+        with self.open_file(name) as f:
+            return f.read()
+
     def pack_file_paths(self, picked_pack):
         """keys: ["model", "diffuse", "specular", "normal"], values: corresponding paths
         """
         return {
-            key: os.path.join(self.unpack_path, value) for key, value in Pack.pack_paths[picked_pack].items()
+            key: self.file_path(value) for key, value in Pack.pack_paths[picked_pack].items()
         }
 
     def additional_elements_paths(self):
         results = {}
         if AdditionalElements.BackHeadTex & self.additional_elements:
             results[AdditionalElements.BackHeadTex] = {
-                "texture_diffuse": os.path.join(self.unpack_path, "USCBasicPack/texture_diffuse_backhead.png"),
-                "texture_normal": os.path.join(self.unpack_path, "USCBasicPack/texture_normal_backhead.png"),
-                "texture_specular": os.path.join(self.unpack_path, "USCBasicPack/texture_specular_backhead.png"),
+                "texture_diffuse": self.file_path("USCBasicPack/texture_diffuse_backhead.png"),
+                "texture_normal": self.file_path("USCBasicPack/texture_normal_backhead.png"),
+                "texture_specular": self.file_path("USCBasicPack/texture_specular_backhead.png"),
             }
         if AdditionalElements.RiggedBody & self.additional_elements:
-            results[AdditionalElements.RiggedBody] = os.path.join(self.unpack_path, "USCBasicPack/additional_body.fbx")
+            results[AdditionalElements.RiggedBody] = self.file_path("USCBasicPack/additional_body.fbx")
         if AdditionalElements.Components & self.additional_elements:
             if AdditionalElements.BlendShapes & self.additional_elements:
-                results[AdditionalElements.Components] = os.path.join(self.unpack_path, "USCBasicPack/additional_component.fbx")
+                results[AdditionalElements.Components] = self.file_path("USCBasicPack/additional_component.fbx")
             else:
-                obj_path = glob.glob(os.path.join(self.unpack_path, "USCBasicPack/additional_component*.obj")).pop()
-                results[AdditionalElements.Components] = obj_path
+                obj_name = fnmatch.filter(self.file_list, "USCBasicPack/additional_component*.obj").pop()
+                results[AdditionalElements.Components] = self.file_path(obj_name)
         if AdditionalElements.BlendShapes & self.additional_elements:
-            results[AdditionalElements.BlendShapes] = os.path.join(self.unpack_path, "USCBasicPack/additional_blendshape.fbx")
+            results[AdditionalElements.BlendShapes] = self.file_path("USCBasicPack/additional_blendshape.fbx")
         return results
-        
 
-    def __del__(self):
-        if self.unpack_mode == "temp":
-            self.temp_dir.cleanup()
\ No newline at end of file
+    def import_selection(self, selected_pack: PackInfo, selected_additional: AdditionalElements):
+        """(model path, object name, texture paths, additional paths) of an import of the pack
+        """
+        basic_paths = self.pack_file_paths(selected_pack)
+        if selected_pack.topology == Topology.MetaHuman:
+            additional_paths = {}
+            model_path = basic_paths["model"]
+            obj_name = "head_lod0_mesh"
+        elif selected_pack.topology == Topology.Default:
+            additional_paths = self.additional_elements_paths()
+            if AdditionalElements.RiggedBody & selected_additional:
+                model_path = additional_paths[AdditionalElements.RiggedBody]
+                obj_name = "template_fullbody"
+
+            elif AdditionalElements.Components & selected_additional:
+                model_path = additional_paths[AdditionalElements.Components]
+                if AdditionalElements.BlendShapes & self.additional_elements:
+                    obj_name = "tmppu_8s3mi"
+                else:
+                    obj_name = "Mesh"
+
+            elif AdditionalElements.BlendShapes & selected_additional:
+                model_path = additional_paths[AdditionalElements.BlendShapes]
+                obj_name = "input_model"
+
+            else:
+                model_path = basic_paths["model"]
+                obj_name = "Mesh"
+
+        texture_paths = {
+            key: basic_paths[key] for key in ["texture_diffuse", "texture_specular", "texture_normal"]
+        }
+        return model_path, obj_name, texture_paths, additional_paths
\ No newline at end of file
@@ -1,4 +1,5 @@
 import os
+import sys
 import zipfile
 import random
 import string
@@ -14,6 +15,29 @@ def make_safe_pack_name(basename: str) -> str:
     basename = basename.replace(" ", "_")
     return basename
 
+def process_alive(pid):
+    if sys.platform == "win32":
+        # os.kill would terminate the process on Windows
+        import ctypes
+        kernel32 = ctypes.WinDLL("kernel32", use_last_error=True)
+        handle = kernel32.OpenProcess(0x1000, False, pid) # PROCESS_QUERY_LIMITED_INFORMATION
+        if not handle:
+            return ctypes.get_last_error() == 5 # ERROR_ACCESS_DENIED, exists but not ours
+        try:
+            exit_code = ctypes.c_ulong()
+            if not kernel32.GetExitCodeProcess(handle, ctypes.byref(exit_code)):
+                return True
+            return exit_code.value == 259 # STILL_ACTIVE
+        finally:
+            kernel32.CloseHandle(handle)
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
 def file_checker(check_list: Iterable[Iterable[PathLike]]):
     """For all iterables in check_list, check if any file in the inner iterable exists.
 
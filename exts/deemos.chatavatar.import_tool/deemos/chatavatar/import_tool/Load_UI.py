@@ -5,7 +5,6 @@ from PySide6.QtWidgets import QMessageBox
 import UI_RESOURCES
 from ChatAvatarPack.pack import Pack as CAPack
 from ChatAvatarPack import defs as CADefs
-import webbrowser
 
 class ClickableLabel(QtWidgets.QLabel):
     clicked = QtCore.Signal()
@@ -40,6 +39,61 @@ class HoverLabel(QtWidgets.QLabel):
     def leaveEvent(self, event):
         self.__my_setLeave(self)
 
+def rounded_image(image: QtGui.QImage, radius: float) -> QtGui.QImage:
+    """QImage (unlike QPixmap) can be painted outside the GUI thread."""
+    rounded = QtGui.QImage(image.size(), QtGui.QImage.Format_ARGB32_Premultiplied)
+    rounded.fill(QtCore.Qt.transparent)
+    painter = QtGui.QPainter(rounded)
+    painter.setRenderHint(QtGui.QPainter.Antialiasing)
+    painter.setBrush(QtGui.QBrush(image))
+    painter.setPen(QtCore.Qt.NoPen)
+    painter.drawRoundedRect(rounded.rect(), radius, radius)
+    painter.end()
+    return rounded
+
+class PackOpenerSignals(QtCore.QObject):
+    opened = QtCore.Signal(int, object, QtGui.QImage, float) # request id, pack, rounded preview, preview scale
+    failed = QtCore.Signal(int, object)                      # request id, exception
+
+class PackOpener(QtCore.QRunnable):
+    """Extracts a pack and decodes its preview at display size, off the GUI thread."""
+    def __init__(self, request_id, zip_file_path, unpack_location, preview_size: QtCore.QSize, round_radius):
+        super(PackOpener, self).__init__()
+        self.request_id = request_id
+        self.zip_file_path = zip_file_path
+        self.unpack_location = unpack_location
+        self.preview_size = preview_size
+        self.round_radius = round_radius
+        self.signals = PackOpenerSignals()
+
+    def run(self):
+        pack = None
+        try:
+            pack = CAPack(self.zip_file_path, self.unpack_location)
+            if pack.unpack_mode == "zip":
+                # Decoded straight from the zip member, nothing is extracted
+                preview_buffer = QtCore.QBuffer()
+                preview_buffer.setData(QtCore.QByteArray(pack.read_file(pack.preview_image_path)))
+                preview_buffer.open(QtCore.QIODevice.ReadOnly)
+                reader = QtGui.QImageReader(preview_buffer)
+            else:
+                reader = QtGui.QImageReader(pack.preview_image_path)
+            original_size = reader.size()
+            scale = 1.0
+            if original_size.isValid() and original_size.width() > 0:
+                scaled_size = original_size.scaled(self.preview_size, QtCore.Qt.KeepAspectRatio)
+                reader.setScaledSize(scaled_size)
+                scale = scaled_size.width() / original_size.width()
+            image = reader.read()
+            if not image.isNull():
+                image = rounded_image(image, self.round_radius * scale)
+        except Exception as e:
+            if pack is not None:
+                pack.close()
+            self.signals.failed.emit(self.request_id, e)
+        else:
+            self.signals.opened.emit(self.request_id, pack, image, scale)
+
 # 创建自定义窗口类
 class CustomWindow(QtWidgets.QMainWindow):
     _instance = None
@@ -51,10 +105,12 @@ class CustomWindow(QtWidgets.QMainWindow):
         cls._instance = super(CustomWindow, cls).__new__(cls, *args, **kwargs)
         return cls._instance
 
-    def __init__(self, op_handler, unpack_location, parent=None):
+    def __init__(self, op_handler, unpack_location, resident=False, parent=None):
         super(CustomWindow, self).__init__(parent)
+        # A resident window only hides when closed, the launcher process is reused
+        self.resident = resident
 
-        assert unpack_location in {"temp", "local"}
+        assert unpack_location in {"temp", "local", "zip"}
         self.unpack_location = unpack_location
         self.load_pixmaps()
 
@@ -65,6 +121,10 @@ class CustomWindow(QtWidgets.QMainWindow):
         self.selected_resolution: Union(None, CADefs.TextureResolution) = None
         self.selected_topology: Union(None, CADefs.Topology) = None
         self.selected_components: CADefs.AdditionalElements = CADefs.AdditionalElements.Nothing
+        # Running PackOpeners by request id, kept alive until they report back
+        self.pack_openers = {}
+        # Request whose result is still wanted, 0 for none
+        self.pack_open_request = 0
 
         self.create_window()
         # Button signals
@@ -73,34 +133,35 @@ class CustomWindow(QtWidgets.QMainWindow):
         self.pushButton_Import.clicked.connect(self.import_press)
         self.pushButton_back.clicked.connect(self.back_press)
         self.pushButton_Confirm.clicked.connect(self.confirm_press)
+        # Import signals
+        self.op_handler.importStarted.connect(self.import_started)
+        self.op_handler.importFinished.connect(self.import_finished)
+        self.op_handler.queueChanged.connect(self.import_queue_changed)
         self.set_button_enabled("RESET")
 
     def load_pixmaps(self):
-        # Load All images as QIcon
-        ## Fixed elements
+        # Only what is shown right away is decoded here
         self.fixed_element_pixmaps = {
-            key: QtGui.QPixmap(value)
-            for key, value in UI_RESOURCES.FIXED_ELEMENTS_ABSOLUTE_PATHS.items()
+            key: QtGui.QPixmap(UI_RESOURCES.FIXED_ELEMENTS_ABSOLUTE_PATHS[key])
+            for key in ["Background", "Title"]
         }
-        ### Only buttons need icon
+        if any(pixmap.isNull() for pixmap in self.fixed_element_pixmaps.values()):
+            # Name the missing file
+            UI_RESOURCES.assert_complete_pack()
+        # Icons load their files on first paint of each mode/state, so
+        # unavailable and selected states are only decoded once they are shown
+        ## Only buttons need icon
         self.fixed_element_icon = {}
         for i in ["Confirm", "Import", "Back"]:
             icon = self.fixed_element_icon[i] = QtGui.QIcon()
-            icon.addPixmap(self.fixed_element_pixmaps[i])
+            icon.addFile(UI_RESOURCES.FIXED_ELEMENTS_ABSOLUTE_PATHS[i])
         ## Select buttons
-        self.selection_buttons_pixmaps = {
-            key_1: {
-                key_2: QtGui.QPixmap(value_2)
-                for key_2, value_2 in value_1.items()
-            } for key_1, value_1 in UI_RESOURCES.SELECTION_BUTTONS_ABSOLUTE_PATHS.items()
-        }
         self.selection_buttons_icons = {}
-        for i in self.selection_buttons_pixmaps:
+        for i, paths in UI_RESOURCES.SELECTION_BUTTONS_ABSOLUTE_PATHS.items():
             icon = self.selection_buttons_icons[i] = QtGui.QIcon()
-            pixmaps = self.selection_buttons_pixmaps[i]
-            icon.addPixmap(pixmaps["AVAILABLE"])
-            icon.addPixmap(pixmaps["UNAVAILABLE"], QtGui.QIcon.Mode.Disabled)
-            icon.addPixmap(pixmaps["SELECTED"], QtGui.QIcon.Mode.Normal, QtGui.QIcon.State.On)
+            icon.addFile(paths["AVAILABLE"])
+            icon.addFile(paths["UNAVAILABLE"], QtCore.QSize(), QtGui.QIcon.Mode.Disabled)
+            icon.addFile(paths["SELECTED"], QtCore.QSize(), QtGui.QIcon.Mode.Normal, QtGui.QIcon.State.On)
 
     def create_window(self):
         self.setWindowTitle("ChatAvatar Import Tool")
@@ -117,7 +178,7 @@ class CustomWindow(QtWidgets.QMainWindow):
         self.logo_label.setScaledContents(True)
         self.logo_label.setToolTip("Click here to visit ChatAvater.")
         self.logo_label.setCursor(QtCore.Qt.PointingHandCursor)
-        self.logo_label.clicked.connect(lambda: webbrowser.open_new("https://hyperhuman.top"))
+        self.logo_label.clicked.connect(self.open_website)
 
         self.image_label = QtWidgets.QLabel(self)
         self.image_label.setGeometry(880, 200, 270, 360)
@@ -133,6 +194,11 @@ class CustomWindow(QtWidgets.QMainWindow):
         self.text_label.setWordWrap(True)
         self.text_label.setAlignment(QtCore.Qt.AlignCenter)
 
+        self.progressBar_open = QtWidgets.QProgressBar(self)
+        self.progressBar_open.setGeometry(QtCore.QRect(940, 375, 150, 10))
+        self.progressBar_open.setRange(0, 0) # Busy indicator
+        self.progressBar_open.setTextVisible(False)
+        self.progressBar_open.hide()
 
         #region Selection buttons
         self.pushButton_4K = QtWidgets.QPushButton(self)
@@ -211,6 +277,28 @@ class CustomWindow(QtWidgets.QMainWindow):
         self.pushButton_back.setIconSize(QtCore.QSize(53, 20))
         self.pushButton_back.setStyleSheet("background: transparent; border: none")
         #endregion
+
+        self.checkBox_update = QtWidgets.QCheckBox("Update previous import of this pack", self)
+        self.checkBox_update.setGeometry(QtCore.QRect(880, 575, 270, 24))
+        self.checkBox_update.setToolTip("Edit the last import in place instead of adding another avatar to the stage.")
+        self.checkBox_update.setStyleSheet("color: white; background: transparent;")
+
+        self.checkBox_lod = QtWidgets.QCheckBox("Generate LOD variants", self)
+        self.checkBox_lod.setGeometry(QtCore.QRect(880, 680, 270, 24))
+        self.checkBox_lod.setToolTip("Add decimated, unsubdivided variants of the avatar for crowds, selectable in the \"lod\" variant set.")
+        self.checkBox_lod.setStyleSheet("color: white; background: transparent;")
+
+        #region Import status
+        self.progressBar_import = QtWidgets.QProgressBar(self)
+        self.progressBar_import.setGeometry(QtCore.QRect(40, 680, 400, 10))
+        self.progressBar_import.setRange(0, 0) # Busy indicator, the server reports no progress
+        self.progressBar_import.setTextVisible(False)
+        self.progressBar_import.hide()
+
+        self.label_import_status = QtWidgets.QLabel(self)
+        self.label_import_status.setGeometry(QtCore.QRect(40, 690, 800, 24))
+        self.label_import_status.setStyleSheet("color: white; background: transparent;")
+        #endregion
         
         ## Selection group
         self.buttonGroup_resolution = QtWidgets.QButtonGroup()
@@ -295,10 +383,13 @@ class CustomWindow(QtWidgets.QMainWindow):
             self.deselect_button_group(self.buttonGroup_parts)
             self.set_all_disabled()
             self.pushButton_Confirm.setEnabled(False)
+            self.checkBox_update.setChecked(False)
+            self.checkBox_update.setEnabled(False)
             return
         if trigger_event == "IMPORT":
             self.set_button_enabled("RESET")
             self.set_resolution_enabled()
+            self.checkBox_update.setEnabled(True)
             self.pushButton_Confirm.setEnabled(False)
             return
         if trigger_event == "SELECT_RES":
@@ -346,6 +437,18 @@ class CustomWindow(QtWidgets.QMainWindow):
             self.set_topology(None)
             self.set_button_enabled("SELECT_RES")
 
+    def closeEvent(self, event):
+        if self.resident:
+            event.ignore()
+            self.hide()
+        else:
+            super(CustomWindow, self).closeEvent(event)
+
+    @staticmethod
+    def open_website():
+        import webbrowser # Deferred, only needed on click
+        webbrowser.open_new("https://hyperhuman.top")
+
     def set_background_image(self):
         bglabel = QtWidgets.QLabel(self)
         bg_pixmap = self.fixed_element_pixmaps["Background"]
@@ -354,52 +457,68 @@ class CustomWindow(QtWidgets.QMainWindow):
         bglabel.setScaledContents(True)
         bglabel.show()
 
-    def rounded_pixmap(self, pixmap, radius):
-        mask = QtGui.QPixmap(pixmap.size())
-        mask.fill(QtGui.QColor("transparent"))
-        painter = QtGui.QPainter(mask)
-        painter.setRenderHint(QtGui.QPainter.Antialiasing)
-        painter.setBrush(QtGui.QBrush(QtGui.QColor("black")))
-        painter.drawRoundedRect(mask.rect(), radius, radius)
-        painter.end()
-
-        rounded_pixmap = QtGui.QPixmap(pixmap.size())
-        rounded_pixmap.fill(QtGui.QColor("transparent"))
-        painter = QtGui.QPainter(rounded_pixmap)
-        painter.setRenderHint(QtGui.QPainter.Antialiasing)
-        painter.setCompositionMode(QtGui.QPainter.CompositionMode_Source)
-        painter.drawPixmap(rounded_pixmap.rect(), pixmap)
-        painter.setCompositionMode(QtGui.QPainter.CompositionMode_DestinationIn)
-        painter.drawPixmap(rounded_pixmap.rect(), mask)
-        painter.end()
-
-        return rounded_pixmap
-
     def import_press(self):
         zip_file_path, _ = QtWidgets.QFileDialog.getOpenFileName(self, "Choose Package", "", "Zip Files (*.zip)")
         if not zip_file_path:
             return
-        try:
-            self.pack = CAPack(os.path.join(zip_file_path), self.unpack_location)
-        except CADefs.InvalidPack:
-            msg_box = QMessageBox(self)
-            msg_box.setWindowTitle("ChatAvatar Import Tool")
+        self.open_zip(zip_file_path)
+
+    def open_zip(self, zip_file_path):
+        self.back_press()
+
+        # Placeholder until the pack is extracted in background
+        self.pushButton_Import.setEnabled(False)
+        self.text_label.setText("Opening pack...")
+        self.progressBar_open.show()
+        self.pack_open_request = max(self.pack_openers, default=self.pack_open_request) + 1
+        pack_opener = self.pack_openers[self.pack_open_request] = PackOpener(
+            self.pack_open_request,
+            os.path.join(zip_file_path),
+            self.unpack_location,
+            self.image_label.size(),
+            round_radius=25, # px in original image
+        )
+        pack_opener.signals.opened.connect(self.pack_opened)
+        pack_opener.signals.failed.connect(self.pack_open_failed)
+        QtCore.QThreadPool.globalInstance().start(pack_opener)
+
+    def pack_open_done(self, request_id):
+        """Returns False when the result is stale, the user went back while opening."""
+        self.pack_openers.pop(request_id, None)
+        if request_id != self.pack_open_request:
+            return False
+        self.pack_open_request = 0
+        self.pushButton_Import.setEnabled(True)
+        self.progressBar_open.hide()
+        self.text_label.clear()
+        return True
+
+    def pack_open_failed(self, request_id, exception):
+        if not self.pack_open_done(request_id):
+            return
+        msg_box = QMessageBox(self)
+        msg_box.setWindowTitle("ChatAvatar Import Tool")
+        if isinstance(exception, CADefs.InvalidPack):
             msg_box.setText(
                 "Wrong pack imported! Consider visiting <a href='https://hyperhuman.top'>ChatAvatar</a> to generate a ChatAvatar Package."
             )
-            msg_box.setStandardButtons(QMessageBox.Ok)
-            msg_box.exec()
+        else:
+            msg_box.setText(f"Failed to open pack! ({type(exception).__name__}: {exception})")
+        msg_box.setStandardButtons(QMessageBox.Ok)
+        msg_box.exec()
+
+    def pack_opened(self, request_id, pack, preview_image, preview_scale):
+        if not self.pack_open_done(request_id):
+            pack.close()
             return
+        self.pack = pack
 
-        round_radius = 25 # px in original image
-        self.view_image_path = self.pack.preview_image_path
-        self.viewpixmap = QtGui.QPixmap(self.view_image_path)
-        rounded_pixmap = self.rounded_pixmap(self.viewpixmap, round_radius)
-        self.image_label.setPixmap(rounded_pixmap)
+        self.image_label.setPixmap(QtGui.QPixmap.fromImage(preview_image))
         self.image_label.setScaledContents(True)
 
         if self.pack.prompt_txt:
-            border_radius_str = "border-radius: {:0.05f}px;".format(round_radius / self.viewpixmap.size().width() * self.image_label.size().width())
+            round_radius = 25 # px in original image
+            border_radius_str = "border-radius: {:0.05f}px;".format(round_radius * preview_scale)
             def enter_event(_self):
                 _self.setText(self.pack.prompt_txt)
                 _self.setStyleSheet(
@@ -415,9 +534,19 @@ class CustomWindow(QtWidgets.QMainWindow):
             self.text_label.setEnter(enter_event)
             self.text_label.setLeave(leave_event)
         self.set_button_enabled("IMPORT")
+        self.op_handler.open_pack(self, self.pack)
 
     def back_press(self):
+        if self.pack is not None:
+            self.op_handler.close_pack(self, self.pack)
+            # Extracted files stay until queued imports of the pack are done
+            self.pack.close()
         self.pack = None
+        if self.pack_open_request:
+            # Result of the pack being opened is dropped once it arrives
+            self.pack_open_request = 0
+            self.pushButton_Import.setEnabled(True)
+            self.progressBar_open.hide()
         self.selected_resolution = None
         self.selected_topology = None
         self.selected_components = CADefs.AdditionalElements.Nothing
@@ -434,35 +563,7 @@ class CustomWindow(QtWidgets.QMainWindow):
             (CADefs.AdditionalElements.Components  if self.pushButton_eye.isChecked()     else CADefs.AdditionalElements.Nothing) | \
             (CADefs.AdditionalElements.BlendShapes if self.pushButton_BS.isChecked()      else CADefs.AdditionalElements.Nothing) | \
             (CADefs.AdditionalElements.BackHeadTex if self.pushButton_BackTex.isChecked() else CADefs.AdditionalElements.Nothing)
-        basic_paths = self.pack.pack_file_paths(selected_pack)
-        if self.selected_topology == CADefs.Topology.MetaHuman:
-            additional_paths = {}
-            model_path = basic_paths["model"]
-            obj_name = "head_lod0_mesh"
-        elif self.selected_topology == CADefs.Topology.Default:
-            additional_paths = self.pack.additional_elements_paths()
-            if CADefs.AdditionalElements.RiggedBody & selected_additional:
-                model_path = additional_paths[CADefs.AdditionalElements.RiggedBody]
-                obj_name = "template_fullbody"
-            
-            elif CADefs.AdditionalElements.Components & selected_additional:
-                model_path = additional_paths[CADefs.AdditionalElements.Components]
-                if CADefs.AdditionalElements.BlendShapes & self.pack.additional_elements:
-                    obj_name = "tmppu_8s3mi"
-                else:
-                    obj_name = "Mesh"
-            
-            elif CADefs.AdditionalElements.BlendShapes & selected_additional:
-                model_path = additional_paths[CADefs.AdditionalElements.BlendShapes]
-                obj_name = "input_model"
-
-            else:
-                model_path = basic_paths["model"]
-                obj_name = "Mesh"
-
-        texture_paths = {
-            key: basic_paths[key] for key in ["texture_diffuse", "texture_specular", "texture_normal"]
-        }
+        model_path, obj_name, texture_paths, additional_paths = self.pack.import_selection(selected_pack, selected_additional)
 
         self.op_handler.pre_import(
             self,
@@ -476,7 +577,7 @@ class CustomWindow(QtWidgets.QMainWindow):
             additional_paths,
         )
 
-        QtWidgets.QApplication.setOverrideCursor(QtCore.Qt.WaitCursor)
+        # Returns immediately, more packs can be queued while this one imports
         self.op_handler.import_pack(
             model_path,
             obj_name,
@@ -485,18 +586,34 @@ class CustomWindow(QtWidgets.QMainWindow):
             selected_additional,
             self.pack.additional_elements,
             self.pack.pack_name,
-            additional_paths
+            additional_paths,
+            update=self.checkBox_update.isChecked(),
+            pack=self.pack,
+            lod=self.checkBox_lod.isChecked(),
         )
-        QtWidgets.QApplication.restoreOverrideCursor()
-        
+
+    def import_started(self, job):
+        self.progressBar_import.show()
+        self.label_import_status.setText(f"Importing {job['pack_name']}...")
+
+    def import_finished(self, job, response_body):
         self.op_handler.post_import(
             self,
-            model_path,
-            obj_name,
-            texture_paths,
-            selected_pack,
-            selected_additional,
-            self.pack.additional_elements,
-            self.pack.pack_name,
-            additional_paths,
-        )
\ No newline at end of file
+            job["model_path"],
+            job["obj_name"],
+            job["texture_paths"],
+            job["selected_pack"],
+            job["selected_additional"],
+            job["additional_elements"],
+            job["pack_name"],
+            job["additional_paths"],
+        )
+
+    def import_queue_changed(self, pending):
+        if pending == 0:
+            self.progressBar_import.hide()
+            self.label_import_status.clear()
+        elif pending > 1:
+            self.label_import_status.setText(
+                f"Importing {self.op_handler.current_import['pack_name']}... ({pending - 1} queued)"
+            )
\ No newline at end of file
@@ -33,7 +33,7 @@ SELECTION_BUTTONS_ABSOLUTE_PATHS = {
 }
 
 
-def _assert_complete_pack():
+def assert_complete_pack():
     for i in __FIXED_ELEMENTS:
         assert i in FIXED_ELEMENTS_ABSOLUTE_PATHS, i
     for file_path in FIXED_ELEMENTS_ABSOLUTE_PATHS.values():
@@ -46,6 +46,3 @@ def _assert_complete_pack():
         for file_path in d.values():
             if not os.path.exists(file_path):
                 raise FileNotFoundError(file_path)
-
-
-_assert_complete_pack()
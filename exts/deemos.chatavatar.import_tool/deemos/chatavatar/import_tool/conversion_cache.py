@@ -0,0 +1,199 @@
+from __future__ import annotations
+import os
+import asyncio
+import shutil
+import hashlib
+import tempfile
+import threading
+import concurrent.futures
+from typing import Dict, Hashable, Iterable, Optional, Set
+
+import carb
+
+# Bump when the converter output changes, so stale cache entries are not reused.
+CACHE_VERSION = 6
+# Blendshape offsets not longer than this are dropped and targets no further apart
+# than this share their data, set by the extension from its settings
+BLENDSHAPE_EPSILON = 0.0
+MAX_WORKERS = max(1, min(3, (os.cpu_count() or 2) - 1))
+# Where FBX2glTF writes its intermediate glb, set by the extension from its settings.
+# When empty, RAM backed /dev/shm if it has room for it, the temp dir otherwise.
+SCRATCH_DIRECTORY = ""
+SHARED_MEMORY_DIRECTORY = "/dev/shm"
+# Upper bound of the glb size relative to the fbx, blendshape targets are written dense
+GLB_SIZE_FACTOR = 8
+# Reading fbx files in-process (fbx_reader) instead of through FBX2glTF, set by the
+# extension from its settings: "off", "on", or "verify" to convert through FBX2glTF
+# and log where the native reader would have given something else
+NATIVE_FBX_READER = "off"
+
+class ConversionCancelled(Exception):
+    pass
+
+def omni_directory_of(source_path: str) -> str:
+    # Same layout as omni_funcs.import_pack: <unpack_path>/Omni_Directory
+    return os.path.join(os.path.dirname(os.path.dirname(source_path)), "Omni_Directory")
+
+def scratch_directory(source_path: str) -> Optional[str]:
+    """Directory for the intermediate files of converting source_path, None for the temp dir."""
+    if SCRATCH_DIRECTORY:
+        os.makedirs(SCRATCH_DIRECTORY, exist_ok=True)
+        return SCRATCH_DIRECTORY
+    if os.path.isdir(SHARED_MEMORY_DIRECTORY) and os.access(SHARED_MEMORY_DIRECTORY, os.W_OK):
+        # tmpfs is often small, e.g. 64 MB in containers
+        if shutil.disk_usage(SHARED_MEMORY_DIRECTORY).free > os.path.getsize(source_path) * GLB_SIZE_FACTOR:
+            return SHARED_MEMORY_DIRECTORY
+    return None
+
+def cache_key(source_path: str) -> str:
+    stat = os.stat(source_path)
+    # "verify" writes what FBX2glTF gives, like "off"
+    converter = "native" if NATIVE_FBX_READER == "on" and source_path.endswith(".fbx") else "default"
+    identity = f"{CACHE_VERSION}|{BLENDSHAPE_EPSILON}|{converter}|{os.path.abspath(source_path)}|{stat.st_size}|{stat.st_mtime_ns}"
+    return hashlib.sha1(identity.encode("utf-8")).hexdigest()[:16]
+
+def cached_path(source_path: str, suffix: str = ".usd") -> str:
+    stem = os.path.splitext(os.path.basename(source_path))[0]
+    return os.path.join(
+        omni_directory_of(source_path),
+        "Cache",
+        f"{stem}_{cache_key(source_path)}{suffix}",
+    )
+
+class _Job:
+    def __init__(self, future: concurrent.futures.Future, cancel_event: threading.Event):
+        self.future = future
+        self.cancel_event = cancel_event
+        self.owners: Set[Hashable] = set()
+
+class ConversionCache:
+    """Converts FBX and OBJ files to USD once per source file version.
+
+    Conversions run on a small thread pool. Every request registers an owner;
+    a job is only cancelled once all of its owners have withdrawn, so an import
+    waiting on a speculative conversion is never cancelled by the UI.
+    """
+    def __init__(self, max_workers: int = MAX_WORKERS):
+        self._executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=max_workers,
+            thread_name_prefix="chatavatar_convert",
+        )
+        self._jobs: Dict[str, _Job] = {}
+        self._lock = threading.Lock()
+
+    def _convert(self, source_path: str, out_path: str, cancel_event: threading.Event) -> str:
+        if cancel_event.is_set():
+            raise ConversionCancelled(source_path)
+        os.makedirs(os.path.dirname(out_path), exist_ok=True)
+        stem, suffix = os.path.splitext(os.path.basename(out_path))
+        # Own partial file per job, a cancelled job may still be writing when its replacement starts
+        fd, partial_path = tempfile.mkstemp(prefix=f"{stem}.", suffix=f".partial{suffix}", dir=os.path.dirname(out_path))
+        os.close(fd)
+        # Converters are only imported once something has to be converted
+        from . import fbx_to_usd, obj_to_usd
+        try:
+            if source_path.endswith(".obj"):
+                obj_to_usd.obj2usd(source_path, partial_path)
+            else:
+                summary = None
+                if NATIVE_FBX_READER == "on":
+                    try:
+                        summary = fbx_to_usd.fbx2usd(source_path, partial_path, BLENDSHAPE_EPSILON)
+                    except fbx_to_usd.FbxFormatError as e:
+                        carb.log_info(f"Converting {source_path} through FBX2glTF: {e}")
+                if summary is None:
+                    tmp_dir = tempfile.mkdtemp(prefix="chatavatar_", dir=scratch_directory(source_path))
+                    try:
+                        glb_path = os.path.join(tmp_dir, "a.glb")
+                        fbx_to_usd.fbx2gltf(source_path, glb_path, cancel_event=cancel_event)
+                        if cancel_event.is_set():
+                            raise ConversionCancelled(source_path)
+                        summary = fbx_to_usd.gltf2usd(glb_path, partial_path, BLENDSHAPE_EPSILON)
+                        if NATIVE_FBX_READER == "verify":
+                            self._verify_native(source_path, glb_path)
+                    finally:
+                        # The glb stays mapped while a traceback holds on to its arrays,
+                        # Windows cannot delete it then
+                        shutil.rmtree(tmp_dir, ignore_errors=True)
+                carb.log_info(f"Converted {source_path}: {summary}")
+        except BaseException:
+            if os.path.exists(partial_path):
+                os.remove(partial_path)
+            raise
+        # Publish atomically, a half written file must never look like a cache hit
+        os.replace(partial_path, out_path)
+        return out_path
+
+    def _verify_native(self, source_path: str, glb_path: str):
+        from . import fbx_to_usd
+        try:
+            mismatches = fbx_to_usd.native_fbx_mismatches(source_path, glb_path)
+        except fbx_to_usd.FbxFormatError as e:
+            carb.log_info(f"{source_path} is not read natively: {e}")
+            return
+        if mismatches:
+            carb.log_warn(f"Native fbx reader differs from FBX2glTF for {source_path}: {', '.join(mismatches)}")
+        else:
+            carb.log_info(f"Native fbx reader matches FBX2glTF for {source_path}")
+
+    def _forget(self, key: str, future: concurrent.futures.Future):
+        with self._lock:
+            job = self._jobs.get(key)
+            if job is not None and job.future is future:
+                del self._jobs[key]
+
+    def submit(self, source_path: str, owner: Hashable, suffix: str = ".usd") -> concurrent.futures.Future:
+        out_path = cached_path(source_path, suffix)
+        with self._lock:
+            job = self._jobs.get(out_path)
+            if job is None or job.cancel_event.is_set():
+                if os.path.exists(out_path):
+                    future = concurrent.futures.Future()
+                    future.set_result(out_path)
+                    return future
+                cancel_event = threading.Event()
+                job = _Job(
+                    self._executor.submit(self._convert, source_path, out_path, cancel_event),
+                    cancel_event,
+                )
+                self._jobs[out_path] = job
+                job.future.add_done_callback(lambda f, key=out_path: self._forget(key, f))
+            job.owners.add(owner)
+            return job.future
+
+    async def convert(self, source_path: str, suffix: str = ".usd") -> str:
+        return await asyncio.wrap_future(self.submit(source_path, object(), suffix))
+
+    def prefetch(self, source_paths: Iterable[str], owner: Hashable, suffix: str = ".usd"):
+        def report(future: concurrent.futures.Future, source_path: str):
+            if future.cancelled():
+                return
+            exc = future.exception()
+            if exc is None:
+                return
+            from . import obj_to_usd
+            if not isinstance(exc, (ConversionCancelled, obj_to_usd.ObjFormatError)):
+                carb.log_warn(f"Pre-conversion of {source_path} failed: {type(exc).__name__}: {exc}")
+
+        for source_path in source_paths:
+            future = self.submit(source_path, owner, suffix)
+            future.add_done_callback(lambda f, p=source_path: report(f, p))
+
+    def cancel(self, owner: Hashable):
+        with self._lock:
+            for job in self._jobs.values():
+                if owner not in job.owners:
+                    continue
+                job.owners.discard(owner)
+                if not job.owners:
+                    job.cancel_event.set()
+                    job.future.cancel()
+
+    def cancel_all(self):
+        with self._lock:
+            for job in self._jobs.values():
+                job.owners.clear()
+                job.cancel_event.set()
+                job.future.cancel()
+
+cache = ConversionCache()
@@ -1,5 +1,6 @@
 from __future__ import annotations
 import omni.ext
+import omni.usd
 import omni.kit.menu.utils as menu_utils
 import omni.kit.actions.core as actions_core
 from omni.services.core import main
@@ -9,9 +10,11 @@ import subprocess
 import importlib
 import importlib.util
 import carb
+import carb.tokens
 from .ChatAvatarPack import defs as CADefs
-from . import omni_funcs
+from . import conversion_cache, import_gc, import_scheduler, omni_funcs, pack_transfer, watch_folder
 import asyncio
+import json
 import sys
 import traceback
 
@@ -22,6 +25,8 @@ else:
     from typing_extensions import TypedDict
 
 from omni.services.core import routers
+from fastapi import Request
+from fastapi.responses import JSONResponse
 from pydantic import BaseModel, Field
 
 #region server
@@ -77,6 +82,31 @@ class ChatAvatarImportRequestModel(BaseModel):
         default=...,
         title="Additional item paths",
     )
+    update: bool = Field(
+        default=False,
+        title="Update previous import",
+        description="Edit the latest import of this pack in place, regenerating only what changed"
+    )
+    source_zip: Optional[str] = Field(
+        default=None,
+        title="Source zip",
+        description="Path to the pack zip, paths are then names of its members"
+    )
+    upload_id: Optional[str] = Field(
+        default=None,
+        title="Upload ID",
+        description="Pack zip sent to /upload, paths are then names of its members"
+    )
+    load: bool = Field(
+        default=True,
+        title="Load",
+        description="Load the avatar right away, an unloaded avatar is shown as a box until loaded through /avatars/load"
+    )
+    lod: bool = Field(
+        default=False,
+        title="LOD variants",
+        description="Author a \"lod\" variant set with decimated head meshes and lower subdivision levels"
+    )
 
 class ChatAvatarResponseModel(BaseModel):
     success: bool = Field(
@@ -102,7 +132,118 @@ class ChatAvatarResponseModel(BaseModel):
         description="Optional error message in case the operation was not successful.",
     )
 
+class ChatAvatarPreconvertRequestModel(BaseModel):
+    pack_id: str = Field(
+        default=...,
+        title="Pack ID",
+        description="Identifier of the opened pack, used to cancel its pre-conversion"
+    )
+    source_paths: List[str] = Field(
+        default=[],
+        title="Source paths",
+        description="Paths to all fbx files of the opened pack"
+    )
+    source_zip: Optional[str] = Field(
+        default=None,
+        title="Source zip",
+        description="Path to the pack zip, source paths are then names of its members"
+    )
+    upload_id: Optional[str] = Field(
+        default=None,
+        title="Upload ID",
+        description="Pack zip sent to /upload, source paths are then names of its members"
+    )
+    pack_name: str = Field(
+        default="",
+        title="Pack name",
+        description="Required with upload_id"
+    )
+
+class ChatAvatarLoadRequestModel(BaseModel):
+    import_ids: Optional[List[str]] = Field(
+        default=None,
+        title="Import IDs",
+        description="Avatars to load or unload, all imported avatars in the stage when omitted"
+    )
+    load: bool = Field(
+        default=True,
+        title="Load",
+        description="Load the avatars, unload them when false"
+    )
+
+class ChatAvatarLoadResponseModel(ChatAvatarResponseModel):
+    import_ids: List[str] = Field(
+        default=[],
+        title="Import IDs",
+        description="Avatars that were loaded or unloaded",
+    )
+
+class ChatAvatarExportRequestModel(BaseModel):
+    import_ids: Optional[List[str]] = Field(
+        default=None,
+        title="Import IDs",
+        description="Avatars to export, all imported avatars in the stage when omitted"
+    )
+    output_dir: Optional[str] = Field(
+        default=None,
+        title="Output directory",
+        description="Directory the USDZ files are written to, the import directory of each avatar when omitted"
+    )
+
+class ChatAvatarExportResponseModel(ChatAvatarResponseModel):
+    usdz_paths: Dict[str, str] = Field(
+        default={},
+        title="USDZ paths",
+        description="Exported USDZ file by import id",
+    )
+
+class ChatAvatarGcRequestModel(BaseModel):
+    roots: List[str] = Field(
+        default=[],
+        title="Roots",
+        description="Directories of pack zips whose extractions are collected too, besides the configured ones"
+    )
+    max_age_days: Optional[float] = Field(
+        default=None,
+        title="Maximum age",
+        description="Remove what was not referenced for this many days, 0 for no limit, the gc_max_age_days setting when omitted"
+    )
+    max_total_gb: Optional[float] = Field(
+        default=None,
+        title="Quota",
+        description="Remove least recently referenced first until the rest fits in this many GB, 0 for no quota, the gc_max_total_gb setting when omitted"
+    )
+    dry_run: bool = Field(
+        default=False,
+        title="Dry run",
+        description="Only report what would be removed"
+    )
+
+class ChatAvatarGcEntryModel(BaseModel):
+    path: str
+    kind: str = Field(description="\"import\", \"cache\" or \"extraction\"")
+    size: int = Field(description="Bytes, without the entries inside of it")
+    last_referenced: float = Field(description="Seconds since the epoch")
+    reason: str = Field(description="Why it is removed (\"age\", \"quota\") or kept")
+
+class ChatAvatarGcResponseModel(ChatAvatarResponseModel):
+    dry_run: bool = False
+    total_bytes: int = 0
+    freed_bytes: int = 0
+    removed: List[ChatAvatarGcEntryModel] = []
+    kept: List[ChatAvatarGcEntryModel] = Field(default=[], description="Entries kept whatever the policy says")
+    errors: List[Dict[str, str]] = []
+
+class ChatAvatarUploadResponseModel(ChatAvatarResponseModel):
+    upload_id: Optional[str] = Field(
+        default=None,
+        title="Upload ID",
+        description="Identifier of the uploaded pack, to be passed to /import and /preconvert",
+    )
+
 router = routers.ServiceAPIRouter()
+# Seconds a client is asked to wait before sending an import again when the queue is full
+RETRY_AFTER_S = 2
 #endregion
 
 @router.get(
@@ -121,8 +262,12 @@ async def ping():
 )
 async def import_pack(request: ChatAvatarImportRequestModel) -> ChatAvatarResponseModel:
     try:
-        fut = asyncio.ensure_future(
-            omni_funcs.import_pack(
+        source_zip, extract_dir = pack_transfer.resolve_source(request.source_zip, request.upload_id, request.pack_name)
+        # Identical requests, e.g. a double clicked confirm button, share one import
+        key = json.dumps(request.dict(), sort_keys=True, default=str)
+        fut = import_scheduler.scheduler.submit(
+            key,
+            lambda: omni_funcs.import_pack(
                 model_path=request.model_path,
                 obj_name=request.obj_name,
                 texture_paths=request.texture_paths,
@@ -137,15 +282,122 @@ async def import_pack(request: ChatAvatarImportRequestModel) -> ChatAvatarRespon
                     item["part"]: item["value"]
                     for item in request.additional_paths
                 },
+                update=request.update,
+                source_zip=source_zip,
+                extract_dir=extract_dir,
+                load=request.load,
+                lod=request.lod,
             )
         )
         await fut
+    except import_scheduler.QueueFull as e:
+        return JSONResponse(
+            status_code=429,
+            content=ChatAvatarResponseModel(success=False, error_message=f"{type(e).__name__}: {e}").dict(),
+            headers={"Retry-After": str(RETRY_AFTER_S)},
+        )
+    except Exception as e:
+        traceback.print_exc()
+        return ChatAvatarResponseModel(success=False, error_message=f"{type(e).__name__}: {e}")
+    else:
+        return ChatAvatarResponseModel(success=True, error_message=None)
+
+@router.post(
+    path="/preconvert",
+    summary="Convert the fbx files of an opened pack in background",
+    response_model=ChatAvatarResponseModel,
+    tags=["ChatAvatar"]
+)
+async def preconvert_pack(request: ChatAvatarPreconvertRequestModel) -> ChatAvatarResponseModel:
+    try:
+        source_zip, extract_dir = pack_transfer.resolve_source(request.source_zip, request.upload_id, request.pack_name)
+        omni_funcs.preconvert_pack(request.source_paths, request.pack_id, source_zip, extract_dir)
     except Exception as e:
         traceback.print_exc()
         return ChatAvatarResponseModel(success=False, error_message=f"{type(e).__name__}: {e}")
     else:
         return ChatAvatarResponseModel(success=True, error_message=None)
 
+@router.post(
+    path="/preconvert/cancel",
+    summary="Cancel background conversion of an opened pack",
+    response_model=ChatAvatarResponseModel,
+    tags=["ChatAvatar"]
+)
+async def cancel_preconvert(request: ChatAvatarPreconvertRequestModel) -> ChatAvatarResponseModel:
+    omni_funcs.cancel_preconvert(request.pack_id)
+    return ChatAvatarResponseModel(success=True, error_message=None)
+
+@router.post(
+    path="/avatars/load",
+    summary="Load or unload imported avatars",
+    response_model=ChatAvatarLoadResponseModel,
+    tags=["ChatAvatar"]
+)
+async def load_avatars(request: ChatAvatarLoadRequestModel) -> ChatAvatarLoadResponseModel:
+    try:
+        import_ids = omni_funcs.load_avatars(request.import_ids, request.load)
+    except Exception as e:
+        traceback.print_exc()
+        return ChatAvatarLoadResponseModel(success=False, error_message=f"{type(e).__name__}: {e}")
+    else:
+        return ChatAvatarLoadResponseModel(success=True, error_message=None, import_ids=import_ids)
+
+@router.post(
+    path="/avatars/export",
+    summary="Export imported avatars as self-contained USDZ files",
+    response_model=ChatAvatarExportResponseModel,
+    tags=["ChatAvatar"]
+)
+async def export_avatars(request: ChatAvatarExportRequestModel) -> ChatAvatarExportResponseModel:
+    try:
+        usdz_paths = await omni_funcs.export_avatars(request.import_ids, request.output_dir)
+    except Exception as e:
+        traceback.print_exc()
+        return ChatAvatarExportResponseModel(success=False, error_message=f"{type(e).__name__}: {e}")
+    else:
+        return ChatAvatarExportResponseModel(success=True, error_message=None, usdz_paths=usdz_paths)
+
+@router.post(
+    path="/imports/gc",
+    summary="Remove imports, pack extractions and cached conversions not referenced for a while",
+    response_model=ChatAvatarGcResponseModel,
+    tags=["ChatAvatar"]
+)
+async def collect_garbage(request: ChatAvatarGcRequestModel) -> ChatAvatarGcResponseModel:
+    try:
+        report = await omni_funcs.collect_garbage(
+            request.roots + import_gc.ROOTS,
+            import_gc.MAX_AGE_DAYS if request.max_age_days is None else request.max_age_days,
+            import_gc.MAX_TOTAL_GB if request.max_total_gb is None else request.max_total_gb,
+            request.dry_run,
+        )
+    except Exception as e:
+        traceback.print_exc()
+        return ChatAvatarGcResponseModel(success=False, error_message=f"{type(e).__name__}: {e}")
+    else:
+        return ChatAvatarGcResponseModel(success=True, error_message=None, **report)
+
+@router.post(
+    path="/upload",
+    summary="Receive a pack zip streamed in the request body",
+    response_model=ChatAvatarUploadResponseModel,
+    tags=["ChatAvatar"]
+)
+async def upload_pack(request: Request) -> ChatAvatarUploadResponseModel:
+    try:
+        upload_id = await pack_transfer.receive_upload(request.stream())
+    except pack_transfer.UploadTooLarge as e:
+        return JSONResponse(
+            status_code=413,
+            content=ChatAvatarUploadResponseModel(success=False, error_message=f"{type(e).__name__}: {e}").dict(),
+        )
+    except Exception as e:
+        traceback.print_exc()
+        return ChatAvatarUploadResponseModel(success=False, error_message=f"{type(e).__name__}: {e}")
+    else:
+        return ChatAvatarUploadResponseModel(success=True, error_message=None, upload_id=upload_id)
+
 # Any class derived from `omni.ext.IExt` in top level module (defined in `python.modules` of `extension.toml`) will be
 # instantiated when extension gets enabled and `on_startup(ext_id)` will be called. Later when extension gets disabled
 # on_shutdown() is called.
@@ -185,14 +437,37 @@ class DeemosChatavatarImport_toolExtension(omni.ext.IExt):
             if not isinstance(self.window_process.poll(), int):
                 self.window_process.kill()
 
+    def send_window_command(self, command):
+        try:
+            self.window_process.stdin.write(f"{command}\n".encode())
+            self.window_process.stdin.flush()
+        except (OSError, ValueError):
+            return False
+        return True
+
     def pop_window(self):
+        # The launcher stays alive when its window is closed, it only has to be shown again
+        if isinstance(self.window_process, subprocess.Popen) and \
+            self.window_process.poll() is None and \
+            self.send_window_command("show"):
+            return
+        # A launcher this extension lost track of (e.g. after a reload) takes
+        # over the request through its single instance channel
+        self.spawn_window()
+
+    def spawn_window(self, hidden=False):
         self.kill_window()
 
         args = [
             self.find_python_path(),
             "ui_launcher.py",
-            "--url", self.url
+            "--url", self.url,
+            "--resident",
+            "--parent-pid", str(os.getpid()),
+            "--unpack", self.unpack_mode,
         ]
+        if hidden:
+            args.append("--hidden")
         env = {
             **os.environ,
             "PYTHONPATH": ";".join([self.PySide6_path])
@@ -207,6 +482,7 @@ class DeemosChatavatarImport_toolExtension(omni.ext.IExt):
             args,
             cwd=os.path.dirname(__file__),
             env=env,
+            stdin=subprocess.PIPE,
         )
 
     def on_startup(self, ext_id):
@@ -239,14 +515,73 @@ class DeemosChatavatarImport_toolExtension(omni.ext.IExt):
         # register router
         ext_name = ext_id.split("-")[0]
         self.url_prefix = carb.settings.get_settings().get_as_string(f"exts/{ext_name}/url_prefix")
+        # Opt-in human readable (usda) output, crate is written otherwise
+        omni_funcs.DEBUG = carb.settings.get_settings().get_as_bool(f"exts/{ext_name}/debug_ascii_usd")
+        import_scheduler.scheduler = import_scheduler.ImportScheduler(
+            max(1, carb.settings.get_settings().get_as_int(f"exts/{ext_name}/import_queue_size")),
+            max(1, carb.settings.get_settings().get_as_int(f"exts/{ext_name}/max_concurrent_imports")),
+        )
+        conversion_cache.BLENDSHAPE_EPSILON = carb.settings.get_settings().get_as_float(f"exts/{ext_name}/blendshape_epsilon")
+        omni_funcs.NATIVE_OBJ = carb.settings.get_settings().get_as_bool(f"exts/{ext_name}/native_obj_reader")
+        conversion_cache.NATIVE_FBX_READER = (
+            carb.settings.get_settings().get_as_string(f"exts/{ext_name}/native_fbx_reader") or "off"
+        )
+        conversion_cache.SCRATCH_DIRECTORY = carb.tokens.get_tokens_interface().resolve(
+            carb.settings.get_settings().get_as_string(f"exts/{ext_name}/scratch_directory")
+        )
+        pack_transfer.UPLOAD_DIRECTORY = carb.tokens.get_tokens_interface().resolve(
+            carb.settings.get_settings().get_as_string(f"exts/{ext_name}/upload_directory")
+        )
+        pack_transfer.MAX_UPLOAD_SIZE = carb.settings.get_settings().get_as_int(f"exts/{ext_name}/max_upload_mb") << 20
+        self.unpack_mode = carb.settings.get_settings().get_as_string(f"exts/{ext_name}/unpack_mode") or "local"
         main.register_router(router=router, prefix=self.url_prefix)
+        self.watch_folders = None
+        watch_folder_entries = carb.settings.get_settings().get(f"exts/{ext_name}/watch_folders") or []
+        if watch_folder_entries:
+            self.watch_folders = watch_folder.WatchFolders(
+                {
+                    carb.tokens.get_tokens_interface().resolve(entry["path"]): watch_folder.preset_from_settings(entry)
+                    for entry in watch_folder_entries
+                },
+                import_scheduler.scheduler.max_preparing,
+            )
+            self.watch_folders.start()
+        import_gc.REGISTRY_PATH = carb.tokens.get_tokens_interface().resolve(
+            carb.settings.get_settings().get_as_string(f"exts/{ext_name}/import_registry")
+        )
+        import_gc.MAX_AGE_DAYS = carb.settings.get_settings().get_as_float(f"exts/{ext_name}/gc_max_age_days")
+        import_gc.MAX_TOTAL_GB = carb.settings.get_settings().get_as_float(f"exts/{ext_name}/gc_max_total_gb")
+        # Packs are extracted next to uploaded and watched zips
+        import_gc.ROOTS = [
+            carb.tokens.get_tokens_interface().resolve(root)
+            for root in carb.settings.get_settings().get(f"exts/{ext_name}/gc_roots") or []
+        ] + [pack_transfer.upload_directory()] + (list(self.watch_folders.folders) if self.watch_folders else [])
+        # Imports in a stage count as referenced when it is opened and when it is closed
+        self._stage_event_subscription = omni.usd.get_context().get_stage_event_stream().create_subscription_to_pop(
+            self.on_stage_event, name="chatavatar import registry"
+        )
         self.set_transfer_path()
+        # Start the launcher hidden, so the menu item only has to show it
+        self.prewarm_launcher = carb.settings.get_settings().get_as_bool(f"exts/{ext_name}/prewarm_launcher")
+        if self.prewarm_launcher:
+            self.spawn_window(hidden=True)
         
 
+    def on_stage_event(self, event):
+        if event.type in (int(omni.usd.StageEventType.OPENED), int(omni.usd.StageEventType.CLOSING)):
+            stage = omni.usd.get_context().get_stage()
+            if stage is not None:
+                omni_funcs.touch_imports(stage)
+
     def on_shutdown(self):
         print("[deemos.chatavatar.import_tool] deemos chatavatar import_tool shutdown")
         self._action_registry.deregister_all_actions_for_extension(self.EXTENSION_ID)
         menu_utils.remove_menu_items(self._menu_item_list, "ChatAvatar Import Tool")
         # deregister router
         main.deregister_router(router=router)
+        if self.watch_folders is not None:
+            self.watch_folders.stop()
+        self._stage_event_subscription = None
+        omni_funcs.conversion_cache.cache.cancel_all()
+        self.kill_window()
         
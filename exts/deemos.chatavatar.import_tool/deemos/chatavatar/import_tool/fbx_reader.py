@@ -0,0 +1,219 @@
+# Reader of binary FBX files, decoding their arrays straight into numpy.
+# Only the node tree is parsed here, the FBX scene (objects, connections,
+# properties) is interpreted by fbx_to_usd.build_fbx_mesh_data. Anything it
+# cannot read raises FbxFormatError so the caller can fall back to FBX2glTF.
+
+import struct
+import zlib
+from typing import Dict, List, Optional
+import numpy as np
+
+FBX_MAGIC = b"Kaydara FBX Binary  \x00\x1a\x00"
+# Node records use 64-bit offsets from this version on
+FBX_WIDE_VERSION = 7500
+SCALAR_FORMATS = {
+    b"Y": struct.Struct("<h"),
+    b"C": struct.Struct("<?"),
+    b"I": struct.Struct("<i"),
+    b"F": struct.Struct("<f"),
+    b"D": struct.Struct("<d"),
+    b"L": struct.Struct("<q"),
+}
+ARRAY_DTYPES = {
+    b"f": np.dtype("<f4"),
+    b"d": np.dtype("<f8"),
+    b"i": np.dtype("<i4"),
+    b"l": np.dtype("<i8"),
+    b"b": np.dtype("?"),
+}
+NODE_HEADER = struct.Struct("<IIIB")
+WIDE_NODE_HEADER = struct.Struct("<QQQB")
+LENGTH = struct.Struct("<I")
+ARRAY_HEADER = struct.Struct("<III")
+# Object names are stored as "name\x00\x01class"
+NAME_SEPARATOR = "\x00\x01"
+
+class FbxFormatError(ValueError):
+    pass
+
+class FbxArray:
+    """Array property, only inflated and decoded when asked for."""
+    __slots__ = ("dtype", "count", "encoding", "data")
+
+    def __init__(self, dtype, count, encoding, data):
+        self.dtype = dtype
+        self.count = count
+        self.encoding = encoding
+        self.data = data
+
+    def decode(self) -> np.ndarray:
+        if self.encoding == 1:
+            try:
+                data = zlib.decompress(self.data)
+            except zlib.error as e:
+                raise FbxFormatError(f"Corrupted array: {e}") from e
+        elif self.encoding == 0:
+            data = self.data
+        else:
+            raise FbxFormatError(f"Unknown array encoding {self.encoding}")
+        if len(data) != self.count * self.dtype.itemsize:
+            raise FbxFormatError("Array length does not match its data")
+        return np.frombuffer(data, dtype=self.dtype, count=self.count)
+
+class FbxNode:
+    __slots__ = ("name", "properties", "children")
+
+    def __init__(self, name: str, properties: list, children: List["FbxNode"]):
+        self.name = name
+        self.properties = properties
+        self.children = children
+
+    def find(self, name: str) -> Optional["FbxNode"]:
+        return next((child for child in self.children if child.name == name), None)
+
+    def find_all(self, name: str) -> List["FbxNode"]:
+        return [child for child in self.children if child.name == name]
+
+    def array(self, name: str, default=None) -> np.ndarray:
+        """Decoded array property of the child name."""
+        child = self.find(name)
+        if child is None:
+            if default is not None:
+                return default
+            raise FbxFormatError(f"{self.name} has no {name}")
+        if not child.properties or not isinstance(child.properties[0], FbxArray):
+            raise FbxFormatError(f"{name} is not an array")
+        return child.properties[0].decode()
+
+    def value(self, name: str, default=None):
+        """First property of the child name."""
+        child = self.find(name)
+        return child.properties[0] if child is not None and child.properties else default
+
+    def properties70(self) -> Dict[str, list]:
+        """Values of the Properties70 entries by property name."""
+        properties = self.find("Properties70")
+        if properties is None:
+            return {}
+        # P: name, type, label, flags, values...
+        return {p.properties[0]: p.properties[4:] for p in properties.find_all("P")}
+
+def object_name(node: FbxNode) -> str:
+    return node.properties[1].split(NAME_SEPARATOR)[0]
+
+def _read_property(data, offset):
+    type_code = bytes(data[offset:offset + 1])
+    offset += 1
+    scalar_format = SCALAR_FORMATS.get(type_code)
+    if scalar_format is not None:
+        return scalar_format.unpack_from(data, offset)[0], offset + scalar_format.size
+    if type_code in (b"S", b"R"):
+        (length,) = LENGTH.unpack_from(data, offset)
+        offset += LENGTH.size
+        value = data[offset:offset + length]
+        if type_code == b"S":
+            value = bytes(value).decode("utf-8", "replace")
+        return value, offset + length
+    dtype = ARRAY_DTYPES.get(type_code)
+    if dtype is None:
+        raise FbxFormatError(f"Unknown property type {type_code!r}")
+    count, encoding, length = ARRAY_HEADER.unpack_from(data, offset)
+    offset += ARRAY_HEADER.size
+    return FbxArray(dtype, count, encoding, data[offset:offset + length]), offset + length
+
+def _read_node(data, offset, header):
+    """(node, offset after it), node is None for the record closing a child list."""
+    end_offset, property_count, _, name_length = header.unpack_from(data, offset)
+    if end_offset == 0:
+        return None, offset + header.size
+    if end_offset > len(data):
+        raise FbxFormatError("Truncated file")
+    offset += header.size
+    name = bytes(data[offset:offset + name_length]).decode("ascii")
+    offset += name_length
+    properties = []
+    for _ in range(property_count):
+        value, offset = _read_property(data, offset)
+        properties.append(value)
+    children = []
+    while offset < end_offset:
+        child, offset = _read_node(data, offset, header)
+        if child is None:
+            break
+        children.append(child)
+    return FbxNode(name, properties, children), end_offset
+
+def read_fbx(in_file) -> FbxNode:
+    """Node tree of a binary FBX file, under a nameless root node."""
+    with open(in_file, "rb") as f:
+        data = memoryview(f.read())
+    if bytes(data[:len(FBX_MAGIC)]) != FBX_MAGIC:
+        raise FbxFormatError("Not a binary FBX file")
+    (version,) = LENGTH.unpack_from(data, len(FBX_MAGIC))
+    header = WIDE_NODE_HEADER if version >= FBX_WIDE_VERSION else NODE_HEADER
+    offset = len(FBX_MAGIC) + LENGTH.size
+    nodes = []
+    try:
+        while offset + header.size <= len(data):
+            node, offset = _read_node(data, offset, header)
+            if node is None:
+                break
+            nodes.append(node)
+    except (struct.error, UnicodeDecodeError) as e:
+        raise FbxFormatError(f"Corrupted file: {e}") from e
+    return FbxNode("", [version], nodes)
+
+class FbxScene:
+    """Objects of a node tree by id, and the connections between them."""
+    def __init__(self, root: FbxNode):
+        objects = root.find("Objects")
+        connections = root.find("Connections")
+        if objects is None or connections is None:
+            raise FbxFormatError("No objects or connections")
+        self.root = root
+        # Defaults of the properties of each object type
+        self._templates: Dict[str, Dict[str, list]] = {}
+        definitions = root.find("Definitions")
+        for object_type in definitions.find_all("ObjectType") if definitions is not None else []:
+            template = object_type.find("PropertyTemplate")
+            if template is not None:
+                self._templates[object_type.properties[0]] = template.properties70()
+        self.objects: Dict[int, FbxNode] = {node.properties[0]: node for node in objects.children}
+        self._children: Dict[int, List[int]] = {}
+        self._parents: Dict[int, List[int]] = {}
+        for connection in connections.find_all("C"):
+            # OO: object to object, OP: object to a property of the other one
+            if connection.properties[0] != "OO":
+                continue
+            child_id, parent_id = connection.properties[1:3]
+            self._children.setdefault(parent_id, []).append(child_id)
+            self._parents.setdefault(child_id, []).append(parent_id)
+
+    def properties(self, node: FbxNode) -> Dict[str, list]:
+        """Properties70 of node over the defaults of its type."""
+        return {**self._templates.get(node.name, {}), **node.properties70()}
+
+    def settings(self) -> Dict[str, list]:
+        settings = self.root.find("GlobalSettings")
+        return settings.properties70() if settings is not None else {}
+
+    def of_type(self, node_name: str, sub_class: Optional[str] = None) -> List[FbxNode]:
+        return [
+            node for node in self.objects.values()
+            if node.name == node_name and (sub_class is None or node.properties[2] == sub_class)
+        ]
+
+    def _connected(self, ids, node_name, sub_class):
+        nodes = [self.objects[i] for i in ids if i in self.objects]
+        return [
+            node for node in nodes
+            if node.name == node_name and (sub_class is None or node.properties[2] == sub_class)
+        ]
+
+    def children(self, node: FbxNode, node_name: str, sub_class: Optional[str] = None) -> List[FbxNode]:
+        """Objects connected to node, in connection order."""
+        return self._connected(self._children.get(node.properties[0], []), node_name, sub_class)
+
+    def parents(self, node: FbxNode, node_name: str, sub_class: Optional[str] = None) -> List[FbxNode]:
+        """Objects node is connected to, in connection order."""
+        return self._connected(self._parents.get(node.properties[0], []), node_name, sub_class)
@@ -5,19 +5,31 @@
 # that it should be.
 # The modified version has a custom field "ORIGINAL_INDICES", having the vertex
 # index in the original fbx
+# Binary fbx files ChatAvatar writes can be read in-process instead (fbx_reader),
+# into the same arrays FBX2glTF would give, with the original polygons.
 
 import os
 import sys
 import json
+import mmap
 import base64
+import zlib
+import struct
+import functools
 import numpy as np
-from scipy.spatial.transform import Rotation as Rotation
-from pxr import Usd, UsdGeom, UsdShade, Gf, UsdSkel, Sdf
+from pxr import Gf, Sdf, Tf, Vt
+from . import usd_authoring
+from .fbx_reader import FbxFormatError, FbxScene, object_name, read_fbx
 import subprocess
 
 
 # Constants
 BUFFER_URI_PERFIX = "data:application/octet-stream;base64,"
+GLB_MAGIC = b"glTF"
+GLB_HEADER = struct.Struct("<4sII")
+GLB_CHUNK_HEADER = struct.Struct("<II")
+GLB_JSON_CHUNK = 0x4E4F534A
+GLB_BIN_CHUNK = 0x004E4942
 COMPONENT_TYPE_SIZE = {
     5120: 1,  # GL_BYTE
     5121: 1,  # GL_UNSIGNED_BYTE
@@ -34,6 +46,18 @@ COMPONENT_TYPE_NP = {
     5125: np.uint32,  # GL_UNSIGNED_INT
     5126: np.float32  # GL_FLOAT
 }
+# glTF to skeleton space, the points are converted the same way (row vector convention)
+SKEL_COORD_CONVERT = np.array([[1,0,0,0],[0,0,1,0],[0,-1,0,0],[0,0,0,1]], dtype=float)
+POINTS_COORD_CONVERT = SKEL_COORD_CONVERT[:3, :3]
+DEFAULT_FRAMES_PER_SECOND = 24.0
+# FBX2glTF reads centimeters and writes meters
+FBX_SCALE = 0.01
+# Name FBX2glTF gives the node of the scene root
+FBX_ROOT_NAME = "RootNode"
+# "XYZ" rotates about X first
+FBX_ROTATION_ORDERS = ["XYZ", "XZY", "YZX", "YXZ", "ZXY", "ZYX"]
+# Axis system read natively (Y up, right handed), FBX2glTF converts others
+FBX_AXIS_SETTINGS = {"UpAxis": 1, "UpAxisSign": 1, "FrontAxis": 2, "FrontAxisSign": 1, "CoordAxis": 0, "CoordAxisSign": 1}
 TYPE_ELEMENT_COUNT = {
     "SCALAR": 1,
     "VEC2": 2,
@@ -56,13 +80,41 @@ TYPE_ELEMENT_SHAPE = {
 def safe_usd_name(name):
     return name.replace(".", "_")
 
+def _read_glb(in_file):
+    """JSON chunk and memory mapped BIN chunk of a glb, only the JSON is parsed."""
+    with open(in_file, "rb") as f:
+        data = memoryview(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ))
+    magic, _, length = GLB_HEADER.unpack_from(data, 0)
+    assert magic == GLB_MAGIC and length <= len(data)
+    content, binary = None, None
+    offset = GLB_HEADER.size
+    while offset < length:
+        chunk_length, chunk_type = GLB_CHUNK_HEADER.unpack_from(data, offset)
+        offset += GLB_CHUNK_HEADER.size
+        if chunk_type == GLB_JSON_CHUNK:
+            content = json.loads(bytes(data[offset:offset + chunk_length]))
+        elif chunk_type == GLB_BIN_CHUNK and binary is None:
+            binary = data[offset:offset + chunk_length]
+        offset += chunk_length
+    return content, binary
+
 def read_gltf(in_file):
-    # load gltf
-    with open(in_file, "r") as f:
-        content = json.load(f)
+    # load gltf, accessors of a glb are views of the mapped file
+    with open(in_file, "rb") as f:
+        is_glb = f.read(len(GLB_MAGIC)) == GLB_MAGIC
+    if is_glb:
+        content, binary = _read_glb(in_file)
+    else:
+        with open(in_file, "r") as f:
+            content = json.load(f)
 
     buffers = []
     for buffer in content["buffers"]:
+        if "uri" not in buffer:
+            # The BIN chunk of a glb
+            assert is_glb and binary is not None and len(binary) >= buffer["byteLength"]
+            buffers.append(binary)
+            continue
         assert buffer["uri"].startswith(BUFFER_URI_PERFIX)
         buf = base64.b64decode(buffer["uri"][len(BUFFER_URI_PERFIX):])
         assert len(buf) == buffer["byteLength"]
@@ -138,26 +190,93 @@ def read_gltf(in_file):
         if "skin" in node:
             node["skin"] = skins[node["skin"]]
 
+    # Animations, one entry per channel targeting a node
+    animations = []
+    for animation in content.get("animations", []):
+        channels = []
+        for channel in animation["channels"]:
+            if "node" not in channel["target"]:
+                continue
+            sampler = animation["samplers"][channel["sampler"]]
+            values = accessors[sampler["output"]]["data"]
+            if np.issubdtype(values.dtype, np.integer):
+                # Normalized integers, allowed for rotations and weights
+                values = np.maximum(values / np.iinfo(values.dtype).max, -1.0)
+            channels.append({
+                "node": channel["target"]["node"],
+                "path": channel["target"]["path"],
+                "interpolation": sampler.get("interpolation", "LINEAR"),
+                "times": accessors[sampler["input"]]["data"].ravel().astype(np.float64),
+                "values": values.astype(np.float64),
+            })
+        animations.append({"name": animation.get("name", ""), "channels": channels})
+
     return {
         "materials": materials,
         "nodes_parent": nodes_parent,
         "nodes": nodes,
-        "skins": skins
+        "skins": skins,
+        "animations": animations,
     }
 
 def _merge_prim_arraies(arrays, indices_arraies, vertices_count):
     points = np.zeros((vertices_count, arrays[0].shape[1]))
     flags = np.zeros((vertices_count,), dtype=bool)
     for array, indices_array in zip(arrays, indices_arraies):
-        for new_vertex_point, original_index in zip(array, indices_array):
-            if flags[original_index] == 1:
-                assert np.allclose(new_vertex_point, points[original_index])
-            points[original_index] = new_vertex_point
-            flags[original_index] = 1
+        indices = indices_array.ravel()
+        seen = flags[indices]
+        if np.any(seen):
+            assert np.allclose(array[seen], points[indices[seen]])
+        points[indices] = array
+        # Also catches disagreeing duplicates inside the same primitive
+        assert np.allclose(points[indices], array)
+        flags[indices] = True
     
-    assert np.all(flags==1)
+    assert np.all(flags)
     return points
 
+def compress_blendshapes(blendshapes, epsilon):
+    """Sparse float32 targets from dense offsets, with what the compression cost.
+
+    A target within epsilon of an earlier one gets "duplicate_of" set to its name,
+    "error" is the largest distance of a stored offset to the original one.
+    """
+    results = []
+    by_point_indices = {}
+    for bs in blendshapes:
+        dense_offsets = bs["offsets"]
+        lengths = np.linalg.norm(dense_offsets, axis=1)
+        moved = lengths > epsilon
+        result = {
+            "name": bs["name"],
+            "offsets": dense_offsets[moved].astype(np.float32),
+            "point_indices": np.flatnonzero(moved).astype(np.int32),
+            "dropped": int(np.count_nonzero(lengths[~moved])),
+            "duplicate_of": None,
+        }
+        candidates = by_point_indices.setdefault(result["point_indices"].tobytes(), [])
+        for other in candidates:
+            if np.all(np.linalg.norm(other["offsets"] - result["offsets"], axis=1) <= epsilon):
+                result["duplicate_of"] = other["name"]
+                result["offsets"] = other["offsets"]
+                break
+        else:
+            candidates.append(result)
+        stored_offsets = np.zeros_like(dense_offsets)
+        stored_offsets[moved] = result["offsets"]
+        result["error"] = float(np.linalg.norm(stored_offsets - dense_offsets, axis=1).max(initial=0.0))
+        results.append(result)
+    return results
+
+def blendshape_summary(blendshapes):
+    return (
+        f"{len(blendshapes)} blendshapes"
+        f", {sum(bs['duplicate_of'] is not None for bs in blendshapes)} shared"
+        f", {sum(len(bs['point_indices']) for bs in blendshapes)} offsets kept"
+        f", {sum(bs['dropped'] for bs in blendshapes)} dropped"
+        f", largest error {max((bs['error'] for bs in blendshapes), default=0.0):.3g}"
+    )
+
 def _get_node_path(start_node_index, end_node_index, nodes, nodes_parent):
     path = []
     current_node_index = start_node_index
@@ -168,158 +287,235 @@ def _get_node_path(start_node_index, end_node_index, nodes, nodes_parent):
     
     return "/".join(reversed(path))
 
+def quat_to_matrix(quats):
+    """Rotation matrices (..., 3, 3) of unit quaternions (..., 4) in glTF's (x, y, z, w) order."""
+    x, y, z, w = np.moveaxis(np.asarray(quats, dtype=np.float64), -1, 0)
+    return np.stack([
+        np.stack([1 - 2*(y*y + z*z), 2*(x*y - z*w), 2*(x*z + y*w)], axis=-1),
+        np.stack([2*(x*y + z*w), 1 - 2*(x*x + z*z), 2*(y*z - x*w)], axis=-1),
+        np.stack([2*(x*z - y*w), 2*(y*z + x*w), 1 - 2*(x*x + y*y)], axis=-1),
+    ], axis=-2)
+
+def matrix_to_quat(matrices):
+    """Unit quaternions (..., 4) in (x, y, z, w) order of rotation matrices (..., 3, 3)."""
+    m = np.asarray(matrices, dtype=np.float64)
+    trace = m[..., 0, 0] + m[..., 1, 1] + m[..., 2, 2]
+    # products[i, j] = 4 * q[i] * q[j], the row of the largest component is divided by it
+    products = np.empty(m.shape[:-2] + (4, 4))
+    products[..., 0, 0] = 1 + 2 * m[..., 0, 0] - trace
+    products[..., 1, 1] = 1 + 2 * m[..., 1, 1] - trace
+    products[..., 2, 2] = 1 + 2 * m[..., 2, 2] - trace
+    products[..., 3, 3] = 1 + trace
+    products[..., 0, 1] = products[..., 1, 0] = m[..., 0, 1] + m[..., 1, 0]
+    products[..., 0, 2] = products[..., 2, 0] = m[..., 0, 2] + m[..., 2, 0]
+    products[..., 1, 2] = products[..., 2, 1] = m[..., 1, 2] + m[..., 2, 1]
+    products[..., 0, 3] = products[..., 3, 0] = m[..., 2, 1] - m[..., 1, 2]
+    products[..., 1, 3] = products[..., 3, 1] = m[..., 0, 2] - m[..., 2, 0]
+    products[..., 2, 3] = products[..., 3, 2] = m[..., 1, 0] - m[..., 0, 1]
+    largest = np.argmax(np.diagonal(products, axis1=-2, axis2=-1), axis=-1)
+    row = np.take_along_axis(products, largest[..., None, None], axis=-2)[..., 0, :]
+    return row / (2 * np.sqrt(np.take_along_axis(row, largest[..., None], axis=-1)))
+
 def _get_transform_from_node(node):
     translation = node.get("translation", np.array([0,0,0]))
     rotation = node.get("rotation", np.array([0,0,0,1]))
     scale = node.get("scale", np.array([1, 1, 1]))
     matrix = np.eye(4)
-    matrix[:3, :3] = Rotation.from_quat(rotation).as_matrix() * scale
+    matrix[:3, :3] = quat_to_matrix(rotation) * scale
     matrix[:3, 3] = translation
     return matrix
 
 
-def gen_usd(gltf_data, out_file):
-    # write usd
-    materials = gltf_data["materials"]
-    nodes_parent = gltf_data["nodes_parent"]
+def _resample(channel, times):
+    """Channel values at times, (len(times), components), for all times at once."""
+    keys = channel["times"]
+    values = channel["values"].reshape(len(keys) * (3 if channel["interpolation"] == "CUBICSPLINE" else 1), -1)
+    if channel["interpolation"] == "CUBICSPLINE":
+        # (in tangent, value, out tangent) per key, tangents are left out
+        values = values[1::3]
+    index = np.clip(np.searchsorted(keys, times, side="right") - 1, 0, len(keys) - 1)
+    if channel["interpolation"] == "STEP" or len(keys) == 1:
+        return values[index]
+    index = np.minimum(index, len(keys) - 2)
+    fraction = np.clip((times - keys[index]) / (keys[index + 1] - keys[index]), 0.0, 1.0)[:, None]
+    start, end = values[index], values[index + 1]
+    if channel["path"] == "rotation":
+        # Normalized lerp along the shorter arc
+        end = end * np.where(np.sum(start * end, axis=1, keepdims=True) < 0, -1.0, 1.0)
+        result = start + (end - start) * fraction
+        return result / np.linalg.norm(result, axis=1, keepdims=True)
+    return start + (end - start) * fraction
+
+def _root_parent_transform(root_joint, nodes, nodes_parent):
+    """Skeleton space from the space the root joint is local to (column vector convention)."""
+    transform = np.eye(4)
+    node_index = root_joint
+    while nodes_parent[node_index] != node_index:
+        node_index = nodes_parent[node_index]
+        transform = _get_transform_from_node(nodes[node_index]) @ transform
+    return SKEL_COORD_CONVERT.T @ transform
+
+def build_animations(gltf_data, mesh_node, joints, blendshape_names):
+    """Joint local transforms and blendshape weights of every animation, sampled on one timeline each.
+
+    joints are node indices, joints without channels keep their rest transform.
+    The root joint is given in skeleton space, the glTF space converted like the points.
+    """
     nodes = gltf_data["nodes"]
-    skins = gltf_data["skins"]
+    nodes_parent = gltf_data["nodes_parent"]
+    mesh_node_index = next(i for i, node in enumerate(nodes) if node is mesh_node)
+    joint_slots = {joint: slot for slot, joint in enumerate(joints)}
+    rest = {
+        "translation": np.array([nodes[joint].get("translation", [0, 0, 0]) for joint in joints], dtype=np.float64).reshape(-1, 3),
+        "rotation": np.array([nodes[joint].get("rotation", [0, 0, 0, 1]) for joint in joints], dtype=np.float64).reshape(-1, 4),
+        "scale": np.array([nodes[joint].get("scale", [1, 1, 1]) for joint in joints], dtype=np.float64).reshape(-1, 3),
+    }
+    root_slot = next((slot for joint, slot in joint_slots.items() if nodes_parent[joint] not in joint_slots), None)
+    if root_slot is not None:
+        root_parent_transform = _root_parent_transform(joints[root_slot], nodes, nodes_parent)
+
+    animations = []
+    for animation_index, animation in enumerate(gltf_data["animations"]):
+        channels = [
+            channel for channel in animation["channels"]
+            if (channel["node"] in joint_slots and channel["path"] in rest)
+            or (channel["node"] == mesh_node_index and channel["path"] == "weights" and blendshape_names)
+        ]
+        if not channels:
+            continue
+        # Channels baked by FBX2glTF share their keys, the union is taken anyway
+        times = np.unique(np.round(np.concatenate([channel["times"] for channel in channels]), 6))
+        sampled = {path: np.repeat(values[None], len(times), axis=0) for path, values in rest.items()}
+        weights = np.zeros((len(times), len(blendshape_names)))
+        for channel in channels:
+            values = _resample(channel, times)
+            if channel["path"] == "weights":
+                weights = values
+            else:
+                sampled[channel["path"]][:, joint_slots[channel["node"]]] = values
+
+        if root_slot is not None:
+            root_transforms = np.tile(np.eye(4), (len(times), 1, 1))
+            root_transforms[:, :3, :3] = quat_to_matrix(sampled["rotation"][:, root_slot]) * sampled["scale"][:, root_slot, None, :]
+            root_transforms[:, :3, 3] = sampled["translation"][:, root_slot]
+            root_transforms = root_parent_transform @ root_transforms
+            linear = root_transforms[:, :3, :3]
+            scales = np.linalg.norm(linear, axis=1)
+            scales[np.linalg.det(linear) < 0, 0] *= -1
+            sampled["translation"][:, root_slot] = root_transforms[:, :3, 3]
+            sampled["rotation"][:, root_slot] = matrix_to_quat(linear / scales[:, None, :])
+            sampled["scale"][:, root_slot] = scales
+        frame_steps = np.diff(times)
+        # Clip names are free text, e.g. "Take 001"
+        name = Tf.MakeValidIdentifier(animation["name"] or f"Animation_{animation_index}")
+        if any(other["name"] == name for other in animations):
+            name = f"{name}_{animation_index}"
+        animations.append({
+            "name": name,
+            "times": times,
+            "frames_per_second": float(np.round(1.0 / np.median(frame_steps))) if len(frame_steps) else DEFAULT_FRAMES_PER_SECOND,
+            "translations": sampled["translation"].astype(np.float32),
+            "rotations": sampled["rotation"].astype(np.float32),
+            "scales": sampled["scale"].astype(np.float16),
+            "blendshape_weights": weights.astype(np.float32),
+        })
+    return animations
+
+def _rebuild_polygons(gltf_mesh_obj, faces_count):
+    """Merge the triangle pairs FBX2glTF split quads into back to polygons.
 
-    # Create a new stage
-    stage = Usd.Stage.CreateNew(out_file)
-    stage.SetMetadata('metersPerUnit', 0.01)
-    stage.SetMetadata('upAxis', 'Y')
+    Returns face vertex counts, face vertex indices (original fbx vertex indices)
+    and face varying texture coordinates, in original polygon order.
+    """
+    triangle_polygons, triangle_prims, triangle_vertices, triangle_uvs = [], [], [], []
+    for gltf_prim_index, mesh_gltf_prim in enumerate(gltf_mesh_obj["primitives"]):
+        gltf_indices = mesh_gltf_prim["indices"].reshape(-1, 3)
+        assert len(mesh_gltf_prim["faceindices"]) == gltf_indices.shape[0]
+        triangle_polygons.append(mesh_gltf_prim["faceindices"].ravel())
+        triangle_prims.append(np.full(gltf_indices.shape[0], gltf_prim_index))
+        triangle_vertices.append(mesh_gltf_prim["attributes"]["ORIGINAL_INDICES"].ravel()[gltf_indices])
+        triangle_uvs.append(mesh_gltf_prim["attributes"]["TEXCOORD_0"][gltf_indices])
+    triangle_polygons = np.concatenate(triangle_polygons).astype(np.int64)
+    triangle_prims = np.concatenate(triangle_prims)
+    triangle_vertices = np.concatenate(triangle_vertices)
+    triangle_uvs = np.concatenate(triangle_uvs)
+
+    # Every polygon is made of one (triangle) or two (quad) triangles
+    triangles_per_polygon = np.bincount(triangle_polygons, minlength=faces_count)
+    assert np.all((1 <= triangles_per_polygon) & (triangles_per_polygon <= 2))
+    order = np.argsort(triangle_polygons, kind="stable")
+    first = np.searchsorted(triangle_polygons[order], np.arange(faces_count))
+    is_quad = triangles_per_polygon == 2
+    face_1 = order[first]
+    face_2 = face_1.copy()
+    face_2[is_quad] = order[first[is_quad] + 1]
+    assert np.all(triangle_prims[face_1] == triangle_prims[face_2])
+
+    quad_vertices = np.hstack([triangle_vertices[face_1[is_quad]], triangle_vertices[face_2[is_quad]]])
+    quad_vertices.sort(axis=1)
+    assert np.all(np.count_nonzero(np.diff(quad_vertices, axis=1), axis=1) == 3)
+
+    # The triangle whose second vertex closes the other one comes last
+    swap = is_quad & (triangle_vertices[face_1, 1] == triangle_vertices[face_2, 2])
+    face_1[swap], face_2[swap] = face_2[swap], face_1[swap]
 
-    root_prim = UsdGeom.Xform.Define(stage, '/root')
-    stage.SetDefaultPrim(root_prim.GetPrim())
+    face_vertex_counts = np.where(is_quad, 4, 3).astype(np.int32)
+    offsets = np.concatenate([[0], np.cumsum(face_vertex_counts)[:-1]])
+    corners = offsets[:, None] + np.arange(3)
+    face_vertex_indices = np.empty(int(face_vertex_counts.sum()), dtype=np.int32)
+    face_vertex_indices[corners] = triangle_vertices[face_1]
+    face_vertex_indices[offsets[is_quad] + 3] = triangle_vertices[face_2[is_quad], 2]
+    texcoord = np.empty((len(face_vertex_indices), 2), dtype=np.float32)
+    texcoord[corners] = triangle_uvs[face_1]
+    texcoord[offsets[is_quad] + 3] = triangle_uvs[face_2[is_quad], 2]
+    return face_vertex_counts, face_vertex_indices, texcoord
 
-    # Add transformation operations to the root prim
-    xform = UsdGeom.Xformable(root_prim)
-    translate_op = xform.AddTranslateOp(UsdGeom.XformOp.PrecisionFloat)
-    translate_op.Set(Gf.Vec3f(0, 0, 0))
-    rotate_op = xform.AddOrientOp(UsdGeom.XformOp.PrecisionFloat)
-    rotate_op.Set(Gf.Quatf(np.sqrt(2)/2, -np.sqrt(2)/2, 0.0, 0.0))
-    scale_op = xform.AddXformOp(UsdGeom.XformOp.TypeScale, UsdGeom.XformOp.PrecisionFloat)
-    scale_op.Set(Gf.Vec3f(100, 100, 100))
+def build_mesh_data(gltf_data, blendshape_epsilon=0.0):
+    """Computes every array written by write_usd, without touching USD."""
+    materials = gltf_data["materials"]
+    nodes_parent = gltf_data["nodes_parent"]
+    nodes = gltf_data["nodes"]
 
     # Find root node
     root_nodes = [node for i, node in enumerate(nodes) if nodes_parent[i] == i]
     assert len(root_nodes) == 1
     root_node = root_nodes.pop()
-    # Create prim for root node
-    stuffs_root_path = f'/root/{safe_usd_name(root_node["name"])}'
-    skel_root = UsdSkel.Root.Define(stage, stuffs_root_path)
-    xform = UsdGeom.Xformable(skel_root)
-    translate_op = xform.AddTranslateOp(UsdGeom.XformOp.PrecisionFloat)
-    translate_op.Set(Gf.Vec3f(0, 0, 0))
-    rotate_op = xform.AddOrientOp(UsdGeom.XformOp.PrecisionFloat)
-    rotate_op.Set(Gf.Quatf(1, 0, 0, 0))
-    scale_op = xform.AddScaleOp(UsdGeom.XformOp.PrecisionFloat)
-    scale_op.Set(Gf.Vec3f(1, 1, 1))
-    
-    # Create materials
-    UsdGeom.Scope.Define(stage, '/root/Looks')
-    usd_materials = []
-    for mat in materials:
-        mat_path = f'/root/Looks/{safe_usd_name(mat["name"])}'
-        usd_materials.append(UsdShade.Material.Define(stage, mat_path))
-
-    # Create mesh node
+
     mesh_nodes = [node for node in nodes if "mesh" in node]
     assert len(mesh_nodes) == 1
     mesh_node = mesh_nodes.pop()
-
-    # The mesh
-    mesh_prim_path = f'{stuffs_root_path}/{safe_usd_name(mesh_node["name"])}'
-    mesh_prim = UsdGeom.Mesh.Define(stage, mesh_prim_path)
-    UsdShade.MaterialBindingAPI.Apply(mesh_prim.GetPrim())
-    UsdShade.MaterialBindingAPI(mesh_prim).SetMaterialBindSubsetsFamilyType('nonOverlapping')
-    UsdSkel.BindingAPI.Apply(mesh_prim.GetPrim())
-
-    xform = UsdGeom.Xformable(mesh_prim)
-    translate_op = xform.AddTranslateOp(UsdGeom.XformOp.PrecisionFloat)
-    translate_op.Set(Gf.Vec3f(0, 0, 0))
-    rotate_op = xform.AddOrientOp(UsdGeom.XformOp.PrecisionFloat)
-    rotate_op.Set(Gf.Quatf(np.sqrt(2)/2, np.sqrt(2)/2, 0.0, 0.0))
-    scale_op = xform.AddScaleOp(UsdGeom.XformOp.PrecisionFloat)
-    scale_op.Set(Gf.Vec3f(1, 1, 1))
     gltf_mesh_obj = mesh_node["mesh"]
-
-    mesh_prim.CreateDoubleSidedAttr(True, False)
+    original_indices = [prim["attributes"]["ORIGINAL_INDICES"] for prim in gltf_mesh_obj["primitives"]]
 
     vertices_count = 0
     faces_count = 0
     for mesh_gltf_prim in gltf_mesh_obj["primitives"]:
         vertices_count = max(np.max(mesh_gltf_prim["attributes"]["ORIGINAL_INDICES"])+1, vertices_count)
         faces_count = max(np.max(mesh_gltf_prim["faceindices"])+1, faces_count)
-    
-    points_coord_convert = np.array([[1,0,0],[0,0,1],[0,-1,0]], dtype=float)
+
     points = np.einsum(
         "ni,ij->nj",
         _merge_prim_arraies(
             [prim["attributes"]["POSITION"] for prim in gltf_mesh_obj["primitives"]],
-            [prim["attributes"]["ORIGINAL_INDICES"] for prim in gltf_mesh_obj["primitives"]],
+            original_indices,
             vertices_count
         ),
-        points_coord_convert
+        POINTS_COORD_CONVERT
     )
-    mesh_prim.CreatePointsAttr(points, False)
-    
-    face_vertex_counts = []
-    face_vertex_indices = []
-    texcoord = []
-    triangle_collections = [[] for _ in range(faces_count)]
-    for gltf_prim_index, mesh_gltf_prim in enumerate(gltf_mesh_obj["primitives"]):
-        gltf_indices = mesh_gltf_prim["indices"]
-        gltf_indices = gltf_indices.reshape(-1, 3)
-
-        total_triangle_count = gltf_indices.shape[0]
-        assert len(mesh_gltf_prim["faceindices"]) == total_triangle_count
-
-        geom_subset_prim = UsdGeom.Subset.Define(stage, f'{mesh_prim_path}/{safe_usd_name(materials[mesh_gltf_prim["material"]]["name"])}')
-        geom_subset_prim.CreateElementTypeAttr("face", False)
-        geom_subset_prim.CreateIndicesAttr(mesh_gltf_prim["faceindices"].ravel().tolist(), False)
-        geom_subset_prim.CreateFamilyNameAttr("materialBind", False)
-        UsdShade.MaterialBindingAPI.Apply(geom_subset_prim.GetPrim())
-        mat_prim = usd_materials[mesh_gltf_prim["material"]]
-        UsdShade.MaterialBindingAPI(geom_subset_prim).Bind(mat_prim)
-
-        for i, polygon_index in enumerate(mesh_gltf_prim["faceindices"].ravel()):
-            triangle_collections[polygon_index].append({
-                "prim_index": gltf_prim_index,
-                "indices": gltf_indices[i].ravel().tolist(),
-            })
-    for triangle_collection in triangle_collections:
-        assert 1 <= len(triangle_collection) <= 2
-        if len(triangle_collection) == 1:
-            prim_index = triangle_collection[0]["prim_index"]
-            face_vertex_counts.append(3)
-            face_vertex_indices.extend(gltf_mesh_obj["primitives"][prim_index]["attributes"]["ORIGINAL_INDICES"][triangle_collection[0]["indices"]].ravel().tolist())
-            texcoord.extend(gltf_mesh_obj["primitives"][prim_index]["attributes"]["TEXCOORD_0"][triangle_collection[0]["indices"]].tolist())
-        elif len(triangle_collection) == 2:
-            prim_index = triangle_collection[0]["prim_index"]
-            assert prim_index == triangle_collection[1]["prim_index"]
-            face_vertex_counts.append(4)
-            face_1, face_2 = triangle_collection
-            face_1 = face_1["indices"]
-            face_2 = face_2["indices"]
-
-            face_1_ori = gltf_mesh_obj["primitives"][prim_index]["attributes"]["ORIGINAL_INDICES"][face_1].ravel().tolist()
-            face_2_ori = gltf_mesh_obj["primitives"][prim_index]["attributes"]["ORIGINAL_INDICES"][face_2].ravel().tolist()
-
-            assert len(set([*face_1_ori, *face_2_ori])) == 4
-            if face_1_ori[1] == face_2_ori[2]:
-                face_1, face_2 = face_2, face_1
-                face_1_ori, face_2_ori = face_2_ori, face_1_ori
-            face_vertex_indices.extend([*face_1_ori, face_2_ori[2]])
-
-            texcoord.extend(gltf_mesh_obj["primitives"][prim_index]["attributes"]["TEXCOORD_0"][[*face_1, face_2[2]]].tolist())
-
-    mesh_prim.CreateFaceVertexCountsAttr(face_vertex_counts, False)
-    mesh_prim.CreateFaceVertexIndicesAttr(face_vertex_indices, False)
-    UsdGeom.PrimvarsAPI(mesh_prim.GetPrim()).CreatePrimvar('st', Sdf.ValueTypeNames.TexCoord2fArray, "faceVarying", len(texcoord)).Set(texcoord)
+
+    face_vertex_counts, face_vertex_indices, texcoord = _rebuild_polygons(gltf_mesh_obj, faces_count)
+
+    # One subset per material, holding polygon indices
+    subsets = {}
+    for mesh_gltf_prim in gltf_mesh_obj["primitives"]:
+        subsets.setdefault(mesh_gltf_prim["material"], []).append(mesh_gltf_prim["faceindices"].ravel())
+    subsets = {
+        materials[material_index]["name"]: np.unique(np.concatenate(face_indices)).astype(np.int32)
+        for material_index, face_indices in subsets.items()
+    }
 
     # Blendshapes
+    blendshapes = []
     if "weights" in gltf_mesh_obj:
         bs_length_sets = set([
             len(gltf_mesh_obj["weights"]),
@@ -331,32 +527,23 @@ def gen_usd(gltf_data, out_file):
         assert len(bs_length_sets)== 1
         bs_length = bs_length_sets.pop()
 
-        bs_prims = []
         bs_names = [safe_usd_name(i) for i in gltf_mesh_obj["extras"]["targetNames"]]
-        UsdSkel.BindingAPI(mesh_prim).CreateBlendShapesAttr(bs_names)
-        UsdSkel.BindingAPI(mesh_prim).CreateBlendShapeTargetsRel()
-        bs_rel = []
         for i in range(bs_length):
             bs_points = _merge_prim_arraies(
                 [prim["targets"][i]["POSITION"] for prim in gltf_mesh_obj["primitives"]],
-                [prim["attributes"]["ORIGINAL_INDICES"] for prim in gltf_mesh_obj["primitives"]],
+                original_indices,
                 vertices_count
             )
-            bs_name = bs_names[i]
-            bs_prim = UsdSkel.BlendShape.Define(stage, f'{mesh_prim_path}/{bs_name}')
-            
-            non_zero_vecs = np.any(bs_points != 0, axis=1)
-            new_indices = np.where(non_zero_vecs)[0]
-            new_offsets = bs_points[non_zero_vecs]
-
-            bs_prim.CreateOffsetsAttr(new_offsets, False)
-            bs_prim.CreatePointIndicesAttr(new_indices, False)
-            bs_prims.append(bs_prim)
-            bs_rel.append(bs_prim.GetPath())
-        UsdSkel.BindingAPI(mesh_prim).GetBlendShapeTargetsRel().SetTargets(bs_rel)
-    
+            blendshapes.append({
+                "name": bs_names[i],
+                # Offsets live in the space of the points
+                "offsets": bs_points @ POINTS_COORD_CONVERT,
+            })
+        blendshapes = compress_blendshapes(blendshapes, blendshape_epsilon)
+
     # Skeleton
-    skin = None
+    skeleton = None
+    joints = []
     if "skin" in mesh_node:
         skin = mesh_node["skin"]
         root_joints = [
@@ -366,33 +553,16 @@ def gen_usd(gltf_data, out_file):
         assert len(root_joints) == 1
         root_joint = root_joints.pop()
         assert len(nodes[nodes_parent[root_joint]]["children"]) == 1
-        skel_prim_name = safe_usd_name(nodes[nodes_parent[root_joint]]["name"])
-        skel_prim = UsdSkel.Skeleton.Define(stage, f"{stuffs_root_path}/{skel_prim_name}")
-        UsdSkel.BindingAPI.Apply(skel_prim.GetPrim())
-        
-        bind_transforms = []
-        # rest_transforms = []
-        joint_names = []
-        for i, joint in enumerate(skin["joints"]):
-            path = _get_node_path(joint, root_joint, nodes, nodes_parent)
-            joint_names.append(path)
-            
-            bind_coord_convert = np.array([[1,0,0,0],[0,0,1,0],[0,-1,0,0],[0,0,0,1]], dtype=float)
-            bind_transform = np.linalg.inv(skin["inverseBindMatrices"][i])
-            bind_transforms.append(bind_transform)
-
-            # rest_coord_convert = np.array([[1,0,0,0],[0,1,0,0],[0,0,1,0],[0,0,0,1]], dtype=float)
-            # rest_transform = _get_transform_from_node(nodes[joint])
-            # rest_transforms.append(rest_transform)
-        skel_prim.CreateJointsAttr(joint_names, False)
-        skel_prim.CreateBindTransformsAttr(
-            np.einsum("nij,jk->nik", np.array(bind_transforms), bind_coord_convert),
-            False
-        )
-        # skel_prim.CreateRestTransformsAttr(
-        #     np.einsum("nij,jk->nik", np.array(bind_transforms), rest_coord_convert),
-        #     False
-        # )
+        joints = skin["joints"]
+
+        joint_names = [
+            _get_node_path(joint, root_joint, nodes, nodes_parent)
+            for joint in skin["joints"]
+        ]
+        rest_transforms = np.stack([_get_transform_from_node(nodes[joint]) for joint in joints])
+        root_slot = joints.index(root_joint)
+        rest_transforms[root_slot] = _root_parent_transform(root_joint, nodes, nodes_parent) @ rest_transforms[root_slot]
+        bind_transforms = np.linalg.inv(np.asarray(skin["inverseBindMatrices"], dtype=np.float64))
 
         prims_joints, prims_weights = [], []
         element_sizes = []
@@ -411,25 +581,531 @@ def gen_usd(gltf_data, out_file):
             prims_joints.append(prim_joints)
             prims_weights.append(prim_weights)
             element_sizes.append(element_size)
+        max_element_size = max(element_sizes)
         if len(set(element_sizes)) > 1:
-            max_element_size = max(element_sizes)
             for i in range(len(prims_joints)):
                 prims_joints[i] = np.pad(prims_joints[i], ((0,0), (0, max_element_size - element_sizes[i])))
                 prims_weights[i] = np.pad(prims_weights[i], ((0,0), (0, max_element_size - element_sizes[i])))
 
-        joints = _merge_prim_arraies(prims_joints, [prim["attributes"]["ORIGINAL_INDICES"] for prim in gltf_mesh_obj["primitives"]], vertices_count)
-        weights = _merge_prim_arraies(prims_weights, [prim["attributes"]["ORIGINAL_INDICES"] for prim in gltf_mesh_obj["primitives"]], vertices_count)
-        UsdSkel.BindingAPI(mesh_prim.GetPrim()).CreateJointIndicesPrimvar(False, element_size).Set(joints)
-        UsdSkel.BindingAPI(mesh_prim.GetPrim()).CreateJointWeightsPrimvar(False, element_size).Set(weights)
-        UsdSkel.BindingAPI(mesh_prim.GetPrim()).CreateSkeletonRel()
-        UsdSkel.BindingAPI(mesh_prim.GetPrim()).GetSkeletonRel().SetTargets([skel_prim.GetPath()])
+        skeleton = {
+            "name": safe_usd_name(nodes[nodes_parent[root_joint]]["name"]),
+            "joints": joint_names,
+            "bind_transforms": np.einsum("nij,jk->nik", bind_transforms, SKEL_COORD_CONVERT),
+            "rest_transforms": rest_transforms.transpose(0, 2, 1),
+            "joint_indices": _merge_prim_arraies(prims_joints, original_indices, vertices_count).astype(np.int32),
+            "joint_weights": _merge_prim_arraies(prims_weights, original_indices, vertices_count).astype(np.float32),
+            "element_size": max_element_size,
+        }
+
+    animations = build_animations(gltf_data, mesh_node, joints, [bs["name"] for bs in blendshapes])
+    if animations and skeleton is None:
+        # Blendshape weights are animated through a skeleton, one without joints will do
+        skeleton = {"name": "Skeleton", "joints": [], "bind_transforms": np.zeros((0, 4, 4)), "rest_transforms": np.zeros((0, 4, 4))}
+
+    return {
+        "root_name": safe_usd_name(root_node["name"]),
+        "mesh_name": safe_usd_name(mesh_node["name"]),
+        "materials": [safe_usd_name(mat["name"]) for mat in materials],
+        "points": points.astype(np.float32),
+        "face_vertex_counts": face_vertex_counts,
+        "face_vertex_indices": face_vertex_indices,
+        "texcoord": texcoord,
+        "subsets": {safe_usd_name(name): indices for name, indices in subsets.items()},
+        "blendshapes": blendshapes,
+        "skeleton": skeleton,
+        "animations": animations,
+    }
+
+def _translation_matrix(translation):
+    matrix = np.eye(4)
+    matrix[:3, 3] = translation
+    return matrix
+
+def _scaling_matrix(scale):
+    return np.diag([*scale, 1.0])
+
+def _euler_matrix(degrees, order="XYZ"):
+    matrix = np.eye(4)
+    for axis in order:
+        i = "XYZ".index(axis)
+        j, k = (i + 1) % 3, (i + 2) % 3
+        angle = np.radians(degrees[i])
+        rotation = np.eye(4)
+        rotation[j, j] = rotation[k, k] = np.cos(angle)
+        rotation[k, j], rotation[j, k] = np.sin(angle), -np.sin(angle)
+        matrix = rotation @ matrix
+    return matrix
+
+def _fbx_vector(properties, name, default):
+    return np.array(properties.get(name, default)[:3], dtype=np.float64)
+
+def _fbx_local_transform(properties):
+    """Local transform (column vector convention) of an FBX model as the FBX SDK evaluates it."""
+    rotation_order = "XYZ"
+    pre_rotation = post_rotation = np.eye(4)
+    # Pre/post rotations and the rotation order only apply with RotationActive
+    if properties.get("RotationActive", [0])[0]:
+        order = int(properties.get("RotationOrder", [0])[0])
+        if order >= len(FBX_ROTATION_ORDERS):
+            raise FbxFormatError("Spheric rotation order is not supported")
+        rotation_order = FBX_ROTATION_ORDERS[order]
+        pre_rotation = _euler_matrix(_fbx_vector(properties, "PreRotation", [0, 0, 0]))
+        post_rotation = _euler_matrix(_fbx_vector(properties, "PostRotation", [0, 0, 0]))
+    rotation_pivot = _translation_matrix(_fbx_vector(properties, "RotationPivot", [0, 0, 0]))
+    scaling_pivot = _translation_matrix(_fbx_vector(properties, "ScalingPivot", [0, 0, 0]))
+    return (
+        _translation_matrix(_fbx_vector(properties, "Lcl Translation", [0, 0, 0]))
+        @ _translation_matrix(_fbx_vector(properties, "RotationOffset", [0, 0, 0]))
+        @ rotation_pivot @ pre_rotation
+        @ _euler_matrix(_fbx_vector(properties, "Lcl Rotation", [0, 0, 0]), rotation_order)
+        @ np.linalg.inv(post_rotation) @ np.linalg.inv(rotation_pivot)
+        @ _translation_matrix(_fbx_vector(properties, "ScalingOffset", [0, 0, 0]))
+        @ scaling_pivot @ _scaling_matrix(_fbx_vector(properties, "Lcl Scaling", [1, 1, 1])) @ np.linalg.inv(scaling_pivot)
+    )
+
+def _fbx_scaled(matrices):
+    """Transforms in centimeters to meters, like FBX2glTF scales translations."""
+    matrices = np.array(matrices, dtype=np.float64)
+    matrices[..., :3, 3] *= FBX_SCALE
+    return matrices
+
+def _fbx_corner_values(element, name, components, face_vertex_indices):
+    """Face varying values of a LayerElement, e.g. the UVs."""
+    if element is None:
+        raise FbxFormatError(f"No {name} layer")
+    values = element.array(name).reshape(-1, components)
+    if element.value("ReferenceInformationType") in ("IndexToDirect", "Index"):
+        indices = element.array(f"{name}Index")
+        if len(indices) and (indices.min() < 0 or indices.max() >= len(values)):
+            raise FbxFormatError(f"{name} without a value")
+        values = values[indices]
+    mapping = element.value("MappingInformationType")
+    if mapping in ("ByVertice", "ByVertex", "ByControlPoint"):
+        values = values[face_vertex_indices]
+    elif mapping != "ByPolygonVertex":
+        raise FbxFormatError(f"{name} mapped {mapping} is not supported")
+    if len(values) != len(face_vertex_indices):
+        raise FbxFormatError(f"{name} count does not match the polygons")
+    return values
+
+def _fbx_skin_weights(clusters, vertices_count):
+    """Joint indices and weights per vertex, heaviest first and normalized, in whole sets of 4."""
+    vertex_ids, joint_ids, weights = [np.zeros(0, dtype=np.int64)], [np.zeros(0, dtype=np.int64)], [np.zeros(0)]
+    for slot, cluster in enumerate(clusters):
+        indexes = cluster.array("Indexes", np.zeros(0, dtype=np.int32))
+        vertex_ids.append(indexes.astype(np.int64))
+        joint_ids.append(np.full(len(indexes), slot))
+        weights.append(cluster.array("Weights", np.zeros(0)))
+    vertex_ids, joint_ids, weights = (np.concatenate(arrays) for arrays in (vertex_ids, joint_ids, weights))
+    if len(vertex_ids) != len(weights) or (len(vertex_ids) and vertex_ids.max() >= vertices_count):
+        raise FbxFormatError("Cluster indexes do not match the mesh")
+    used = weights > 0
+    vertex_ids, joint_ids, weights = vertex_ids[used], joint_ids[used], weights[used]
+    order = np.lexsort((-weights, vertex_ids))
+    vertex_ids, joint_ids, weights = vertex_ids[order], joint_ids[order], weights[order]
+    counts = np.bincount(vertex_ids, minlength=vertices_count)
+    element_size = max(4, -(-int(counts.max(initial=0)) // 4) * 4)
+    ranks = np.arange(len(vertex_ids)) - np.repeat(np.cumsum(counts) - counts, counts)
+    joint_indices = np.zeros((vertices_count, element_size), dtype=np.int32)
+    joint_weights = np.zeros((vertices_count, element_size))
+    joint_indices[vertex_ids, ranks] = joint_ids
+    joint_weights[vertex_ids, ranks] = weights
+    sums = joint_weights.sum(axis=1, keepdims=True)
+    np.divide(joint_weights, sums, out=joint_weights, where=sums > 0)
+    return joint_indices, joint_weights.astype(np.float32), element_size
+
+def build_fbx_mesh_data(fbx_root, blendshape_epsilon=0.0):
+    """build_mesh_data of the node tree of a binary fbx, as converted through FBX2glTF.
+
+    Only the subset ChatAvatar writes is supported, in centimeters and Y up: one mesh
+    with polygons, UVs and per polygon materials, blend shape channels with a single
+    target, skin clusters and bind poses. Files outside of it raise FbxFormatError.
+    """
+    scene = FbxScene(fbx_root)
+    settings = scene.settings()
+    if settings.get("UnitScaleFactor", [1.0])[0] != 1.0:
+        raise FbxFormatError("Only centimeters are read natively")
+    if any(int(settings.get(name, [value])[0]) != value for name, value in FBX_AXIS_SETTINGS.items()):
+        raise FbxFormatError("Only the Y up axis system is read natively")
+    for curve in scene.of_type("AnimationCurve"):
+        values = curve.array("KeyValueFloat", np.zeros(0))
+        if len(values) and values.min() != values.max():
+            raise FbxFormatError("Animations are converted through FBX2glTF")
+
+    mesh_models = scene.of_type("Model", "Mesh")
+    if len(mesh_models) != 1:
+        raise FbxFormatError(f"{len(mesh_models)} meshes, only files with one are read natively")
+    mesh_model = mesh_models[0]
+    geometries = scene.children(mesh_model, "Geometry", "Mesh")
+    if len(geometries) != 1:
+        raise FbxFormatError("Mesh without geometry")
+    geometry = geometries[0]
+    mesh_properties = scene.properties(mesh_model)
+    geometric_transform = (
+        _translation_matrix(_fbx_vector(mesh_properties, "GeometricTranslation", [0, 0, 0]))
+        @ _euler_matrix(_fbx_vector(mesh_properties, "GeometricRotation", [0, 0, 0]))
+        @ _scaling_matrix(_fbx_vector(mesh_properties, "GeometricScaling", [1, 1, 1]))
+    )
+
+    control_points = geometry.array("Vertices").reshape(-1, 3)
+    vertices_count = len(control_points)
+    points = (control_points @ geometric_transform[:3, :3].T + geometric_transform[:3, 3]) * FBX_SCALE @ POINTS_COORD_CONVERT
+
+    # The last vertex of every polygon is stored bitwise negated
+    polygon_vertex_index = geometry.array("PolygonVertexIndex")
+    polygon_ends = polygon_vertex_index < 0
+    if not len(polygon_ends) or not polygon_ends[-1]:
+        raise FbxFormatError("Unterminated polygon")
+    face_vertex_indices = np.where(polygon_ends, ~polygon_vertex_index, polygon_vertex_index).astype(np.int32)
+    if face_vertex_indices.max() >= vertices_count:
+        raise FbxFormatError("Polygon vertex out of range")
+    face_vertex_counts = np.diff(np.flatnonzero(polygon_ends), prepend=-1).astype(np.int32)
+    faces_count = len(face_vertex_counts)
+    texcoord = _fbx_corner_values(geometry.find("LayerElementUV"), "UV", 2, face_vertex_indices).astype(np.float32)
+
+    # One subset per material used, holding polygon indices
+    materials = scene.children(mesh_model, "Material")
+    material_layer = geometry.find("LayerElementMaterial")
+    if material_layer is None or not materials:
+        raise FbxFormatError("Mesh without materials")
+    polygon_materials = material_layer.array("Materials")
+    if material_layer.value("MappingInformationType") == "AllSame":
+        polygon_materials = np.full(faces_count, polygon_materials[0])
+    if len(polygon_materials) != faces_count or polygon_materials.min() < 0 or polygon_materials.max() >= len(materials):
+        raise FbxFormatError("Polygon materials do not match the mesh")
+    used_materials, first_polygons = np.unique(polygon_materials, return_index=True)
+    used_materials = used_materials[np.argsort(first_polygons)]
+    subsets = {
+        safe_usd_name(object_name(materials[material])): np.flatnonzero(polygon_materials == material).astype(np.int32)
+        for material in used_materials
+    }
+
+    # Blendshapes, offsets are stored for the indexed vertices only
+    blendshapes = []
+    for blend_shape in scene.children(geometry, "Deformer", "BlendShape"):
+        for channel in scene.children(blend_shape, "Deformer", "BlendShapeChannel"):
+            shapes = scene.children(channel, "Geometry", "Shape")
+            if len(shapes) != 1:
+                raise FbxFormatError("Only blend shape channels with a single target are read natively")
+            indexes = shapes[0].array("Indexes")
+            if len(indexes) and indexes.max() >= vertices_count:
+                raise FbxFormatError("Shape vertex out of range")
+            offsets = np.zeros_like(control_points)
+            offsets[indexes] = shapes[0].array("Vertices").reshape(-1, 3)
+            blendshapes.append({
+                "name": safe_usd_name(object_name(channel)),
+                "offsets": offsets @ geometric_transform[:3, :3].T * FBX_SCALE @ POINTS_COORD_CONVERT,
+            })
+    if blendshapes:
+        blendshapes = compress_blendshapes(blendshapes, blendshape_epsilon)
+
+    # Skeleton
+    skeleton = None
+    skins = scene.children(geometry, "Deformer", "Skin")
+    if len(skins) > 1:
+        raise FbxFormatError("Only meshes with one skin are read natively")
+    if skins:
+        models = {model.properties[0]: model for model in scene.of_type("Model")}
+        model_parents = {}
+        for model_id, model in models.items():
+            parents = scene.parents(model, "Model")
+            model_parents[model_id] = parents[0].properties[0] if parents else None
+        local_transforms = {
+            model_id: _fbx_scaled(_fbx_local_transform(scene.properties(model)))
+            for model_id, model in models.items()
+        }
+        def global_transform(model_id):
+            transform = np.eye(4)
+            while model_id is not None:
+                transform = local_transforms[model_id] @ transform
+                model_id = model_parents[model_id]
+            return transform
+
+        clusters = scene.children(skins[0], "Deformer", "Cluster")
+        joints = []
+        for cluster in clusters:
+            links = scene.children(cluster, "Model")
+            if len(links) != 1:
+                raise FbxFormatError("Cluster without a joint")
+            joints.append(links[0].properties[0])
+        root_joints = [joint for joint in joints if model_parents[joint] not in joints]
+        if len(root_joints) != 1:
+            raise FbxFormatError("Only skeletons with one root joint are read natively")
+        root_joint = root_joints.pop()
+        skeleton_parent = model_parents[root_joint]
+        if sum(parent == skeleton_parent for parent in model_parents.values()) != 1:
+            raise FbxFormatError("The root joint has to be the only child of its parent")
+
+        def joint_name(joint):
+            path = [object_name(models[joint])]
+            while joint != root_joint:
+                joint = model_parents[joint]
+                path.append(object_name(models[joint]))
+            return "/".join(reversed(path))
+
+        # Cluster matrices are global transforms at bind time, taken from the bind pose when missing
+        bind_pose = {}
+        for pose in scene.of_type("Pose", "BindPose"):
+            for pose_node in pose.find_all("PoseNode"):
+                bind_pose[pose_node.value("Node")] = pose_node.array("Matrix").reshape(4, 4).T
+        def cluster_matrix(cluster, name, model_id):
+            matrix = cluster.find(name)
+            if matrix is not None:
+                return cluster.array(name).reshape(4, 4).T
+            if model_id not in bind_pose:
+                raise FbxFormatError(f"Cluster without {name} or bind pose")
+            return bind_pose[model_id]
+        inverse_bind_transforms = _fbx_scaled(np.stack([
+            np.linalg.inv(cluster_matrix(cluster, "TransformLink", joint))
+            @ cluster_matrix(cluster, "Transform", mesh_model.properties[0])
+            @ geometric_transform
+            for cluster, joint in zip(clusters, joints)
+        ]))
+
+        rest_transforms = np.stack([local_transforms[joint] for joint in joints])
+        root_slot = joints.index(root_joint)
+        parent_transform = global_transform(skeleton_parent)
+        rest_transforms[root_slot] = SKEL_COORD_CONVERT.T @ parent_transform @ rest_transforms[root_slot]
+        joint_indices, joint_weights, element_size = _fbx_skin_weights(clusters, vertices_count)
+        skeleton = {
+            "name": safe_usd_name(object_name(models[skeleton_parent])) if skeleton_parent is not None else FBX_ROOT_NAME,
+            "joints": [joint_name(joint) for joint in joints],
+            "bind_transforms": np.linalg.inv(inverse_bind_transforms).transpose(0, 2, 1) @ SKEL_COORD_CONVERT,
+            "rest_transforms": rest_transforms.transpose(0, 2, 1),
+            "joint_indices": joint_indices,
+            "joint_weights": joint_weights,
+            "element_size": element_size,
+        }
+
+    return {
+        "root_name": FBX_ROOT_NAME,
+        "mesh_name": safe_usd_name(object_name(mesh_model)),
+        "materials": list(subsets),
+        "points": points.astype(np.float32),
+        "face_vertex_counts": face_vertex_counts,
+        "face_vertex_indices": face_vertex_indices,
+        "texcoord": texcoord,
+        "subsets": subsets,
+        "blendshapes": blendshapes,
+        "skeleton": skeleton,
+        "animations": [],
+    }
+
+def write_usd(mesh_data, out_file):
+    """Author the whole layer through Sdf inside a single change block."""
+    layer = usd_authoring.create_layer(out_file)
+    T = Sdf.ValueTypeNames
+    with Sdf.ChangeBlock():
+        usd_authoring.set_stage_metadata(layer, default_prim="root", meters_per_unit=0.01, up_axis="Y")
+
+        root_prim = usd_authoring.define_prim(layer, "/root", "Xform")
+        usd_authoring.set_xform_ops(
+            root_prim,
+            Gf.Vec3f(0, 0, 0),
+            Gf.Quatf(np.sqrt(2)/2, -np.sqrt(2)/2, 0.0, 0.0),
+            Gf.Vec3f(100, 100, 100),
+        )
+
+        # Prim for root node
+        stuffs_root_path = Sdf.Path(f'/root/{mesh_data["root_name"]}')
+        skel_root = usd_authoring.define_prim(layer, stuffs_root_path, "SkelRoot")
+        usd_authoring.set_xform_ops(skel_root, Gf.Vec3f(0, 0, 0), Gf.Quatf(1, 0, 0, 0), Gf.Vec3f(1, 1, 1))
+
+        # Materials
+        usd_authoring.define_prim(layer, "/root/Looks", "Scope")
+        for material_name in mesh_data["materials"]:
+            usd_authoring.define_prim(layer, f"/root/Looks/{material_name}", "Material")
+
+        # The mesh
+        mesh_prim_path = stuffs_root_path.AppendChild(mesh_data["mesh_name"])
+        mesh_prim = usd_authoring.define_prim(layer, mesh_prim_path, "Mesh")
+        usd_authoring.apply_api_schemas(mesh_prim, ["MaterialBindingAPI", "SkelBindingAPI"])
+        usd_authoring.set_attribute(mesh_prim, "subsetFamily:materialBind:familyType", T.Token, "nonOverlapping", uniform=True)
+        usd_authoring.set_xform_ops(
+            mesh_prim,
+            Gf.Vec3f(0, 0, 0),
+            Gf.Quatf(np.sqrt(2)/2, np.sqrt(2)/2, 0.0, 0.0),
+            Gf.Vec3f(1, 1, 1),
+        )
+        usd_authoring.set_attribute(mesh_prim, "doubleSided", T.Bool, True, uniform=True)
+        usd_authoring.set_attribute(mesh_prim, "points", T.Point3fArray, Vt.Vec3fArray.FromNumpy(mesh_data["points"]))
+        usd_authoring.set_attribute(mesh_prim, "faceVertexCounts", T.IntArray, Vt.IntArray.FromNumpy(mesh_data["face_vertex_counts"]))
+        usd_authoring.set_attribute(mesh_prim, "faceVertexIndices", T.IntArray, Vt.IntArray.FromNumpy(mesh_data["face_vertex_indices"]))
+        usd_authoring.set_attribute(
+            mesh_prim, "primvars:st", T.TexCoord2fArray, Vt.Vec2fArray.FromNumpy(mesh_data["texcoord"]),
+            interpolation="faceVarying",
+        )
+
+        for material_name, face_indices in mesh_data["subsets"].items():
+            geom_subset_prim = usd_authoring.define_prim(layer, mesh_prim_path.AppendChild(material_name), "GeomSubset")
+            usd_authoring.apply_api_schemas(geom_subset_prim, ["MaterialBindingAPI"])
+            usd_authoring.set_attribute(geom_subset_prim, "elementType", T.Token, "face", uniform=True)
+            usd_authoring.set_attribute(geom_subset_prim, "familyName", T.Token, "materialBind", uniform=True)
+            usd_authoring.set_attribute(geom_subset_prim, "indices", T.IntArray, Vt.IntArray.FromNumpy(face_indices))
+            usd_authoring.set_relationship(geom_subset_prim, "material:binding", [f"/root/Looks/{material_name}"])
+
+        # Blendshapes
+        if mesh_data["blendshapes"]:
+            bs_names = [bs["name"] for bs in mesh_data["blendshapes"]]
+            usd_authoring.set_attribute(mesh_prim, "skel:blendShapes", T.TokenArray, Vt.TokenArray(bs_names), uniform=True)
+            for bs in mesh_data["blendshapes"]:
+                bs_prim = usd_authoring.define_prim(layer, mesh_prim_path.AppendChild(bs["name"]), "BlendShape")
+                usd_authoring.set_custom_data(bs_prim, "droppedOffsets", bs["dropped"])
+                usd_authoring.set_custom_data(bs_prim, "maxOffsetError", bs["error"])
+                if bs["duplicate_of"] is not None:
+                    # Each target needs a prim of its own, the data is shared
+                    usd_authoring.add_reference(bs_prim, "", mesh_prim_path.AppendChild(bs["duplicate_of"]))
+                    continue
+                usd_authoring.set_attribute(bs_prim, "offsets", T.Vector3fArray, Vt.Vec3fArray.FromNumpy(bs["offsets"]), uniform=True)
+                usd_authoring.set_attribute(bs_prim, "pointIndices", T.IntArray, Vt.IntArray.FromNumpy(bs["point_indices"]), uniform=True)
+            usd_authoring.set_relationship(
+                mesh_prim, "skel:blendShapeTargets", [mesh_prim_path.AppendChild(name) for name in bs_names]
+            )
+
+        # Skeleton
+        skeleton = mesh_data["skeleton"]
+        if skeleton is not None:
+            skel_prim_path = stuffs_root_path.AppendChild(skeleton["name"])
+            skel_prim = usd_authoring.define_prim(layer, skel_prim_path, "Skeleton")
+            usd_authoring.apply_api_schemas(skel_prim, ["SkelBindingAPI"])
+            # Placed like the mesh, skinned points are in skeleton space
+            usd_authoring.set_xform_ops(
+                skel_prim,
+                Gf.Vec3f(0, 0, 0),
+                Gf.Quatf(np.sqrt(2)/2, np.sqrt(2)/2, 0.0, 0.0),
+                Gf.Vec3f(1, 1, 1),
+            )
+            usd_authoring.set_attribute(skel_prim, "joints", T.TokenArray, Vt.TokenArray(skeleton["joints"]), uniform=True)
+            usd_authoring.set_attribute(
+                skel_prim, "bindTransforms", T.Matrix4dArray,
+                Vt.Matrix4dArray.FromNumpy(np.ascontiguousarray(skeleton["bind_transforms"])), uniform=True,
+            )
+            usd_authoring.set_attribute(
+                skel_prim, "restTransforms", T.Matrix4dArray,
+                Vt.Matrix4dArray.FromNumpy(np.ascontiguousarray(skeleton["rest_transforms"])), uniform=True,
+            )
+            usd_authoring.set_relationship(mesh_prim, "skel:skeleton", [skel_prim_path])
+        if skeleton is not None and skeleton["joints"]:
+            usd_authoring.set_attribute(
+                mesh_prim, "primvars:skel:jointIndices", T.IntArray,
+                Vt.IntArray.FromNumpy(skeleton["joint_indices"].ravel()),
+                interpolation="vertex", elementSize=skeleton["element_size"],
+            )
+            usd_authoring.set_attribute(
+                mesh_prim, "primvars:skel:jointWeights", T.FloatArray,
+                Vt.FloatArray.FromNumpy(skeleton["joint_weights"].ravel()),
+                interpolation="vertex", elementSize=skeleton["element_size"],
+            )
+
+        # Animations, the first one is bound
+        animations = mesh_data["animations"]
+        if animations:
+            animations_path = stuffs_root_path.AppendChild("Animations")
+            usd_authoring.define_prim(layer, animations_path, "Scope")
+            bs_names = [bs["name"] for bs in mesh_data["blendshapes"]]
+            # One frame per time code
+            frames_per_second = animations[0]["frames_per_second"]
+            for animation in animations:
+                anim_prim = usd_authoring.define_prim(layer, animations_path.AppendChild(animation["name"]), "SkelAnimation")
+                time_codes = animation["times"] * frames_per_second
+                if skeleton["joints"]:
+                    usd_authoring.set_attribute(anim_prim, "joints", T.TokenArray, Vt.TokenArray(skeleton["joints"]), uniform=True)
+                    usd_authoring.set_time_samples(anim_prim, "translations", T.Float3Array, time_codes, animation["translations"])
+                    usd_authoring.set_time_samples(anim_prim, "rotations", T.QuatfArray, time_codes, animation["rotations"])
+                    usd_authoring.set_time_samples(anim_prim, "scales", T.Half3Array, time_codes, animation["scales"])
+                if bs_names:
+                    usd_authoring.set_attribute(anim_prim, "blendShapes", T.TokenArray, Vt.TokenArray(bs_names), uniform=True)
+                    usd_authoring.set_time_samples(anim_prim, "blendShapeWeights", T.FloatArray, time_codes, animation["blendshape_weights"])
+            usd_authoring.set_relationship(skel_prim, "skel:animationSource", [animations_path.AppendChild(animations[0]["name"])])
+            usd_authoring.set_stage_metadata(
+                layer,
+                time_codes_per_second=frames_per_second,
+                time_code_range=(animations[0]["times"][0] * frames_per_second, animations[0]["times"][-1] * frames_per_second),
+            )
+
+    # Save the layer to file
+    layer.Save()
+
+def gen_usd(gltf_data, out_file, blendshape_epsilon=0.0):
+    """Returns a summary of the blendshape compression, see compress_blendshapes for blendshape_epsilon."""
+    mesh_data = build_mesh_data(gltf_data, blendshape_epsilon)
+    write_usd(mesh_data, out_file)
+    return blendshape_summary(mesh_data["blendshapes"])
+
+def gltf2usd(in_file, out_file, blendshape_epsilon=0.0):
+    return gen_usd(read_gltf(in_file), out_file, blendshape_epsilon)
+
+def read_fbx_mesh_data(in_file, blendshape_epsilon=0.0):
+    """build_fbx_mesh_data of a fbx file, anything it cannot interpret raises FbxFormatError."""
+    try:
+        return build_fbx_mesh_data(read_fbx(in_file), blendshape_epsilon)
+    except FbxFormatError:
+        raise
+    except (ArithmeticError, LookupError, TypeError, ValueError, struct.error, zlib.error) as e:
+        # Arrays whose lengths do not fit the scene fail in reshape or indexing
+        raise FbxFormatError(f"Unexpected scene: {e!r}") from e
+
+def fbx2usd(in_file, out_file, blendshape_epsilon=0.0):
+    """Convert without FBX2glTF, raises FbxFormatError for files it has to convert."""
+    mesh_data = read_fbx_mesh_data(in_file, blendshape_epsilon)
+    write_usd(mesh_data, out_file)
+    return blendshape_summary(mesh_data["blendshapes"])
+
+def _dense_offsets(blendshape, points_count):
+    offsets = np.zeros((points_count, 3), dtype=np.float32)
+    offsets[blendshape["point_indices"]] = blendshape["offsets"]
+    return offsets
+
+def _dense_weights(skeleton, points_count):
+    # Per point weight of each joint by name, converters may order influences differently
+    weights = {}
+    joint_indices = skeleton["joint_indices"].reshape(points_count, -1)
+    joint_weights = skeleton["joint_weights"].reshape(points_count, -1)
+    for joint_index, joint in enumerate(skeleton["joints"]):
+        weights[joint] = np.where(joint_indices == joint_index, joint_weights, 0.0).sum(axis=1)
+    return weights
 
-    # Save the stage to file
-    stage.GetRootLayer().Save()
+def compare_mesh_data(expected, actual, atol=1e-5):
+    """Where actual differs from expected: points, polygons, skin weights and blendshape offsets."""
+    mismatches = []
+    for name in ("points", "texcoord"):
+        if expected[name].shape != actual[name].shape or not np.allclose(expected[name], actual[name], atol=atol):
+            mismatches.append(name)
+    for name in ("face_vertex_counts", "face_vertex_indices"):
+        if not np.array_equal(expected[name], actual[name]):
+            mismatches.append(name)
+    if mismatches:
+        # Offsets and weights are per point, nothing more to compare
+        return mismatches
+    points_count = len(expected["points"])
+    expected_blendshapes = {bs["name"]: bs for bs in expected["blendshapes"]}
+    actual_blendshapes = {bs["name"]: bs for bs in actual["blendshapes"]}
+    if list(expected_blendshapes) != list(actual_blendshapes):
+        mismatches.append("blendshape names")
+    for name in expected_blendshapes.keys() & actual_blendshapes.keys():
+        if not np.allclose(
+            _dense_offsets(expected_blendshapes[name], points_count),
+            _dense_offsets(actual_blendshapes[name], points_count), atol=atol,
+        ):
+            mismatches.append(f"blendshape {name} offsets")
+    expected_skeleton, actual_skeleton = expected["skeleton"], actual["skeleton"]
+    if ("joint_weights" in (expected_skeleton or {})) != ("joint_weights" in (actual_skeleton or {})):
+        mismatches.append("skin")
+    elif expected_skeleton and "joint_weights" in expected_skeleton:
+        expected_weights = _dense_weights(expected_skeleton, points_count)
+        actual_weights = _dense_weights(actual_skeleton, points_count)
+        if set(expected_weights) != set(actual_weights):
+            mismatches.append("joint names")
+        for joint in expected_weights.keys() & actual_weights.keys():
+            if not np.allclose(expected_weights[joint], actual_weights[joint], atol=atol):
+                mismatches.append(f"{joint} weights")
+    return mismatches
 
-def gltf2usd(in_file, out_file):
-    gen_usd(read_gltf(in_file), out_file)
+def native_fbx_mismatches(fbx_file, gltf_file):
+    """compare_mesh_data of the native reader against FBX2glTF's output of the same fbx."""
+    return compare_mesh_data(build_mesh_data(read_gltf(gltf_file)), read_fbx_mesh_data(fbx_file))
 
+@functools.lru_cache(maxsize=None)
 def find_fbx2gltf_bin():
     binary_lookup = {
         "win32": os.path.join(os.path.dirname(__file__), "binaries", "win32", "FBX2glTF.exe"),
@@ -438,16 +1114,34 @@ def find_fbx2gltf_bin():
     if sys.platform not in binary_lookup:
         raise OSError("Unsupported platform!")
     binary_path = binary_lookup[sys.platform]
-    if sys.platform == "linux":
-        os.chmod(binary_path, "0755")
+    if sys.platform == "linux" and not os.access(binary_path, os.X_OK):
+        os.chmod(binary_path, 0o755)
     return binary_path
 
 
-def fbx2gltf(in_file, out_file, bin_path=find_fbx2gltf_bin()):
-    args = "-v --long-indices always --no-flip-u --no-flip-v --skinning-weights 512 --blend-shape-no-sparse -e".split()
-    subprocess.run([
+def fbx2gltf(in_file, out_file, bin_path=None, cancel_event=None):
+    if bin_path is None:
+        bin_path = find_fbx2gltf_bin()
+    args = "-v --long-indices always --no-flip-u --no-flip-v --skinning-weights 512 --blend-shape-no-sparse".split()
+    # glb keeps the buffers binary, gltf embeds them as base64
+    args.append("-b" if out_file.endswith(".glb") else "-e")
+    process = subprocess.Popen([
         os.path.abspath(bin_path), *args, "-i", in_file, "-o", out_file
     ])
+    # Poll so a cancelled conversion does not keep the converter running
+    while True:
+        try:
+            returncode = process.wait(timeout=0.1)
+        except subprocess.TimeoutExpired:
+            if cancel_event is not None and cancel_event.is_set():
+                process.kill()
+                process.wait()
+                return
+        else:
+            # A failed conversion may leave a missing or truncated output behind
+            if returncode != 0:
+                raise subprocess.CalledProcessError(returncode, process.args)
+            return
 
 if __name__ == "__main__":
     fbx_path = r"C:\Users\ericc\Desktop\ChatAvatarPlugins\ChatAvatarPacks\ChatAvatar_Test_Package\USCBasicPack\additional_body.fbx"
@@ -0,0 +1,379 @@
+# Garbage collection of what imports leave on disk. Import directories in
+# Omni_Directory, conversion cache files and the pack extractions they sit in are
+# never removed otherwise. They are removed least recently referenced first, once
+# not referenced for a maximum age or while all of them together exceed a quota.
+# Anything the open stage uses is kept, and so is a pack extraction that is the
+# only copy of the pack or still has imports.
+#
+# The last time each import was referenced (imported, stage opened or closed with
+# it) is kept in a registry file. Runs in Kit through /imports/gc, or with this
+# script, which asks Kit or, with --offline, collects itself while Kit is not running.
+
+from __future__ import annotations
+import os
+import re
+import sys
+import json
+import time
+import shutil
+import argparse
+import threading
+import urllib.request
+from dataclasses import dataclass, field
+from typing import Dict, Iterable, List, Optional, Set
+
+try:
+    from . import import_manifest
+    from .ChatAvatarPack.pack import Pack
+except ImportError:
+    # Run as a script, like ui_launcher
+    import import_manifest
+    from ChatAvatarPack.pack import Pack
+
+# Set by the extension from its settings, nothing is recorded when empty
+REGISTRY_PATH = ""
+REGISTRY_VERSION = 1
+# Defaults of a collection, set by the extension from its settings. 0 disables either policy.
+MAX_AGE_DAYS = 0.0
+MAX_TOTAL_GB = 0.0
+# Directories of pack zips whose extractions are collected too, besides those of recorded imports
+ROOTS: List[str] = []
+# Nothing referenced more recently is collected, e.g. an import being written or a pack just opened
+MIN_AGE_S = 3600
+OMNI_DIRECTORY_NAME = "Omni_Directory"
+# Shared by the imports of a pack directory
+TEXTURE_DIRECTORY_NAME = "Textures"
+CACHE_DIRECTORY_NAME = "Cache"
+# Where safe_extractall extracts a pack when its directory conflicts with the zip
+CONFLICT_FOLDER = re.compile(r"^[a-z]{8,}$")
+PACK_FOLDERS = frozenset(path.split("/")[0] for paths in Pack.pack_paths.values() for path in paths.values())
+# Ties are broken so what a unit depends on comes after it
+KIND_ORDER = {"import": 0, "cache": 1, "extraction": 2}
+DEFAULT_URL = "http://localhost:8011/chatavatar"
+
+_registry_lock = threading.Lock()
+
+def read_registry(path: str) -> Dict[str, dict]:
+    """Recorded imports by directory, {"last_referenced": epoch seconds, "source_zip": path or None}."""
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            registry = json.load(f)
+    except (OSError, ValueError):
+        return {}
+    if registry.get("version") != REGISTRY_VERSION:
+        return {}
+    return registry["imports"]
+
+def write_registry(path: str, imports: Dict[str, dict]):
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    with open(f"{path}.partial", "w", encoding="utf-8") as f:
+        json.dump({"version": REGISTRY_VERSION, "imports": imports}, f, indent=1)
+    os.replace(f"{path}.partial", path)
+
+def touch(import_dirs: Iterable[str], source_zip: Optional[str] = None, registry_path: Optional[str] = None):
+    """Record import directories as referenced now."""
+    registry_path = registry_path or REGISTRY_PATH
+    import_dirs = [os.path.abspath(import_dir) for import_dir in import_dirs]
+    if not registry_path or not import_dirs:
+        return
+    with _registry_lock:
+        imports = read_registry(registry_path)
+        now = time.time()
+        for import_dir in import_dirs:
+            record = imports.setdefault(import_dir, {"source_zip": None})
+            record["last_referenced"] = now
+            if source_zip is not None:
+                record["source_zip"] = os.path.abspath(source_zip)
+        write_registry(registry_path, imports)
+
+@dataclass(eq=False)
+class _Unit:
+    """What is removed at once: an import directory, a cache file or a pack extraction."""
+    path: str
+    kind: str
+    size: int
+    last_referenced: float
+    # Units inside of this one or using it, it is only removed after all of them
+    dependents: List["_Unit"] = field(default_factory=list)
+    # Why it is kept whatever the policy says
+    kept_because: Optional[str] = None
+    removed: bool = False
+
+    def effective_last_referenced(self) -> float:
+        return max([self.last_referenced] + [unit.effective_last_referenced() for unit in self.dependents])
+
+    def report(self, reason: str) -> dict:
+        return {
+            "path": self.path,
+            "kind": self.kind,
+            "size": self.size,
+            "last_referenced": self.effective_last_referenced(),
+            "reason": reason,
+        }
+
+def _mtime(path: str) -> float:
+    try:
+        return os.stat(path).st_mtime
+    except OSError:
+        return 0.0
+
+def _tree_size(path: str, excluded: Set[str] = frozenset()) -> int:
+    size = 0
+    for directory, dirnames, filenames in os.walk(path):
+        dirnames[:] = [name for name in dirnames if os.path.join(directory, name) not in excluded]
+        for name in filenames:
+            file_path = os.path.join(directory, name)
+            if file_path in excluded:
+                continue
+            try:
+                size += os.lstat(file_path).st_size
+            except OSError:
+                pass
+    return size
+
+def _is_extraction(path: str) -> bool:
+    return any(os.path.isdir(os.path.join(path, folder)) for folder in PACK_FOLDERS)
+
+def _subdirectories(path: str) -> List[os.DirEntry]:
+    try:
+        with os.scandir(path) as entries:
+            return [entry for entry in entries if entry.is_dir(follow_symlinks=False)]
+    except OSError:
+        return []
+
+def _is_conflict_folder(path: str) -> bool:
+    return bool(CONFLICT_FOLDER.match(os.path.basename(path))) and _is_extraction(os.path.dirname(path))
+
+def pack_directories(registry: Dict[str, dict], roots: Iterable[str]) -> Set[str]:
+    """Pack extractions of recorded imports and next to the zips in roots."""
+    directories = set()
+    for import_dir in registry:
+        directory = os.path.dirname(os.path.dirname(import_dir))
+        # Conflict folders are collected with the extraction they are in
+        directories.add(os.path.dirname(directory) if _is_conflict_folder(directory) else directory)
+    for root in roots:
+        for entry in _subdirectories(root):
+            if os.path.isdir(os.path.join(entry.path, OMNI_DIRECTORY_NAME)) or \
+                (os.path.isfile(f"{entry.path}.zip") and _is_extraction(entry.path)):
+                directories.add(os.path.abspath(entry.path))
+    return {directory for directory in directories if os.path.isdir(directory)}
+
+def _extraction_units(pack_directory: str, registry: Dict[str, dict], zips: List[str], units: List[_Unit]) -> _Unit:
+    """Add the units of a pack extraction to units, returns the one of the extraction itself."""
+    excluded = set()
+    dependents = []
+    import_units = []
+    # Imports without a readable manifest may use any cache file
+    unknown_imports = []
+    omni_directory = os.path.join(pack_directory, OMNI_DIRECTORY_NAME)
+    for entry in _subdirectories(omni_directory):
+        if entry.name in (TEXTURE_DIRECTORY_NAME, CACHE_DIRECTORY_NAME):
+            continue
+        record = registry.get(entry.path)
+        if record is not None and record.get("source_zip"):
+            zips.append(record["source_zip"])
+        unit = _Unit(
+            entry.path,
+            "import",
+            _tree_size(entry.path),
+            record["last_referenced"] if record is not None else _mtime(entry.path),
+        )
+        manifest = import_manifest.read_manifest(entry.path)
+        import_units.append((unit, manifest))
+        if manifest is None:
+            unknown_imports.append(unit)
+        excluded.add(entry.path)
+        dependents.append(unit)
+        units.append(unit)
+
+    cache_directory = os.path.join(omni_directory, CACHE_DIRECTORY_NAME)
+    cache_units = {}
+    try:
+        with os.scandir(cache_directory) as entries:
+            for entry in entries:
+                if entry.is_file(follow_symlinks=False):
+                    stat = entry.stat(follow_symlinks=False)
+                    cache_units[os.path.normcase(entry.path)] = _Unit(entry.path, "cache", stat.st_size, stat.st_mtime, list(unknown_imports))
+    except OSError:
+        pass
+    for unit, manifest in import_units:
+        cache_unit = cache_units.get(os.path.normcase(os.path.abspath(manifest["model_path"]))) if manifest else None
+        if cache_unit is not None:
+            cache_unit.dependents.append(unit)
+    for cache_unit in cache_units.values():
+        excluded.add(cache_unit.path)
+        dependents.append(cache_unit)
+        units.append(cache_unit)
+
+    if not _is_conflict_folder(pack_directory):
+        for entry in _subdirectories(pack_directory):
+            if CONFLICT_FOLDER.match(entry.name) and _is_extraction(entry.path):
+                # Extracted from the same zip
+                dependents.append(_extraction_units(entry.path, registry, zips, units))
+                excluded.add(entry.path)
+
+    unit = _Unit(
+        pack_directory,
+        "extraction",
+        _tree_size(pack_directory, excluded),
+        max([_mtime(pack_directory)] + [_mtime(entry.path) for entry in _subdirectories(pack_directory)]),
+        dependents,
+    )
+    zip_directory = os.path.dirname(pack_directory) if _is_conflict_folder(pack_directory) else pack_directory
+    if not any(os.path.isfile(path) for path in [f"{zip_directory}.zip"] + zips):
+        unit.kept_because = "only copy of the pack"
+    units.append(unit)
+    return unit
+
+def _remove(unit: _Unit):
+    if unit.kind == "cache":
+        os.remove(unit.path)
+        return
+    if unit.kind == "import":
+        # A half removed import must not be taken for the latest import of its pack
+        try:
+            os.remove(import_manifest.manifest_path(unit.path))
+        except FileNotFoundError:
+            pass
+    shutil.rmtree(unit.path)
+
+def collect(
+    roots: Iterable[str] = (),
+    max_age_days: float = 0.0,
+    max_total_gb: float = 0.0,
+    in_use: Iterable[str] = (),
+    dry_run: bool = False,
+    registry_path: Optional[str] = None,
+) -> dict:
+    """Remove what the policy evicts, returns a report of it.
+
+    in_use: paths the open stages use, units holding any of them are kept.
+    """
+    registry_path = registry_path or REGISTRY_PATH
+    registry = read_registry(registry_path) if registry_path else {}
+    now = time.time()
+    units: List[_Unit] = []
+    for pack_directory in sorted(pack_directories(registry, roots)):
+        _extraction_units(pack_directory, registry, [], units)
+
+    in_use_directories = set()
+    for path in in_use:
+        path = os.path.normcase(os.path.abspath(path))
+        while path not in in_use_directories:
+            in_use_directories.add(path)
+            path = os.path.dirname(path)
+    for unit in units:
+        if os.path.normcase(unit.path) in in_use_directories:
+            unit.kept_because = "in use"
+        elif unit.kept_because is None and now - unit.effective_last_referenced() < MIN_AGE_S:
+            unit.kept_because = "recent"
+
+    total_bytes = sum(unit.size for unit in units)
+    remaining_bytes = total_bytes
+    max_age_s = max_age_days * 86400
+    max_total_bytes = max_total_gb * (1 << 30)
+    removed, kept, errors = [], [], []
+    for unit in sorted(units, key=lambda unit: (unit.effective_last_referenced(), KIND_ORDER[unit.kind])):
+        if unit.kept_because is not None:
+            kept.append(unit.report(unit.kept_because))
+            continue
+        if not all(dependent.removed for dependent in unit.dependents):
+            continue
+        if max_age_s and now - unit.effective_last_referenced() > max_age_s:
+            reason = "age"
+        elif max_total_bytes and remaining_bytes > max_total_bytes:
+            reason = "quota"
+        else:
+            continue
+        if not dry_run:
+            try:
+                _remove(unit)
+            except OSError as e:
+                errors.append({"path": unit.path, "error": f"{type(e).__name__}: {e}"})
+                continue
+        unit.removed = True
+        remaining_bytes -= unit.size
+        removed.append(unit.report(reason))
+
+    if registry_path and not dry_run:
+        with _registry_lock:
+            imports = read_registry(registry_path)
+            for import_dir in list(imports):
+                if not os.path.isdir(import_dir):
+                    del imports[import_dir]
+            write_registry(registry_path, imports)
+    return {
+        "dry_run": dry_run,
+        "total_bytes": total_bytes,
+        "freed_bytes": total_bytes - remaining_bytes,
+        "removed": removed,
+        "kept": kept,
+        "errors": errors,
+    }
+
+def _format_size(size: int) -> str:
+    for unit in ["B", "KB", "MB", "GB"]:
+        if size < 1024 or unit == "GB":
+            return f"{size:.0f} {unit}" if unit == "B" else f"{size:.1f} {unit}"
+        size /= 1024
+
+def format_report(report: dict) -> str:
+    now = time.time()
+    lines = []
+    action = "would remove" if report["dry_run"] else "removed"
+    for status, entries in [(action, report["removed"]), ("kept", report["kept"])]:
+        for entry in entries:
+            lines.append(
+                f"{status:<12} {entry['kind']:<10} {_format_size(entry['size']):>9} "
+                f"{(now - entry['last_referenced']) / 86400:>6.1f}d  {entry['reason']:<21} {entry['path']}"
+            )
+    for error in report["errors"]:
+        lines.append(f"{'failed':<12} {error['path']}: {error['error']}")
+    lines.append(
+        f"{_format_size(report['freed_bytes'])} of {_format_size(report['total_bytes'])} "
+        f"{'would be freed' if report['dry_run'] else 'freed'}"
+    )
+    return "\n".join(lines)
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Remove imports, pack extractions and cached conversions not referenced for a while.")
+    parser.add_argument("--url", default=DEFAULT_URL, help="Url of the extension, which keeps what its stage uses")
+    parser.add_argument("--offline", action="store_true", help="Collect without asking Kit, only while it is not running")
+    parser.add_argument("--registry", type=str, help="Import registry file, with --offline")
+    parser.add_argument("--root", action="append", default=[], help="Directory of pack zips whose extractions are collected too, repeatable")
+    parser.add_argument("--max-age-days", type=float, help="Remove what was not referenced for this many days, 0 for no limit")
+    parser.add_argument("--max-total-gb", type=float, help="Remove least recently referenced first until the rest fits, 0 for no quota")
+    parser.add_argument("--dry-run", action="store_true", help="Only report what would be removed")
+    parser.add_argument("--json", action="store_true", help="Print the report as json")
+    return parser.parse_args()
+
+def main(args):
+    if args.offline:
+        report = collect(
+            args.root,
+            args.max_age_days or 0.0,
+            args.max_total_gb or 0.0,
+            dry_run=args.dry_run,
+            registry_path=args.registry,
+        )
+    else:
+        request = urllib.request.Request(
+            f"{args.url.rstrip('/')}/imports/gc",
+            data=json.dumps({
+                "roots": args.root,
+                "max_age_days": args.max_age_days,
+                "max_total_gb": args.max_total_gb,
+                "dry_run": args.dry_run,
+            }).encode(),
+            headers={"Content-Type": "application/json"},
+        )
+        with urllib.request.urlopen(request) as response:
+            report = json.loads(response.read().decode())
+        if not report["success"]:
+            print(report["error_message"], file=sys.stderr)
+            sys.exit(1)
+    print(json.dumps(report, indent=1) if args.json else format_report(report))
+    sys.exit(1 if report["errors"] else 0)
+
+if __name__ == "__main__":
+    main(parse_args())
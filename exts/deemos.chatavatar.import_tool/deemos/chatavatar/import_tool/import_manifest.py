@@ -0,0 +1,93 @@
+# Record of what an import directory was generated from.
+# Written next to main.usd as manifest.json, so a later import of the same pack
+# can diff the requested configuration against it and only redo what changed.
+
+from __future__ import annotations
+import os
+import json
+import glob
+from typing import Dict, List, Optional
+
+MANIFEST_NAME = "manifest.json"
+# Bump when the layout of the import directory changes, older imports are then re-imported fully.
+MANIFEST_VERSION = 1
+
+def manifest_path(import_dir: str) -> str:
+    return os.path.join(import_dir, MANIFEST_NAME)
+
+def read_manifest(import_dir: str) -> Optional[dict]:
+    try:
+        with open(manifest_path(import_dir), "r", encoding="utf-8") as f:
+            manifest = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if manifest.get("version") != MANIFEST_VERSION:
+        return None
+    return manifest
+
+def write_manifest(import_dir: str, manifest: dict):
+    path = manifest_path(import_dir)
+    with open(f"{path}.partial", "w", encoding="utf-8") as f:
+        json.dump(manifest, f, indent=4)
+    os.replace(f"{path}.partial", path)
+
+def build_manifest(
+    import_id: str,
+    pack_name: str,
+    model_path: str,
+    main_layer_path: str,
+    selected_additional: int,
+    material_inputs: Dict[str, Dict[str, str]],
+    material_layers: Dict[str, str],
+    stage_prim_path: Optional[str] = None,
+    extent: Optional[List[List[float]]] = None,
+    lod: bool = False,
+) -> dict:
+    return {
+        "version": MANIFEST_VERSION,
+        "import_id": import_id,
+        "pack_name": pack_name,
+        "model_path": model_path,
+        "main_layer": main_layer_path,
+        "selected_additional": selected_additional,
+        "materials": {
+            material: {
+                "inputs": material_inputs[material],
+                "layer": material_layers[material],
+            }
+            for material in material_inputs
+        },
+        "stage_prim_path": stage_prim_path,
+        # [[min], [max]] of the avatar, for its proxy while unloaded
+        "extent": extent,
+        "lod": lod,
+    }
+
+def find_latest_import(omni_directory: str, pack_name: str) -> Optional[str]:
+    """Most recent import directory of pack_name with a valid manifest."""
+    # Import ids end with a %Y%m%d%H%M%S timestamp and, within the same second, a
+    # zero padded counter, so they sort chronologically
+    for import_dir in sorted(glob.glob(os.path.join(glob.escape(omni_directory), f"{glob.escape(pack_name)}_*")), reverse=True):
+        manifest = read_manifest(import_dir)
+        if manifest is not None and manifest["pack_name"] == pack_name:
+            return import_dir
+    return None
+
+def diff_manifest(old: dict, new: dict) -> dict:
+    """What has to be regenerated to go from the old import to the new one."""
+    old_materials = old["materials"]
+    new_materials = new["materials"]
+    return {
+        "materials_added": {
+            material for material in new_materials
+            if material not in old_materials
+            or old_materials[material]["inputs"] != new_materials[material]["inputs"]
+            or not os.path.exists(old_materials[material]["layer"])
+        },
+        "materials_removed": set(old_materials) - set(new_materials),
+        # Bindings depend on the model and on which materials exist
+        "bindings_changed": old["model_path"] != new["model_path"]
+                            or old["selected_additional"] != new["selected_additional"]
+                            or set(old_materials) != set(new_materials)
+                            or old.get("lod", False) != new["lod"],
+    }
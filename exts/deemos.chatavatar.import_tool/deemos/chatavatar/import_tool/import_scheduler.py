@@ -0,0 +1,68 @@
+from __future__ import annotations
+import os
+import asyncio
+import contextlib
+from typing import AsyncIterator, Awaitable, Callable, Dict, Hashable, Optional
+
+# Resource an import holds while preparing (extraction, conversion, material baking,
+# main layer authoring). Placing it in the stage is synchronous, one at a time anyway.
+PREPARE = "prepare"
+MAX_PENDING = 8
+MAX_PREPARING = 2
+
+class QueueFull(Exception):
+    pass
+
+class ImportScheduler:
+    """Bounds the number of pending imports and how many use a resource at once.
+
+    Imports are keyed on their request, an import submitted while an identical one
+    is pending shares its result instead of being run again.
+    """
+    def __init__(self, max_pending: int = MAX_PENDING, max_preparing: int = MAX_PREPARING):
+        self.max_pending = max_pending
+        self.max_preparing = max_preparing
+        self._slots: Dict[str, asyncio.Semaphore] = {
+            PREPARE: asyncio.Semaphore(max_preparing),
+        }
+        self._pending: Dict[Hashable, asyncio.Future] = {}
+        # Lock and number of imports holding or waiting for it, by pack directory
+        self._directories: Dict[str, list] = {}
+
+    def slot(self, resource: str) -> asyncio.Semaphore:
+        """Async context manager holding one of the slots of resource."""
+        return self._slots[resource]
+
+    @contextlib.asynccontextmanager
+    async def directory(self, pack_directory: str) -> AsyncIterator[None]:
+        """Held by one import of a pack directory at a time, they share its Omni_Directory."""
+        key = os.path.normcase(os.path.abspath(pack_directory))
+        entry = self._directories.setdefault(key, [asyncio.Lock(), 0])
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                yield
+        finally:
+            entry[1] -= 1
+            if not entry[1]:
+                del self._directories[key]
+
+    def pending(self) -> int:
+        return len(self._pending)
+
+    def submit(self, key: Hashable, run: Callable[[], Awaitable]) -> asyncio.Future:
+        """Run run() unless an import with key is pending, raises QueueFull when too many are."""
+        future: Optional[asyncio.Future] = self._pending.get(key)
+        if future is None:
+            if len(self._pending) >= self.max_pending:
+                raise QueueFull(f"{len(self._pending)} imports are pending already")
+            future = self._pending[key] = asyncio.ensure_future(run())
+            future.add_done_callback(lambda f: self._forget(key, f))
+        # A caller that goes away must not cancel the import for the others
+        return asyncio.shield(future)
+
+    def _forget(self, key: Hashable, future: asyncio.Future):
+        if self._pending.get(key) is future:
+            del self._pending[key]
+
+scheduler = ImportScheduler()
@@ -0,0 +1,188 @@
+# Level of detail variants of imported avatars.
+# Head meshes are decimated by vertex clustering: vertices are snapped to a grid
+# and merged per cell, faces left with fewer than three distinct corners are
+# dropped. Per vertex data, blendshape offsets included, follows the merge.
+
+import numpy as np
+from pxr import Sdf, Usd, UsdGeom, UsdSkel, Vt
+from . import usd_authoring
+
+LOD_VARIANT_SET = "lod"
+# (variant, grid cells along the longest side of the head or None to keep it, refinement level)
+LOD_VARIANTS = [
+    ("lod0", None, 2),
+    ("lod1", None, 0),
+    ("lod2", 48, 0),
+    ("lod3", 20, 0),
+]
+
+class Decimation:
+    def __init__(self, points, face_vertex_counts, face_vertex_indices, cells):
+        lower = points.min(axis=0)
+        cell_size = float((points.max(axis=0) - lower).max()) / cells
+        if cell_size > 0:
+            keys = np.floor((points - lower) / cell_size).astype(np.int64)
+            _, self.cluster = np.unique(keys, axis=0, return_inverse=True)
+            self.cluster = self.cluster.reshape(-1)
+        else:
+            self.cluster = np.arange(len(points))
+        self.point_count = int(self.cluster.max()) + 1 if len(points) else 0
+        self.cluster_sizes = np.bincount(self.cluster, minlength=self.point_count)
+        # First vertex of every cluster, for data that cannot be averaged
+        self.representatives = np.full(self.point_count, len(points), dtype=np.int64)
+        np.minimum.at(self.representatives, self.cluster, np.arange(len(points)))
+
+        face_count = len(face_vertex_counts)
+        face_of_corner = np.repeat(np.arange(face_count), face_vertex_counts)
+        corners = self.cluster[face_vertex_indices]
+        # Drop corners merged with the previous corner of their face
+        face_starts = np.cumsum(face_vertex_counts) - face_vertex_counts
+        previous_corner = np.arange(len(corners)) - 1
+        previous_corner[face_starts] = face_starts + face_vertex_counts - 1
+        self.kept_corners = corners != corners[previous_corner]
+        distinct_corners = np.bincount(
+            np.unique(face_of_corner * self.point_count + corners) // max(self.point_count, 1),
+            minlength=face_count,
+        )
+        self.kept_faces = distinct_corners >= 3
+        self.kept_corners &= self.kept_faces[face_of_corner]
+        self.face_index_map = np.cumsum(self.kept_faces) - 1
+
+        self.points = self.average(points).astype(points.dtype)
+        self.face_vertex_counts = np.bincount(
+            face_of_corner[self.kept_corners], minlength=face_count
+        )[self.kept_faces].astype(np.int32)
+        self.face_vertex_indices = corners[self.kept_corners].astype(np.int32)
+
+    def average(self, values):
+        """Per vertex values averaged over every cluster."""
+        values = values.reshape(len(self.cluster), -1).astype(np.float64)
+        sums = np.zeros((self.point_count, values.shape[1]))
+        np.add.at(sums, self.cluster, values)
+        return sums / self.cluster_sizes[:, None]
+
+    # values may hold several elements per vertex/corner/face (primvar elementSize)
+    def pick(self, values):
+        """Per vertex values of the first vertex of every cluster."""
+        return _select(values, self.representatives, len(self.cluster))
+
+    def corners(self, values):
+        return _select(values, self.kept_corners, len(self.kept_corners))
+
+    def faces(self, values):
+        return _select(values, self.kept_faces, len(self.kept_faces))
+
+    def face_indices(self, indices):
+        indices = indices[self.kept_faces[indices]]
+        return self.face_index_map[indices].astype(np.int32)
+
+def _select(values, selection, count):
+    return values.reshape(count, -1)[selection].reshape(-1, *values.shape[1:])
+
+def _dense(offsets, point_indices, vertex_count):
+    if point_indices is None:
+        return offsets
+    dense = np.zeros((vertex_count, 3), dtype=offsets.dtype)
+    dense[point_indices] = offsets
+    return dense
+
+def to_vt(type_name: Sdf.ValueTypeName, values):
+    return type_name.type.pythonClass.FromNumpy(np.ascontiguousarray(values))
+
+def variant_spec_path(model_prim_path: Sdf.Path, variant: str, prim_path: Sdf.Path) -> Sdf.Path:
+    """Path of the spec overriding prim_path in a variant of the model prim."""
+    return model_prim_path.AppendVariantSelection(LOD_VARIANT_SET, variant).AppendPath(
+        prim_path.MakeRelativePath(model_prim_path)
+    )
+
+def _set(prim_spec, attr: Usd.Attribute, values):
+    usd_authoring.set_attribute(prim_spec, attr.GetName(), attr.GetTypeName(), to_vt(attr.GetTypeName(), values))
+
+def author_decimated_mesh(layer: Sdf.Layer, spec_path: Sdf.Path, mesh_prim: Usd.Prim, cells: int):
+    """Override topology, primvars, subsets and blendshapes of mesh_prim at spec_path, to be called in an Sdf.ChangeBlock."""
+    mesh = UsdGeom.Mesh(mesh_prim)
+    points = np.array(mesh.GetPointsAttr().Get())
+    if len(points) == 0:
+        return
+    decimation = Decimation(
+        points,
+        np.array(mesh.GetFaceVertexCountsAttr().Get()),
+        np.array(mesh.GetFaceVertexIndicesAttr().Get()),
+        cells,
+    )
+    T = Sdf.ValueTypeNames
+    prim_spec = usd_authoring.over_prim(layer, spec_path)
+    usd_authoring.set_attribute(prim_spec, "points", T.Point3fArray, Vt.Vec3fArray.FromNumpy(decimation.points))
+    usd_authoring.set_attribute(prim_spec, "faceVertexCounts", T.IntArray, Vt.IntArray.FromNumpy(decimation.face_vertex_counts))
+    usd_authoring.set_attribute(prim_spec, "faceVertexIndices", T.IntArray, Vt.IntArray.FromNumpy(decimation.face_vertex_indices))
+    usd_authoring.set_attribute(prim_spec, "extent", T.Float3Array, Vt.Vec3fArray.FromNumpy(
+        np.stack([decimation.points.min(axis=0), decimation.points.max(axis=0)])
+    ))
+    # Indices of vertices and faces that are gone
+    for attr in [mesh.GetCornerIndicesAttr(), mesh.GetCreaseIndicesAttr(), mesh.GetHoleIndicesAttr()]:
+        if attr.HasAuthoredValue():
+            usd_authoring.set_attribute(prim_spec, attr.GetName(), attr.GetTypeName(), Vt.IntArray())
+    for attr in [mesh.GetCornerSharpnessesAttr(), mesh.GetCreaseLengthsAttr(), mesh.GetCreaseSharpnessesAttr()]:
+        if attr.HasAuthoredValue():
+            usd_authoring.set_attribute(prim_spec, attr.GetName(), attr.GetTypeName(), attr.GetTypeName().type.pythonClass())
+
+    normals_attr = mesh.GetNormalsAttr()
+    if normals_attr.HasAuthoredValue():
+        normals = np.array(normals_attr.Get())
+        if mesh.GetNormalsInterpolation() == UsdGeom.Tokens.faceVarying:
+            _set(prim_spec, normals_attr, decimation.corners(normals))
+        elif mesh.GetNormalsInterpolation() in (UsdGeom.Tokens.vertex, UsdGeom.Tokens.varying):
+            _set(prim_spec, normals_attr, decimation.pick(normals))
+        elif mesh.GetNormalsInterpolation() == UsdGeom.Tokens.uniform:
+            _set(prim_spec, normals_attr, decimation.faces(normals))
+
+    for primvar in UsdGeom.PrimvarsAPI(mesh_prim).GetAuthoredPrimvars():
+        interpolation = primvar.GetInterpolation()
+        if interpolation == UsdGeom.Tokens.constant:
+            continue
+        if primvar.IsIndexed():
+            # Values stay, only the indices follow the topology
+            target_attr, values = primvar.GetIndicesAttr(), np.array(primvar.GetIndices())
+        else:
+            target_attr, values = primvar.GetAttr(), np.array(primvar.Get())
+        if values.dtype == object:
+            continue
+        if interpolation == UsdGeom.Tokens.faceVarying:
+            values = decimation.corners(values)
+        elif interpolation in (UsdGeom.Tokens.vertex, UsdGeom.Tokens.varying):
+            values = decimation.pick(values)
+        elif interpolation == UsdGeom.Tokens.uniform:
+            values = decimation.faces(values)
+        _set(prim_spec, target_attr, values)
+
+    for subset in UsdGeom.Subset.GetAllGeomSubsets(mesh):
+        if subset.GetElementTypeAttr().Get() != UsdGeom.Tokens.face:
+            continue
+        subset_spec = usd_authoring.over_prim(layer, spec_path.AppendChild(subset.GetPrim().GetName()))
+        _set(subset_spec, subset.GetIndicesAttr(), decimation.face_indices(np.array(subset.GetIndicesAttr().Get())))
+
+    vertex_count = len(points)
+    for target_path in UsdSkel.BindingAPI(mesh_prim).GetBlendShapeTargetsRel().GetTargets():
+        blend_shape = UsdSkel.BlendShape(mesh_prim.GetStage().GetPrimAtPath(target_path))
+        # Blendshapes authored outside of the mesh would be shared with other meshes
+        if not blend_shape or not target_path.HasPrefix(mesh_prim.GetPath()):
+            continue
+        blend_shape_spec = usd_authoring.over_prim(layer, spec_path.AppendPath(target_path.MakeRelativePath(mesh_prim.GetPath())))
+        point_indices = np.array(blend_shape.GetPointIndicesAttr().Get()) if blend_shape.GetPointIndicesAttr().HasAuthoredValue() else None
+        offsets = np.array(blend_shape.GetOffsetsAttr().Get())
+        # Offset of a merged vertex is the mean offset of its vertices
+        merged_offsets = decimation.average(_dense(offsets, point_indices, vertex_count))
+        moved = None
+        if point_indices is not None:
+            # Stays sparse
+            moved = np.flatnonzero(np.any(merged_offsets != 0.0, axis=1))
+            merged_offsets = merged_offsets[moved]
+            _set(blend_shape_spec, blend_shape.GetPointIndicesAttr(), moved.astype(np.int32))
+        _set(blend_shape_spec, blend_shape.GetOffsetsAttr(), merged_offsets.astype(offsets.dtype))
+        normal_offsets_attr = blend_shape.GetNormalOffsetsAttr()
+        if normal_offsets_attr.HasAuthoredValue():
+            normal_offsets = np.array(normal_offsets_attr.Get())
+            merged_normal_offsets = decimation.average(_dense(normal_offsets, point_indices, vertex_count))
+            if moved is not None:
+                merged_normal_offsets = merged_normal_offsets[moved]
+            _set(blend_shape_spec, normal_offsets_attr, merged_normal_offsets.astype(normal_offsets.dtype))
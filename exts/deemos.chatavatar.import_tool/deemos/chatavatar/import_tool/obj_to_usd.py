@@ -0,0 +1,175 @@
+# Native conversion of the obj files shipped in ChatAvatar packs.
+# Only the subset written by ChatAvatar is supported: v/vt/f records of a single
+# o/g object, one consistent face vertex format per file and usemtl material
+# groups. Anything else raises ObjFormatError so the caller can fall back to
+# Kit's converter. vn normals are not carried over, the mesh is subdivided and
+# its normals computed. Points are written as they are, in centimeters.
+
+import os
+import re
+import mmap
+import numpy as np
+from pxr import Sdf, Tf, Vt
+from . import usd_authoring
+
+
+OBJ_MTLLIB_OR_USEMTL = re.compile(rb"^(mtllib|usemtl)[ \t]+([^\r\n]+)", re.M)
+OBJ_USEMTL_SPLIT = re.compile(rb"^usemtl[ \t]+([^\r\n]*?)[ \t]*\r?$", re.M)
+OBJ_OBJECT_NAME = re.compile(rb"^[og][ \t]+([^\r\n]*?)[ \t]*\r?$", re.M)
+OBJ_RECORD = {
+    b"v": re.compile(rb"^v[ \t]+([^\r\n]*)", re.M),
+    b"vt": re.compile(rb"^vt[ \t]+([^\r\n]*)", re.M),
+    b"f": re.compile(rb"^f[ \t]+([^\r\n]*)", re.M),
+}
+
+class ObjFormatError(ValueError):
+    pass
+
+def _map_file(in_file):
+    with open(in_file, "rb") as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return b""
+        return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+def scan_materials(in_file):
+    """Stream the obj once, returning {mtllib: [usemtl, ...]} in file order."""
+    current_mtllib = None
+    mtllibs = {}
+    with open(in_file, "rb") as f:
+        for line in f:
+            if not line.startswith((b"mtllib", b"usemtl")):
+                continue
+            match = OBJ_MTLLIB_OR_USEMTL.match(line)
+            if match is None:
+                continue
+            keyword, value = match.group(1), match.group(2).split()[0].decode("utf-8")
+            if keyword == b"mtllib":
+                current_mtllib = value
+            else:
+                mtls = mtllibs.setdefault(current_mtllib, [])
+                if value not in mtls:
+                    mtls.append(value)
+    return mtllibs
+
+def _parse_floats(bodies, min_columns):
+    if not bodies:
+        return np.zeros((0, min_columns), dtype=np.float32)
+    columns = len(bodies[0].split())
+    values = np.fromstring(b" ".join(bodies).decode("ascii"), dtype=np.float64, sep=" ")
+    if columns < min_columns or values.size != columns * len(bodies):
+        raise ObjFormatError("Inconsistent vertex record length")
+    return values.reshape(-1, columns)[:, :min_columns].astype(np.float32)
+
+def _parse_faces(bodies):
+    """Returns (counts, corners) where corners is (n, 2) of [v, vt] 1-based indices."""
+    if not bodies:
+        return np.zeros((0,), dtype=np.int32), np.zeros((0, 2), dtype=np.int64)
+    first_corner = bodies[0].split()[0]
+    if b"//" in first_corner:
+        corner_width, has_uv = 2, False
+    else:
+        corner_width = first_corner.count(b"/") + 1
+        has_uv = corner_width >= 2
+    if not has_uv:
+        raise ObjFormatError("Faces without texture coordinates are not supported")
+
+    counts = np.fromiter((len(body.split()) for body in bodies), dtype=np.int32, count=len(bodies))
+    text = b" ".join(bodies).replace(b"//", b"/0/").replace(b"/", b" ").decode("ascii")
+    values = np.fromstring(text, dtype=np.int64, sep=" ")
+    if values.size != int(counts.sum()) * corner_width:
+        raise ObjFormatError("Mixed face vertex formats are not supported")
+    return counts, values.reshape(-1, corner_width)[:, :2]
+
+def _absolute_indices(indices, total):
+    # Relative (negative) indices are resolved against the full element count,
+    # which is correct for files writing all elements before the faces.
+    return np.where(indices < 0, indices + total, indices - 1)
+
+def read_obj(in_file):
+    data = _map_file(in_file)
+    try:
+        points = _parse_floats(OBJ_RECORD[b"v"].findall(data), 3)
+        uvs = _parse_floats(OBJ_RECORD[b"vt"].findall(data), 2)
+        object_names = set(OBJ_OBJECT_NAME.findall(data))
+        if len(object_names) > 1:
+            # Would be merged into one mesh, head meshes are told apart by their prims
+            raise ObjFormatError("Files with several objects are not supported")
+        mesh_name = object_names.pop().decode("utf-8") if object_names else "Mesh"
+
+        # Chunks alternate between face blocks and the usemtl name preceding them
+        chunks = OBJ_USEMTL_SPLIT.split(data)
+        groups = [(None, chunks[0])] + [
+            (chunks[i].decode("utf-8"), chunks[i + 1]) for i in range(1, len(chunks), 2)
+        ]
+        face_counts, face_corners, face_materials = [], [], []
+        for material, chunk in groups:
+            counts, corners = _parse_faces(OBJ_RECORD[b"f"].findall(chunk))
+            face_counts.append(counts)
+            face_corners.append(corners)
+            face_materials.append((material, len(counts)))
+    finally:
+        if isinstance(data, mmap.mmap):
+            data.close()
+
+    counts = np.concatenate(face_counts)
+    corners = np.concatenate(face_corners)
+    if len(counts) == 0:
+        raise ObjFormatError("No faces found")
+
+    subsets = {}
+    first_face = 0
+    for material, count in face_materials:
+        if material is not None and count:
+            subsets.setdefault(material, []).append(np.arange(first_face, first_face + count, dtype=np.int32))
+        first_face += count
+
+    return {
+        "mesh_name": mesh_name,
+        "points": points,
+        "uvs": uvs,
+        "face_vertex_counts": counts,
+        "face_vertex_indices": _absolute_indices(corners[:, 0], len(points)).astype(np.int32),
+        "uv_indices": _absolute_indices(corners[:, 1], len(uvs)).astype(np.int32),
+        "subsets": {key: np.concatenate(value) for key, value in subsets.items()},
+    }
+
+def gen_usd(obj_data, out_file):
+    layer = usd_authoring.create_layer(out_file)
+    T = Sdf.ValueTypeNames
+    with Sdf.ChangeBlock():
+        usd_authoring.set_stage_metadata(layer, default_prim="root", meters_per_unit=0.01, up_axis="Y")
+        usd_authoring.define_prim(layer, "/root", "Xform")
+
+        usd_authoring.define_prim(layer, "/root/Looks", "Scope")
+        material_paths = {
+            name: Sdf.Path(f"/root/Looks/{Tf.MakeValidIdentifier(name)}")
+            for name in obj_data["subsets"]
+        }
+        for material_path in material_paths.values():
+            usd_authoring.define_prim(layer, material_path, "Material")
+
+        mesh_prim_path = Sdf.Path(f'/root/{Tf.MakeValidIdentifier(obj_data["mesh_name"])}')
+        mesh_prim = usd_authoring.define_prim(layer, mesh_prim_path, "Mesh")
+        usd_authoring.apply_api_schemas(mesh_prim, ["MaterialBindingAPI"])
+        usd_authoring.set_attribute(mesh_prim, "subsetFamily:materialBind:familyType", T.Token, "nonOverlapping", uniform=True)
+        usd_authoring.set_attribute(mesh_prim, "points", T.Point3fArray, Vt.Vec3fArray.FromNumpy(obj_data["points"]))
+        usd_authoring.set_attribute(mesh_prim, "faceVertexCounts", T.IntArray, Vt.IntArray.FromNumpy(obj_data["face_vertex_counts"]))
+        usd_authoring.set_attribute(mesh_prim, "faceVertexIndices", T.IntArray, Vt.IntArray.FromNumpy(obj_data["face_vertex_indices"]))
+        usd_authoring.set_attribute(
+            mesh_prim, "primvars:st", T.TexCoord2fArray, Vt.Vec2fArray.FromNumpy(obj_data["uvs"]),
+            interpolation="faceVarying",
+        )
+        usd_authoring.set_attribute(mesh_prim, "primvars:st:indices", T.IntArray, Vt.IntArray.FromNumpy(obj_data["uv_indices"]))
+
+        for name, face_indices in obj_data["subsets"].items():
+            geom_subset_prim = usd_authoring.define_prim(layer, mesh_prim_path.AppendChild(Tf.MakeValidIdentifier(name)), "GeomSubset")
+            usd_authoring.apply_api_schemas(geom_subset_prim, ["MaterialBindingAPI"])
+            usd_authoring.set_attribute(geom_subset_prim, "elementType", T.Token, "face", uniform=True)
+            usd_authoring.set_attribute(geom_subset_prim, "familyName", T.Token, "materialBind", uniform=True)
+            usd_authoring.set_attribute(geom_subset_prim, "indices", T.IntArray, Vt.IntArray.FromNumpy(face_indices))
+            usd_authoring.set_relationship(geom_subset_prim, "material:binding", [material_paths[name]])
+
+    layer.Save()
+
+def obj2usd(in_file, out_file):
+    gen_usd(read_obj(in_file), out_file)
@@ -1,23 +1,156 @@
 from __future__ import annotations
-from typing import Set
+from typing import Dict, List, Optional, Set
 import omni.usd
 import omni.kit.commands
 from .ChatAvatarPack import defs as CADefs
 import carb
 import omni.kit.asset_converter
-import tempfile
 import os
+import shutil
+import tempfile
+import asyncio
+import concurrent.futures
 from datetime import datetime
 import re
-from . import fbx_to_usd
+# mesh_lod and obj_to_usd are imported where used, most imports need neither
+from . import conversion_cache, import_gc, import_manifest, import_scheduler, pack_transfer, usd_authoring
 
-from pxr import Sdf, Usd, UsdShade, UsdGeom, Gf
+from pxr import Sdf, Usd, UsdShade, UsdGeom, UsdSkel, Gf, Vt
 
 DEFAULT_MTLS = frozenset(["Face"])
 BACKHEAD_MTLS = frozenset(["Backhead"])
 COMPONENTS_MTLS = frozenset(["Eye","Eyelashes","Fluid","Occlusion","Teeth","Teeth_fluid"])
 
+# customData key of the stage prims holding imported avatars
+IMPORT_ID_KEY = "chatavatarImportId"
+# Children of the stage prim of an avatar: the payload, and a box standing in for it
+# while unloaded. The box is a sibling, descendants of unloaded prims are not drawn.
+AVATAR_PRIM_NAME = "Avatar"
+PROXY_PRIM_NAME = "Proxy"
+
 DEBUG = False
+# Convert obj models with obj_to_usd instead of referencing them through Kit's asset converter,
+# set by the extension from its settings
+NATIVE_OBJ = False
+
+# Material baking is file I/O and USD export, both release the GIL. Kit embeds
+# its interpreter, so a process pool would have to start Kit itself.
+bake_executor = concurrent.futures.ThreadPoolExecutor(
+    max_workers=min(8, (os.cpu_count() or 2) * 2),
+    thread_name_prefix="chatavatar_bake",
+)
+
+def converted_suffix():
+    return ".usda" if DEBUG else ".usd"
+
+def convertible_suffixes():
+    return (".fbx", ".obj") if NATIVE_OBJ else (".fbx",)
+
+# Model extractions of opened zip packs, by pack id
+preconvert_extractions: Dict[str, concurrent.futures.Future] = {}
+
+def preconvert_pack(
+    source_paths: List[str],
+    pack_id: str,
+    source_zip: Optional[str] = None,
+    extract_dir: Optional[str] = None,
+):
+    """Speculatively convert every model of an opened pack into the conversion cache.
+
+    With source_zip, source_paths are zip members which are extracted to extract_dir first.
+    """
+    if source_zip is None:
+        conversion_cache.cache.prefetch(
+            [path for path in source_paths if path.endswith(convertible_suffixes()) and os.path.isfile(path)],
+            pack_id,
+            converted_suffix(),
+        )
+        return
+
+    future = preconvert_extractions[pack_id] = bake_executor.submit(
+        pack_transfer.extract_members,
+        source_zip,
+        [path for path in source_paths if path.endswith(convertible_suffixes())],
+        extract_dir,
+    )
+    def extracted(future: concurrent.futures.Future):
+        # Dropped when the pack was closed meanwhile
+        if preconvert_extractions.get(pack_id) is not future or future.cancelled():
+            return
+        del preconvert_extractions[pack_id]
+        if future.exception() is not None:
+            carb.log_warn(f"Extraction of {source_zip} failed: {type(future.exception()).__name__}: {future.exception()}")
+            return
+        preconvert_pack(list(future.result().values()), pack_id)
+    future.add_done_callback(extracted)
+
+def cancel_preconvert(pack_id: str):
+    future = preconvert_extractions.pop(pack_id, None)
+    if future is not None:
+        future.cancel()
+    conversion_cache.cache.cancel(pack_id)
+
+# (material, slot name keywords, part that has to be available in the pack), in matching priority
+SLOT_RULES = [
+    ("Eyelashes", ["M_EyeLashes"], CADefs.AdditionalElements.Components),
+    ("TeethFluid", ["teeth_fluid"], CADefs.AdditionalElements.Components),
+    ("Occlusion", ["Occ"], CADefs.AdditionalElements.Components),
+    ("Eye", ["left_eyeball", "right_eyeball"], CADefs.AdditionalElements.Components),
+    ("Teeth", ["teeth"], CADefs.AdditionalElements.Components),
+    ("Fluid", ["Fluid"], CADefs.AdditionalElements.Components),
+    ("Face", ["face", "M_Face"], None),
+    ("Backhead", ["back", "M_BackHead"], CADefs.AdditionalElements.BackHeadTex),
+]
+
+class SlotMatcher:
+    """Maps slot names to materials, with the enabled rules of one import resolved once."""
+    def __init__(
+        self,
+        selected_pack: CADefs.PackInfo,
+        available_additional: CADefs.AdditionalElements,
+        materials_need_to_apply: Set[str]
+    ):
+        self.topology = selected_pack.topology
+        self.rules = [
+            rule for rule in SLOT_RULES
+            if rule[0] in materials_need_to_apply and (rule[2] is None or available_additional & rule[2])
+        ]
+        # One alternation over every keyword, a group per rule. It sits in a lookahead so
+        # keywords overlapping an earlier match are still found in the same scan
+        self.pattern = re.compile("(?=" + "|".join(
+            f"(?P<rule{i}>{'|'.join(re.escape(keyword) for keyword in keywords)})"
+            for i, (_, keywords, _) in enumerate(self.rules)
+        ) + ")") if self.rules else None
+        # Slot names repeat across meshes and imports of a pack
+        self.results = {}
+
+    def match(self, slot_name: str):
+        if self.topology == CADefs.Topology.MetaHuman:
+            return {
+                "name": "Face",
+                "variant": None
+            }
+        elif self.topology != CADefs.Topology.Default:
+            return None
+        if slot_name not in self.results:
+            self.results[slot_name] = self._match(slot_name)
+        return self.results[slot_name]
+
+    def _match(self, slot_name: str):
+        matched_rules = [
+            int(match.lastgroup[len("rule"):]) for match in self.pattern.finditer(slot_name)
+        ] if self.pattern else []
+        if not matched_rules:
+            return None
+        # Rules are in priority order, not the keywords' order in the name
+        name = self.rules[min(matched_rules)][0]
+        variant = None
+        if name == "Eye":
+            variant = "left" if "left_eyeball" in slot_name else "right"
+        return {
+            "name": name,
+            "variant": variant
+        }
 
 def determine_material_by_slot_name(
     slot_name: str,
@@ -26,73 +159,364 @@ def determine_material_by_slot_name(
     available_additional: CADefs.AdditionalElements,
     materials_need_to_apply: Set[str]
 ):
+    return SlotMatcher(selected_pack, available_additional, materials_need_to_apply).match(slot_name)
+
+def materials_to_apply(
+    selected_pack: CADefs.PackInfo,
+    selected_additional: CADefs.AdditionalElements,
+    available_additional: CADefs.AdditionalElements,
+) -> Set[str]:
+    materials_need_to_apply = set(DEFAULT_MTLS)
     if selected_pack.topology == CADefs.Topology.MetaHuman:
+        # Only Face is needed
+        pass
+    elif selected_pack.topology == CADefs.Topology.Default:
+        # Backhead
+        if selected_additional & CADefs.AdditionalElements.BackHeadTex:
+            materials_need_to_apply |= set(BACKHEAD_MTLS)
+        # Components
+        if selected_additional & CADefs.AdditionalElements.Components:
+            materials_need_to_apply |= set(COMPONENTS_MTLS)
+        elif (selected_additional & CADefs.AdditionalElements.RiggedBody) and (available_additional & CADefs.AdditionalElements.Components):
+            materials_need_to_apply |= set(COMPONENTS_MTLS)
+    else:
+        raise NotImplementedError("Unknown topology!")
+    return materials_need_to_apply
+
+def material_inputs(
+    material: str,
+    texture_paths: dict[str, str],
+    additional_paths: dict[CADefs.AdditionalElements, dict[str, str] | str],
+) -> Dict[str, str]:
+    """Pack specific placeholders of a material template and their values."""
+    if material == "Backhead":
+        prefix, paths = "BACKHEAD", additional_paths[CADefs.AdditionalElements.BackHeadTex]
+    elif material == "Face":
+        prefix, paths = "FACE", texture_paths
+    else:
+        return {}
+    return {
+        f"{{{prefix}_{kind.upper()}_PATH}}": paths[f"texture_{kind}"].replace('\\', '/')
+        for kind in ["specular", "diffuse", "normal"]
+    }
+
+def copy_texture(source_path: str, target_path: str):
+    # A copy, not a hardlink, so the shipped texture can never be changed through it.
+    # Concurrent imports of a pack may copy the same texture, each to its own partial file.
+    fd, partial_path = tempfile.mkstemp(suffix=".partial", dir=os.path.dirname(target_path))
+    try:
+        with os.fdopen(fd, "wb") as f, open(source_path, "rb") as source:
+            shutil.copyfileobj(source, f)
+        os.replace(partial_path, target_path)
+    except BaseException:
+        if os.path.exists(partial_path):
+            os.remove(partial_path)
+        raise
+
+def bake_material(content: str, material_usdc_path: str):
+    material_layer = Sdf.Layer.CreateAnonymous(".usda")
+    material_layer.ImportFromString(content)
+    material_layer.Export(material_usdc_path)
+
+async def bake_materials(
+    inputs: Dict[str, Dict[str, str]],
+    material_usdc_paths: Dict[str, str],
+    omni_texture_path: str,
+):
+    needed_textures = set()
+    contents = {}
+    # Extract needed materials
+    for material, placeholders in inputs.items():
+        with open(os.path.join(
+            os.path.dirname(__file__),
+            f"resources/Shader/{material}.material.usda"
+        ), "r", encoding="utf-8") as material_f:
+            content = material_f.read()
+        needed_textures.update(re.findall(r'@(\{OMNI_TEXTURE_PATH\}/.+)@', content))
+        # replace file path
+        content = content.replace("{OMNI_TEXTURE_PATH}", omni_texture_path.replace('\\', '/'))
+        for placeholder, value in placeholders.items():
+            content = content.replace(placeholder, value)
+        contents[material] = content
+
+    # Texture copies and layer exports are independent, run them all at once
+    futures = []
+    for texture in needed_textures:
+        extracted_path = texture.format(OMNI_TEXTURE_PATH=omni_texture_path)
+        if os.path.exists(extracted_path):
+            continue
+        os.makedirs(os.path.dirname(extracted_path), exist_ok=True)
+        futures.append(bake_executor.submit(
+            copy_texture,
+            os.path.join(
+                os.path.dirname(__file__),
+                texture.format(OMNI_TEXTURE_PATH="resources/Texture")
+            ),
+            extracted_path,
+        ))
+    for material, content in contents.items():
+        futures.append(bake_executor.submit(bake_material, content, material_usdc_paths[material]))
+    await asyncio.gather(*[asyncio.wrap_future(future) for future in futures])
+
+    for material in contents:
+        # An update rewrites a layer that may be loaded by the open stage
+        material_layer = Sdf.Layer.Find(material_usdc_paths[material])
+        if material_layer is not None:
+            material_layer.Reload()
+
+def material_prim_paths(material_scope_prim_path: Sdf.Path, material: str) -> Dict[str, Sdf.Path]:
+    if material == "Eye":
         return {
-            "name": "Face",
-            "variant": None
+            "left": material_scope_prim_path.AppendChild("LeftEye"),
+            "right": material_scope_prim_path.AppendChild("RightEye"),
         }
-    elif selected_pack.topology == CADefs.Topology.Default:
-        if "Eyelashes" in materials_need_to_apply and \
-            any(i in slot_name for i in {"M_EyeLashes"}) and \
-            available_additional & CADefs.AdditionalElements.Components:
-            return {
-                "name": "Eyelashes",
-                "variant": None
-            }
-        if "TeethFluid" in materials_need_to_apply and \
-            any(i in slot_name for i in {"teeth_fluid"}) and \
-            available_additional & CADefs.AdditionalElements.Components:
-            return {
-                "name": "TeethFluid",
-                "variant": None
-            }
-        if "Occlusion" in materials_need_to_apply and \
-            any(i in slot_name for i in {"Occ"}) and \
-            available_additional & CADefs.AdditionalElements.Components:
-            return {
-                "name": "Occlusion",
-                "variant": None
-            }
-        if "Eye" in materials_need_to_apply and \
-            any(i in slot_name for i in {"left_eyeball", "right_eyeball"}) and \
-            available_additional & CADefs.AdditionalElements.Components:
-            variant = None
-            if "left_eyeball" in slot_name:
-                variant = "left"
-            elif "right_eyeball" in slot_name:
-                variant = "right"
-            return {
-                "name": "Eye",
-                "variant": variant
-            }
-        if "Teeth" in materials_need_to_apply and \
-            any(i in slot_name for i in {"teeth"}) and \
-            available_additional & CADefs.AdditionalElements.Components:
-            return {
-                "name": "Teeth",
-                "variant": None
-            }
-        if "Fluid" in materials_need_to_apply and \
-            any(i in slot_name for i in {"Fluid"}) and \
-            available_additional & CADefs.AdditionalElements.Components:
-            return {
-                "name": "Fluid",
-                "variant": None
-            }
-        if "Face" in materials_need_to_apply and \
-            any(i in slot_name for i in {"face", "M_Face"}):
-            return {
-                "name": "Face",
-                "variant": None
-            }
-        if "Backhead" in materials_need_to_apply and \
-            any(i in slot_name for i in {"back", "M_BackHead"}) and \
-            available_additional & CADefs.AdditionalElements.BackHeadTex:
-            return {
-                "name": "Backhead",
-                "variant": None
-            }
+    return {None: material_scope_prim_path.AppendChild(material)}
+
+def author_materials(
+    main_layer: Sdf.Layer,
+    material_scope_prim_path: Sdf.Path,
+    material_usdc_paths: Dict[str, str],
+    removed_materials: Set[str],
+):
+    """Add missing material prims and remove the ones no longer used, to be called in an Sdf.ChangeBlock."""
+    for material in removed_materials:
+        for material_path in material_prim_paths(material_scope_prim_path, material).values():
+            usd_authoring.remove_prim(main_layer, material_path)
+    for material, material_usdc_path in material_usdc_paths.items():
+        for material_path in material_prim_paths(material_scope_prim_path, material).values():
+            if main_layer.GetPrimAtPath(material_path):
+                continue
+            material_prim_spec = usd_authoring.define_prim(main_layer, material_path, "Material")
+            usd_authoring.add_reference(material_prim_spec, material_usdc_path, f"/Root/{material}")
+
+def author_model(
+    main_layer: Sdf.Layer,
+    model_prim_path: Sdf.Path,
+    material_scope_prim_path: Sdf.Path,
+    model_path: str,
+    selected_pack: CADefs.PackInfo,
+    selected_additional: CADefs.AdditionalElements,
+    available_additional: CADefs.AdditionalElements,
+    materials_need_to_apply: Set[str],
+    lod: bool = False,
+):
+    """(Re)create the model prim with its reference, transform fixes, bindings and subdivision.
+
+    lod: author the subdivision in LOD variants, with decimated head meshes in the lower ones.
+
+    Returns the extent of the avatar as [[min], [max]], None if it has no geometry.
+    """
+    with Sdf.ChangeBlock():
+        # Overs from a previous import are dropped with the prim
+        usd_authoring.remove_prim(main_layer, model_prim_path)
+        # Create new prim(Xform) to hold reference
+        model_prim_spec = usd_authoring.define_prim(main_layer, model_prim_path, "Xform")
+        usd_authoring.add_reference(model_prim_spec, model_path)
+
+    main_stage = Usd.Stage.Open(main_layer)
+    model_prim = main_stage.GetPrimAtPath(model_prim_path)
+    xform_ops = UsdGeom.Xformable(model_prim).GetOrderedXformOps()
+    materials_new = material_usage_summary(model_prim)
+    carb.log_warn(materials_new)
+
+    # Values are authored in one batch too, through Sdf like everything else in the block
+    with Sdf.ChangeBlock():
+        # Do scaling
+        if (selected_additional & CADefs.AdditionalElements.RiggedBody):
+            for op in xform_ops:
+                if op.GetOpType() == UsdGeom.XformOp.TypeScale:
+                    # 找到现有的缩放操作，更新它的值
+                    usd_authoring.set_attribute(model_prim_spec, op.GetName(), op.GetTypeName(), (100.0, 100.0, 100.0))
+                    break
+        
+        # orientation
+        if (not (selected_additional & CADefs.AdditionalElements.RiggedBody)) and\
+           (model_path.endswith(".usd") or model_path.endswith(".usda")):
+            for op in xform_ops:
+                if op.GetOpType() == UsdGeom.XformOp.TypeOrient:
+                    # Sdf does not cast between quaternion precisions
+                    quat_type = op.GetTypeName().type.pythonClass
+                    usd_authoring.set_attribute(model_prim_spec, op.GetName(), op.GetTypeName(), quat_type(0.0, 1.0, 0.0, 0.0))
+                    break
+
+        # For each material, find new material to apply
+        slot_matcher = SlotMatcher(selected_pack, available_additional, materials_need_to_apply)
+        head_mesh_paths = set()
+        for material_path, material_info in materials_new.items():
+            target_material_key = slot_matcher.match(material_path.name)
+            if target_material_key is None:
+                continue
+            target_material_path = material_prim_paths(
+                material_scope_prim_path,
+                target_material_key["name"]
+            )[target_material_key["variant"]]
+            for target_prim in material_info["users"]:
+                usd_authoring.bind_material(main_layer, target_prim.GetPath(), target_material_path)
+                if target_material_key["name"] == "Face":
+                    head_mesh_paths.add(target_prim.GetPath() if target_prim.IsA(UsdGeom.Mesh) else target_prim.GetParent().GetPath())
+        
+        if lod:
+            author_lod_variants(main_layer, model_prim, head_mesh_paths)
+        else:
+            set_subdiv_scheme_and_refinement(model_prim, main_layer)
+
+    bound = UsdGeom.BBoxCache(Usd.TimeCode.Default(), [UsdGeom.Tokens.default_, UsdGeom.Tokens.render]) \
+        .ComputeWorldBound(main_stage.GetPrimAtPath(model_prim_path.GetParentPath())).ComputeAlignedRange()
+    if bound.IsEmpty():
         return None
+    return [list(bound.GetMin()), list(bound.GetMax())]
+
+def author_lod_variants(main_layer: Sdf.Layer, model_prim: Usd.Prim, head_mesh_paths: Set[Sdf.Path]):
+    """LOD variant set on the model prim, to be called in an Sdf.ChangeBlock.
+
+    Subdivision is only authored in the variants, direct opinions would be stronger.
+    """
+    from . import mesh_lod
+    model_prim_path = model_prim.GetPath()
+    for variant, cells, refinement_level in mesh_lod.LOD_VARIANTS:
+        def spec_path(prim_path, variant=variant):
+            return mesh_lod.variant_spec_path(model_prim_path, variant, prim_path)
+        if cells is not None:
+            for mesh_prim in iter_meshes(model_prim):
+                if mesh_prim.GetPath() in head_mesh_paths:
+                    mesh_lod.author_decimated_mesh(main_layer, spec_path(mesh_prim.GetPath()), mesh_prim, cells)
+        set_subdiv_scheme_and_refinement(model_prim, main_layer, refinement_level, spec_path)
+    model_prim_spec = main_layer.GetPrimAtPath(model_prim_path)
+    model_prim_spec.variantSelections[mesh_lod.LOD_VARIANT_SET] = mesh_lod.LOD_VARIANTS[0][0]
+
+def author_proxy(layer: Sdf.Layer, avatar_prim_path: Sdf.Path, extent: List[List[float]]):
+    """Box the size of the avatar, invisible unless shown by show_proxies."""
+    T = Sdf.ValueTypeNames
+    bound = Gf.Range3d(Gf.Vec3d(*extent[0]), Gf.Vec3d(*extent[1]))
+    proxy_prim_spec = usd_authoring.define_prim(layer, avatar_prim_path.AppendChild(PROXY_PRIM_NAME), "Cube")
+    usd_authoring.set_attribute(proxy_prim_spec, "size", T.Double, 1.0)
+    usd_authoring.set_attribute(proxy_prim_spec, "extent", T.Float3Array, Vt.Vec3fArray([Gf.Vec3f(-0.5), Gf.Vec3f(0.5)]))
+    usd_authoring.set_attribute(proxy_prim_spec, "visibility", T.Token, UsdGeom.Tokens.invisible)
+    usd_authoring.set_xform_ops(
+        proxy_prim_spec,
+        Gf.Vec3f(bound.GetMidpoint()),
+        Gf.Quatf(1.0),
+        Gf.Vec3f(bound.GetSize()),
+    )
+
+def show_proxies(stage: Usd.Stage, avatar_prim_paths: List[Sdf.Path], visible: bool):
+    proxy_prim_paths = [
+        path.AppendChild(PROXY_PRIM_NAME) for path in avatar_prim_paths
+        if stage.GetPrimAtPath(path.AppendChild(PROXY_PRIM_NAME))
+    ]
+    # Load state is not saved with the scene, neither is the proxy shown for it
+    session_layer = stage.GetSessionLayer()
+    with Sdf.ChangeBlock():
+        for proxy_prim_path in proxy_prim_paths:
+            usd_authoring.set_attribute(
+                usd_authoring.over_prim(session_layer, proxy_prim_path),
+                "visibility",
+                Sdf.ValueTypeNames.Token,
+                UsdGeom.Tokens.inherited if visible else UsdGeom.Tokens.invisible,
+            )
+
+def payload_prim_path(stage: Usd.Stage, avatar_prim_path: Sdf.Path) -> Sdf.Path:
+    # Imports older than payloads reference the avatar on the stage prim itself
+    if stage.GetPrimAtPath(avatar_prim_path.AppendChild(AVATAR_PRIM_NAME)):
+        return avatar_prim_path.AppendChild(AVATAR_PRIM_NAME)
+    return avatar_prim_path
+
+def find_avatar_prims(stage: Usd.Stage, import_ids: Optional[Set[str]] = None) -> Dict[str, Sdf.Path]:
+    """Stage prims of imported avatars by import id, all of them when import_ids is None."""
+    results = {}
+    prim_range = iter(Usd.PrimRange.Stage(stage, Usd.PrimIsActive & Usd.PrimIsDefined))
+    for prim in prim_range:
+        import_id = prim.GetCustomDataByKey(IMPORT_ID_KEY)
+        if import_id is not None and (import_ids is None or import_id in import_ids):
+            results[import_id] = prim.GetPath()
+        # Nothing to find inside of avatars or other payloads
+        if import_id is not None or prim.HasAuthoredPayloads():
+            prim_range.PruneChildren()
+    return results
+
+def load_avatars(import_ids: Optional[List[str]], load: bool) -> List[str]:
+    """Load or unload imported avatars, all of them when import_ids is None. Returns the affected ids."""
+    stage = omni.usd.get_context().get_stage()
+    avatar_prim_paths = find_avatar_prims(stage, None if import_ids is None else set(import_ids))
+    missing = set(import_ids or []) - set(avatar_prim_paths)
+    if missing:
+        raise KeyError(f"No imported avatar with id {', '.join(sorted(missing))} in the stage")
+    payload_prim_paths = [payload_prim_path(stage, path) for path in avatar_prim_paths.values()]
+    # One recomposition for all of them
+    if load:
+        stage.LoadAndUnload(payload_prim_paths, [])
+    else:
+        stage.LoadAndUnload([], payload_prim_paths)
+    show_proxies(stage, list(avatar_prim_paths.values()), not load)
+    return sorted(avatar_prim_paths)
+
+def import_dir_of(stage: Usd.Stage, avatar_prim_path: Sdf.Path) -> str:
+    """Import directory holding the main layer of an avatar in the stage."""
+    for prim_spec in stage.GetPrimAtPath(payload_prim_path(stage, avatar_prim_path)).GetPrimStack():
+        arcs = list(prim_spec.payloadList.GetAddedOrExplicitItems()) + list(prim_spec.referenceList.GetAddedOrExplicitItems())
+        for arc in arcs:
+            if arc.assetPath:
+                return os.path.dirname(prim_spec.layer.ComputeAbsolutePath(arc.assetPath))
+    raise KeyError(f"No main layer found for {avatar_prim_path}")
+
+def referenced_import_dirs(stage: Usd.Stage) -> List[str]:
+    import_dirs = []
+    for avatar_prim_path in find_avatar_prims(stage).values():
+        try:
+            import_dirs.append(import_dir_of(stage, avatar_prim_path))
+        except KeyError:
+            pass
+    return import_dirs
+
+def touch_imports(stage: Usd.Stage):
+    """Record the imports the stage references as referenced now."""
+    try:
+        import_gc.touch(referenced_import_dirs(stage))
+    except OSError as e:
+        carb.log_warn(f"Imports of the stage not recorded: {type(e).__name__}: {e}")
+
+async def collect_garbage(
+    roots: List[str],
+    max_age_days: float,
+    max_total_gb: float,
+    dry_run: bool,
+) -> dict:
+    """Remove imports, cache files and pack extractions import_gc evicts, except what the stage uses."""
+    stage = omni.usd.get_context().get_stage()
+    import_dirs = referenced_import_dirs(stage)
+    import_gc.touch(import_dirs)
+    # Unloaded avatars only by their import directory, anything else open by its layers
+    in_use = import_dirs + [layer.realPath for layer in Sdf.Layer.GetLoadedLayers() if layer.realPath]
+    return await asyncio.wrap_future(bake_executor.submit(
+        import_gc.collect,
+        roots,
+        max_age_days,
+        max_total_gb,
+        in_use,
+        dry_run,
+    ))
+
+async def export_avatars(import_ids: Optional[List[str]], output_dir: Optional[str]) -> Dict[str, str]:
+    """Pack imported avatars into USDZ files, all of them when import_ids is None.
+
+    Written to output_dir, or the import directory of each avatar. Returns the files by import id.
+    """
+    from . import usdz_export
+    stage = omni.usd.get_context().get_stage()
+    avatar_prim_paths = find_avatar_prims(stage, None if import_ids is None else set(import_ids))
+    missing = set(import_ids or []) - set(avatar_prim_paths)
+    if missing:
+        raise KeyError(f"No imported avatar with id {', '.join(sorted(missing))} in the stage")
+    futures = {
+        import_id: bake_executor.submit(
+            usdz_export.export_import,
+            import_dir_of(stage, avatar_prim_path),
+            os.path.join(output_dir, f"{import_id}.usdz") if output_dir else None,
+        )
+        for import_id, avatar_prim_path in avatar_prim_paths.items()
+    }
+    usdz_paths = await asyncio.gather(*[asyncio.wrap_future(future) for future in futures.values()])
+    return dict(zip(futures, usdz_paths))
 
 async def import_pack(
     model_path: str,
@@ -103,238 +527,251 @@ async def import_pack(
     available_additional: CADefs.AdditionalElements,
     pack_name: str,
     additional_paths: dict[CADefs.AdditionalElements, dict[str, str] | str],
+    update: bool = False,
+    source_zip: Optional[str] = None,
+    extract_dir: Optional[str] = None,
+    load: bool = True,
+    lod: bool = False,
 ):
+    # Imports of one pack go one at a time until their manifest is written, update mode
+    # edits the latest of them. Waiting for that holds no preparation slot.
+    pack_directory = os.path.dirname(os.path.dirname(
+        os.path.join(extract_dir, model_path) if source_zip is not None else model_path
+    ))
+    async with import_scheduler.scheduler.directory(pack_directory):
+        # Prepared alongside a few other imports
+        async with import_scheduler.scheduler.slot(import_scheduler.PREPARE):
+            manifest, previous_manifest, omni_import_dir = await prepare_import(
+                model_path,
+                obj_name,
+                texture_paths,
+                selected_pack,
+                selected_additional,
+                available_additional,
+                pack_name,
+                additional_paths,
+                update,
+                source_zip,
+                extract_dir,
+                lod,
+            )
+        place_import(manifest, previous_manifest, omni_import_dir, load)
+    try:
+        import_gc.touch([omni_import_dir], source_zip)
+    except OSError as e:
+        carb.log_warn(f"Import {manifest['import_id']} not recorded: {type(e).__name__}: {e}")
+    return manifest["import_id"]
+
+def new_import_dir(omni_directory: str, pack_name: str):
+    """(import id, directory) of a new import, another one made in the same second gets a counter."""
+    os.makedirs(omni_directory, exist_ok=True)
+    base_id = f"{pack_name}_{datetime.now().strftime('%Y%m%d%H%M%S')}"
+    import_unique_id = base_id
+    counter = 0
+    while True:
+        omni_import_dir = os.path.join(omni_directory, import_unique_id)
+        try:
+            # Fails for an existing directory, also one another Kit process just made
+            os.mkdir(omni_import_dir)
+            return import_unique_id, omni_import_dir
+        except FileExistsError:
+            counter += 1
+            import_unique_id = f"{base_id}_{counter:03d}"
+
+async def prepare_import(
+    model_path: str,
+    obj_name: str,
+    texture_paths: dict[str, str],
+    selected_pack: CADefs.PackInfo,
+    selected_additional: CADefs.AdditionalElements,
+    available_additional: CADefs.AdditionalElements,
+    pack_name: str,
+    additional_paths: dict[CADefs.AdditionalElements, dict[str, str] | str],
+    update: bool = False,
+    source_zip: Optional[str] = None,
+    extract_dir: Optional[str] = None,
+    lod: bool = False,
+):
+    """Write the files of an import, returns (manifest, previous manifest, import dir)."""
+    if source_zip is not None:
+        # Paths are zip members, only the files used by this import are extracted
+        model_path, texture_paths, additional_paths = await asyncio.wrap_future(bake_executor.submit(
+            pack_transfer.extract_for_import,
+            source_zip,
+            extract_dir,
+            model_path,
+            texture_paths,
+            additional_paths,
+            selected_additional,
+        ))
+
     # Init
-    import_unique_id = f"{pack_name}_{datetime.now().strftime('%Y%m%d%H%M%S')}"
-    omni_texture_path = os.path.join(
+    omni_directory = os.path.join(
         os.path.dirname(os.path.dirname(model_path)),
         f"Omni_Directory",
-        "Textures",
     )
+    omni_texture_path = os.path.join(omni_directory, "Textures")
 
-    omni_import_dir = os.path.join(
-        os.path.dirname(os.path.dirname(model_path)),
-        f"Omni_Directory",
-        import_unique_id,
-    )
-    os.makedirs(omni_import_dir, exist_ok=True)
+    # Update mode edits the latest import of this pack, if there is one
+    previous_manifest = None
+    if update:
+        previous_import_dir = import_manifest.find_latest_import(omni_directory, pack_name)
+        if previous_import_dir is not None:
+            previous_manifest = import_manifest.read_manifest(previous_import_dir)
+    if previous_manifest is not None:
+        import_unique_id = previous_manifest["import_id"]
+        omni_import_dir = os.path.join(omni_directory, import_unique_id)
+        os.makedirs(omni_import_dir, exist_ok=True)
+    else:
+        import_unique_id, omni_import_dir = new_import_dir(omni_directory, pack_name)
     os.makedirs(omni_texture_path, exist_ok=True)
 
     if model_path.endswith(".fbx"):
-        if DEBUG:
-            new_model_path = os.path.join(omni_import_dir, os.path.basename(model_path).replace(".fbx", ".usda"))
-        else:
-            new_model_path = os.path.join(omni_import_dir, os.path.basename(model_path).replace(".fbx", ".usd"))
-        with tempfile.TemporaryDirectory() as tmp_dir:
-            gltf_path = os.path.join(tmp_dir, "a.gltf")
-            fbx_to_usd.fbx2gltf(model_path, gltf_path)
-            fbx_to_usd.gltf2usd(gltf_path, new_model_path)
-        model_path = new_model_path
-
-    output_usd_path = os.path.join(
-        omni_import_dir,
-        f"main.usd",
-    )
+        # Usually already converted in the background since the pack was opened
+        model_path = await conversion_cache.cache.convert(model_path, converted_suffix())
+    elif model_path.endswith(".obj") and NATIVE_OBJ:
+        from . import obj_to_usd
+        try:
+            model_path = await conversion_cache.cache.convert(model_path, converted_suffix())
+        except obj_to_usd.ObjFormatError as e:
+            carb.log_warn(f"Native obj conversion not possible ({e}), using asset converter instead")
+
+    if previous_manifest is not None:
+        output_usd_path = previous_manifest["main_layer"]
+    else:
+        output_usd_path = os.path.join(
+            omni_import_dir,
+            f"main{converted_suffix()}",
+        )
 
     # For obj, generate mtl files to correctly generate default materials
     if model_path.endswith(".obj"):
         gen_mtl_files(model_path)
 
-    # Create stage & layer
-    main_stage = Usd.Stage.CreateNew(output_usd_path)  
+    # Apply material
+    ## Find materials to apply
+    materials_need_to_apply = materials_to_apply(selected_pack, selected_additional, available_additional)
+    inputs = {
+        material: material_inputs(material, texture_paths, additional_paths)
+        for material in materials_need_to_apply
+    }
+    material_usdc_paths = {
+        material: os.path.join(omni_import_dir, f"{material}.material.usdc")
+        for material in materials_need_to_apply
+    }
+    manifest = import_manifest.build_manifest(
+        import_unique_id,
+        pack_name,
+        model_path,
+        output_usd_path,
+        selected_additional.value,
+        inputs,
+        material_usdc_paths,
+        lod=lod,
+    )
+    if previous_manifest is not None:
+        diff = import_manifest.diff_manifest(previous_manifest, manifest)
+    else:
+        diff = {
+            "materials_added": set(materials_need_to_apply),
+            "materials_removed": set(),
+            "bindings_changed": True,
+        }
+
+    ## Bake needed materials, nothing is authored on the stage yet
+    await bake_materials(
+        {material: inputs[material] for material in diff["materials_added"]},
+        material_usdc_paths,
+        omni_texture_path,
+    )
 
-    # Create new prim(Scope) to hold all imported items
     main_prim_path = Sdf.Path(f"/ChatAvatar_{import_unique_id}")
-    main_prim = main_stage.DefinePrim(main_prim_path, "Xform")
-    main_stage.SetDefaultPrim(main_prim)
-    # Create new prim(Xform) to hold reference
     model_prim_path = main_prim_path.AppendChild("model")
-    model_prim = main_stage.DefinePrim(model_prim_path, "Xform")
-    model_prim.GetReferences().AddReference(model_path)
-
-    # Do scaling
-    if (selected_additional & CADefs.AdditionalElements.RiggedBody):
-        xformable = UsdGeom.Xformable(model_prim)
-        for op in xformable.GetOrderedXformOps():
-            if op.GetOpType() == UsdGeom.XformOp.TypeScale:
-                # 找到现有的缩放操作，更新它的值
-                op.Set(value=(100.0, 100.0, 100.0))
-                break
-    
-    # orientation
-    if (not (selected_additional & CADefs.AdditionalElements.RiggedBody)) and\
-       (model_path.endswith(".usd") or model_path.endswith(".usda")):
-        xformable = UsdGeom.Xformable(model_prim)
-        for op in xformable.GetOrderedXformOps():
-            if op.GetOpType() == UsdGeom.XformOp.TypeOrient:
-                op.Set(value=Gf.Quatf(0.0, 1.0, 0.0, 0.0))
-                break
-
-    # Create new prim(Scope) to hold new materials
     material_scope_prim_path = main_prim_path.AppendChild("Materials")
-    material_scope_prim = main_stage.DefinePrim(material_scope_prim_path, "Scope")
-
-    materials_new = material_usage_summary(model_prim)
-    carb.log_warn(materials_new)
-    # Apply material
-    ## Find materials to apply
-    materials_need_to_apply = set(DEFAULT_MTLS)
-    if selected_pack.topology == CADefs.Topology.MetaHuman:
-        # Only Face is needed
-        pass
-    elif selected_pack.topology == CADefs.Topology.Default:
-        # Backhead
-        if selected_additional & CADefs.AdditionalElements.BackHeadTex:
-            materials_need_to_apply |= set(BACKHEAD_MTLS)
-        # Components
-        if selected_additional & CADefs.AdditionalElements.Components:
-            materials_need_to_apply |= set(COMPONENTS_MTLS)
-        elif (selected_additional & CADefs.AdditionalElements.RiggedBody) and (available_additional & CADefs.AdditionalElements.Components):
-            materials_need_to_apply |= set(COMPONENTS_MTLS)
+    if previous_manifest is not None:
+        # Layer is edited in place, a stage that has it open picks up the changes
+        main_layer = Sdf.Layer.FindOrOpen(output_usd_path)
     else:
-        raise NotImplementedError("Unknown topology!")
+        main_layer = usd_authoring.create_layer(output_usd_path)
+    with Sdf.ChangeBlock():
+        if previous_manifest is None:
+            # Create new prim(Xform) to hold all imported items
+            usd_authoring.define_prim(main_layer, main_prim_path, "Xform")
+            usd_authoring.set_stage_metadata(main_layer, default_prim=main_prim_path.name)
+            # Create new prim(Scope) to hold new materials
+            usd_authoring.define_prim(main_layer, material_scope_prim_path, "Scope")
+        author_materials(main_layer, material_scope_prim_path, material_usdc_paths, diff["materials_removed"])
 
-    ## Import needed materials
-    with tempfile.TemporaryDirectory() as temp_dir:
-        needed_textures = set()
-        # Extract needed materials
-        for material in materials_need_to_apply:
-            temp_material_usda_path = os.path.join(
-                temp_dir,
-                f"{material}.material.usda"
-            )
-            with open(os.path.join(
-                os.path.dirname(__file__),
-                f"resources/Shader/{material}.material.usda"
-            ), "r") as material_f:
-                material_content = material_f.read()
-                new_textures = re.findall(r'@(\{OMNI_TEXTURE_PATH\}/.+)@', material_content)
-                needed_textures.update(new_textures)
-                with open(temp_material_usda_path, "wb") as material_f:
-                    material_f.write(material_content.encode("utf-8"))
-        # Extract needed textures
-        for texture in needed_textures:
-            if os.path.exists(
-                texture.format(OMNI_TEXTURE_PATH=omni_texture_path)
-            ):
-                continue
-            extracted_path = texture.format(OMNI_TEXTURE_PATH=omni_texture_path)
-            os.makedirs(os.path.dirname(extracted_path), exist_ok=True)
-            with open(os.path.join(
-                os.path.dirname(__file__),
-                texture.format(OMNI_TEXTURE_PATH="resources/Texture")
-            ), "rb") as f1:
-                with open(extracted_path, "wb") as f2:
-                    f2.write(f1.read())
-        
-        new_materials = {}
-        for material in materials_need_to_apply:
-            temp_material_usda_path = os.path.join(
-                temp_dir,
-                f"{material}.material.usda"
-            )
-            material_usdc_path = os.path.join(
-                omni_import_dir,
-                f"{material}.material.usdc"
-            )
-            # replace file path
-            with open(temp_material_usda_path, "r+") as material_f:
-                content = material_f.read()
-                material_f.seek(0)
-                content = content.replace("{OMNI_TEXTURE_PATH}", omni_texture_path.replace('\\', '/'))
-                if material == "Backhead":
-                    content = content.replace(
-                        "{BACKHEAD_SPECULAR_PATH}",
-                        additional_paths[CADefs.AdditionalElements.BackHeadTex]["texture_specular"].replace('\\', '/')
-                    )
-                    content = content.replace(
-                        "{BACKHEAD_DIFFUSE_PATH}",
-                        additional_paths[CADefs.AdditionalElements.BackHeadTex]["texture_diffuse"].replace('\\', '/')
-                    )
-                    content = content.replace(
-                        "{BACKHEAD_NORMAL_PATH}",
-                        additional_paths[CADefs.AdditionalElements.BackHeadTex]["texture_normal"].replace('\\', '/')
-                    )
-                elif material == "Face":
-                    content = content.replace(
-                        "{FACE_SPECULAR_PATH}",
-                        texture_paths["texture_specular"].replace('\\', '/')
-                    )
-                    content = content.replace(
-                        "{FACE_DIFFUSE_PATH}",
-                        texture_paths["texture_diffuse"].replace('\\', '/')
-                    )
-                    content = content.replace(
-                        "{FACE_NORMAL_PATH}",
-                        texture_paths["texture_normal"].replace('\\', '/')
-                    )
-                material_f.write(content)
-            
-            temp_stage = Usd.Stage.Open(temp_material_usda_path)
-            temp_stage.Export(material_usdc_path)
-
-            if material == "Eye":
-                left_eye_path = material_scope_prim_path.AppendChild("LeftEye")
-                left_eye_mat_prim = main_stage.DefinePrim(left_eye_path, "Material")
-                left_eye_mat_prim.GetReferences().AddReference(material_usdc_path, f"/Root/{material}")
-
-                right_eye_path = material_scope_prim_path.AppendChild("RightEye")
-                right_eye_mat_prim = main_stage.DefinePrim(right_eye_path, "Material")
-                right_eye_mat_prim.GetReferences().AddReference(material_usdc_path, f"/Root/{material}")
-                
-                new_materials["Eye"] = {
-                    "left": left_eye_mat_prim,
-                    "right": right_eye_mat_prim,
-                }
-            else:
-                material_path = material_scope_prim_path.AppendChild(material)
-                material_prim = main_stage.DefinePrim(material_path, "Material")
-                material_prim.GetReferences().AddReference(material_usdc_path, f"/Root/{material}")
-
-                new_materials[material] = material_prim
-    
-    # For each material, find new material to apply
-    for material_path, material_info in materials_new.items():
-        target_material_key = determine_material_by_slot_name(
-            material_path.name,
+    extent = previous_manifest.get("extent") if previous_manifest is not None else None
+    if diff["bindings_changed"]:
+        extent = author_model(
+            main_layer,
+            model_prim_path,
+            material_scope_prim_path,
+            model_path,
             selected_pack,
             selected_additional,
             available_additional,
-            materials_need_to_apply
+            materials_need_to_apply,
+            lod,
         )
-        if target_material_key is None:
-            continue
-        elif target_material_key["variant"] is None:
-            target_material_prim = new_materials[target_material_key["name"]]
-        else:
-            target_material_prim = new_materials[target_material_key["name"]][target_material_key["variant"]]
-        for target_prim in material_info["users"]:
-            material_binding_api = UsdShade.MaterialBindingAPI.Apply(target_prim)
-            material_binding_api.Bind(UsdShade.Material(target_material_prim))
-    
-    set_subdiv_scheme_and_refinement(model_prim)
 
-    main_stage.Save()
+    main_layer.Save()
+
+    for material in diff["materials_removed"]:
+        old_material_usdc_path = previous_manifest["materials"][material]["layer"]
+        if os.path.exists(old_material_usdc_path):
+            os.remove(old_material_usdc_path)
+
+    manifest["extent"] = extent
+    return manifest, previous_manifest, omni_import_dir
 
-    # Import target
+def place_import(manifest: dict, previous_manifest: Optional[dict], omni_import_dir: str, load: bool = True):
+    """Add a prepared import to the stage, unless the updated import is still in it."""
+    import_unique_id = manifest["import_id"]
+    extent = manifest["extent"]
     context = omni.usd.get_context()
     context_stage = context.get_stage()
-    context_import_prim = context_stage.DefinePrim(
-        context_stage.GetDefaultPrim().GetPath().AppendChild(f"ChatAvatar_{import_unique_id}"),
-        "Xform"
-    )
-    context_import_prim.GetReferences().AddReference(output_usd_path)
+    edit_target = context_stage.GetEditTarget()
+    stage_prim_path = None
+    if previous_manifest is not None and previous_manifest["stage_prim_path"]:
+        stage_prim_path = Sdf.Path(previous_manifest["stage_prim_path"])
+    in_stage = bool(stage_prim_path and context_stage.GetPrimAtPath(stage_prim_path))
+    # Imports older than payloads are referenced as a whole and get no proxy
+    has_proxy = not in_stage or bool(context_stage.GetPrimAtPath(stage_prim_path.AppendChild(AVATAR_PRIM_NAME)))
+    if not in_stage:
+        stage_prim_path = context_stage.GetDefaultPrim().GetPath().AppendChild(f"ChatAvatar_{import_unique_id}")
+        if not load:
+            # Rule is in place before the payload exists, so it is never loaded
+            load_rules = context_stage.GetLoadRules()
+            load_rules.AddRule(stage_prim_path.AppendChild(AVATAR_PRIM_NAME), Usd.StageLoadRules.NoneRule)
+            context_stage.SetLoadRules(load_rules)
+    with Sdf.ChangeBlock():
+        if not in_stage:
+            context_import_prim_spec = usd_authoring.define_prim(
+                edit_target.GetLayer(),
+                edit_target.MapToSpecPath(stage_prim_path),
+                "Xform"
+            )
+            usd_authoring.set_custom_data(context_import_prim_spec, IMPORT_ID_KEY, import_unique_id)
+            # Payload, so avatars can be unloaded and stand in as their proxy box
+            context_payload_prim_spec = usd_authoring.define_prim(
+                edit_target.GetLayer(),
+                edit_target.MapToSpecPath(stage_prim_path.AppendChild(AVATAR_PRIM_NAME)),
+                "Xform"
+            )
+            usd_authoring.add_payload(context_payload_prim_spec, manifest["main_layer"])
+        if extent is not None and has_proxy:
+            author_proxy(edit_target.GetLayer(), edit_target.MapToSpecPath(stage_prim_path), extent)
+    if not in_stage and not load:
+        show_proxies(context_stage, [stage_prim_path], True)
+
+    manifest["stage_prim_path"] = str(stage_prim_path)
+    import_manifest.write_manifest(omni_import_dir, manifest)
 
 def gen_mtl_files(model_path):
-    with open(model_path) as f:
-        lines = f.readlines()
-    current_mtllib = None
-    mtllibs = {} # mtllib: [mtls]
-    for line in lines:
-        if line.startswith("mtllib"):
-            current_mtllib = line.split()[1]
-        if line.startswith("usemtl"):
-            mtllibs.setdefault(current_mtllib, []).append(line.split()[1])
+    from . import obj_to_usd
+    mtllibs = obj_to_usd.scan_materials(model_path) # mtllib: [mtls]
     new_mtl_files = []
     for mtllib, mtls in mtllibs.items():
         mtllib_full_path = os.path.join(os.path.dirname(model_path), mtllib)
@@ -346,22 +783,58 @@ def gen_mtl_files(model_path):
                 print(f"newmtl {mtl}", file=f)
     return new_mtl_files
 
+def holds_geometry(prim):
+    # Typeless prims are plain grouping, e.g. the parents converters define implicitly
+    return not prim.GetTypeName() or (
+        (prim.IsA(UsdGeom.Xformable) or prim.IsA(UsdGeom.Scope)) and not prim.IsA(UsdSkel.Skeleton)
+    )
+
+def iter_meshes(parent_prim):
+    """Mesh prims below parent_prim, without descending into prims that cannot hold geometry."""
+    prim_range = iter(Usd.PrimRange(parent_prim))
+    for prim in prim_range:
+        if prim.IsA(UsdGeom.Mesh):
+            yield prim
+            # Children are subsets and blendshapes
+            prim_range.PruneChildren()
+        elif not holds_geometry(prim):
+            # Materials, shaders and skeleton data
+            prim_range.PruneChildren()
+
 def material_usage_summary(parent_prim):
+    """Direct bindings of meshes, their geom subsets and the Xforms above them, by material path."""
+    # The converters only bind meshes and subsets, blendshapes and skeleton data are skipped
     results = {}
-    for prim in Usd.PrimRange(parent_prim):
-        binding = UsdShade.MaterialBindingAPI(prim).GetDirectBinding()
-        bound_material_prim = binding.GetMaterial()
-        if bound_material_prim:
-            results.setdefault(bound_material_prim.GetPath(), {
-                "material_prim": bound_material_prim,
-                "users": []
-            })["users"].append(prim)
+    prim_range = iter(Usd.PrimRange(parent_prim))
+    for prim in prim_range:
+        if prim.IsA(UsdGeom.Mesh):
+            users = [prim] + [
+                subset.GetPrim() for subset in UsdGeom.Subset.GetAllGeomSubsets(UsdGeom.Imageable(prim))
+            ]
+            prim_range.PruneChildren()
+        elif holds_geometry(prim):
+            users = [prim]
+        else:
+            # Materials, shaders and skeleton animations
+            prim_range.PruneChildren()
+            continue
+        for user in users:
+            binding = UsdShade.MaterialBindingAPI(user).GetDirectBinding()
+            bound_material_prim = binding.GetMaterial()
+            if bound_material_prim:
+                results.setdefault(bound_material_prim.GetPath(), {
+                    "material_prim": bound_material_prim,
+                    "users": []
+                })["users"].append(user)
     return results
 
-def set_subdiv_scheme_and_refinement(parent_prim):
-    for prim in Usd.PrimRange(parent_prim):
-        if prim.IsA(UsdGeom.Mesh):
-            mesh = UsdGeom.Mesh(prim)
-            mesh.GetSubdivisionSchemeAttr().Set(UsdGeom.Tokens.catmullClark)
-            prim.CreateAttribute("refinementEnableOverride", Sdf.ValueTypeNames.Bool).Set(True)
-            prim.CreateAttribute("refinementLevel", Sdf.ValueTypeNames.Int, True).Set(2)
+def set_subdiv_scheme_and_refinement(parent_prim, layer=None, refinement_level=2, spec_path=None):
+    """spec_path maps prim paths to the paths of the specs to author, e.g. in a variant."""
+    # Authored through Sdf so it is safe inside an Sdf.ChangeBlock
+    if layer is None:
+        layer = parent_prim.GetStage().GetEditTarget().GetLayer()
+    for prim in iter_meshes(parent_prim):
+        prim_spec = usd_authoring.over_prim(layer, spec_path(prim.GetPath()) if spec_path else prim.GetPath())
+        usd_authoring.set_attribute(prim_spec, UsdGeom.Tokens.subdivisionScheme, Sdf.ValueTypeNames.Token, UsdGeom.Tokens.catmullClark, uniform=True)
+        usd_authoring.set_attribute(prim_spec, "refinementEnableOverride", Sdf.ValueTypeNames.Bool, True)
+        usd_authoring.set_attribute(prim_spec, "refinementLevel", Sdf.ValueTypeNames.Int, refinement_level)
@@ -0,0 +1,154 @@
+# Packs sent as a whole zip instead of extracted files.
+# The launcher either passes the path of the zip (same filesystem) or streams it
+# to /upload. Only the files an import reads are then extracted, straight into
+# the pack directory the import is generated next to.
+
+from __future__ import annotations
+import os
+import re
+import asyncio
+import hashlib
+import tempfile
+import zipfile
+from datetime import datetime
+from typing import AsyncIterable, Dict, Iterable, Optional, Tuple
+
+from .ChatAvatarPack import defs as CADefs
+from .ChatAvatarPack.utils import str_remove_suffix
+
+# Set by the extension from its settings, temp dir when empty
+UPLOAD_DIRECTORY = ""
+UPLOAD_ID = re.compile(r"^[0-9a-f]{64}$")
+# Largest upload accepted in bytes, set by the extension from its settings, 0 for no limit
+MAX_UPLOAD_SIZE = 0
+
+class UploadTooLarge(Exception):
+    pass
+
+def upload_directory() -> str:
+    return UPLOAD_DIRECTORY or os.path.join(tempfile.gettempdir(), "chatavatar_uploads")
+
+def upload_path(upload_id: str) -> str:
+    if not UPLOAD_ID.match(upload_id):
+        raise ValueError(f"Invalid upload id {upload_id!r}")
+    path = os.path.join(upload_directory(), f"{upload_id}.zip")
+    if not os.path.isfile(path):
+        raise FileNotFoundError(f"No uploaded pack {upload_id}")
+    return path
+
+async def receive_upload(chunks: AsyncIterable[bytes]) -> str:
+    """Store a streamed zip under its sha256, which is returned as upload id."""
+    os.makedirs(upload_directory(), exist_ok=True)
+    digest = hashlib.sha256()
+    size = 0
+    loop = asyncio.get_event_loop()
+    fd, partial_path = tempfile.mkstemp(suffix=".partial", dir=upload_directory())
+    try:
+        with os.fdopen(fd, "wb") as f:
+            async for chunk in chunks:
+                size += len(chunk)
+                if MAX_UPLOAD_SIZE and size > MAX_UPLOAD_SIZE:
+                    raise UploadTooLarge(f"Upload exceeds {MAX_UPLOAD_SIZE} bytes")
+                digest.update(chunk)
+                # Off Kit's event loop, a slow disk must not stall the stage
+                await loop.run_in_executor(None, f.write, chunk)
+        upload_id = digest.hexdigest()
+        # Same content uploaded before, e.g. the pack was opened again
+        os.replace(partial_path, os.path.join(upload_directory(), f"{upload_id}.zip"))
+    except BaseException:
+        os.remove(partial_path)
+        raise
+    return upload_id
+
+def resolve_source(source_zip: Optional[str], upload_id: Optional[str], pack_name: str) -> Tuple[Optional[str], Optional[str]]:
+    """(zip path, directory its files are extracted to), both None for an extracted pack."""
+    # Import directories are named after the pack
+    if os.path.basename(pack_name) != pack_name or pack_name in (".", ".."):
+        raise ValueError(f"Invalid pack name {pack_name!r}")
+    if upload_id:
+        # Named after the validated upload id, the pack name comes from the client
+        return upload_path(upload_id), os.path.join(upload_directory(), upload_id)
+    if source_zip:
+        # Where the launcher extracts in "local" mode, so earlier imports of the pack are found
+        return source_zip, os.path.join(
+            os.path.dirname(source_zip),
+            str_remove_suffix(os.path.basename(source_zip), ".zip"),
+        )
+    return None, None
+
+def _target_path(target_dir: str, member: str) -> str:
+    target_path = os.path.normpath(os.path.join(target_dir, member))
+    if os.path.commonpath([os.path.abspath(target_path), os.path.abspath(target_dir)]) != os.path.abspath(target_dir):
+        raise ValueError(f"Zip member {member!r} is outside of the pack")
+    return target_path
+
+def extract_members(zip_path: str, members: Iterable[str], target_dir: str) -> Dict[str, str]:
+    """Extract members below target_dir, returns {member: path}.
+
+    Files already extracted from the same zip entry are kept, their mtime is the
+    entry's, so conversion cache entries of them stay valid.
+    """
+    results = {}
+    with zipfile.ZipFile(zip_path, "r") as z:
+        for member in members:
+            info = z.getinfo(member)
+            target_path = _target_path(target_dir, member)
+            mtime = datetime(*info.date_time).timestamp()
+            results[member] = target_path
+            try:
+                stat = os.stat(target_path)
+            except OSError:
+                pass
+            else:
+                if stat.st_size == info.file_size and int(stat.st_mtime) == int(mtime):
+                    continue
+            os.makedirs(os.path.dirname(target_path), exist_ok=True)
+            # Unique partial file, an import and a pre-conversion may extract the same member
+            fd, partial_path = tempfile.mkstemp(suffix=".partial", dir=os.path.dirname(target_path))
+            try:
+                with os.fdopen(fd, "wb") as f, z.open(info) as source:
+                    while True:
+                        chunk = source.read(1 << 20)
+                        if not chunk:
+                            break
+                        f.write(chunk)
+                os.utime(partial_path, (mtime, mtime))
+                os.replace(partial_path, target_path)
+            except BaseException:
+                if os.path.exists(partial_path):
+                    os.remove(partial_path)
+                raise
+    return results
+
+def extract_for_import(
+    zip_path: str,
+    target_dir: str,
+    model_path: str,
+    texture_paths: dict[str, str],
+    additional_paths: dict[CADefs.AdditionalElements, dict[str, str] | str],
+    selected_additional: CADefs.AdditionalElements,
+):
+    """Extract what one import reads and map its member names to file paths."""
+    needed = {model_path, *texture_paths.values()}
+    if model_path.endswith(".obj"):
+        # Material libraries next to the obj, missing ones are generated
+        with zipfile.ZipFile(zip_path, "r") as z:
+            model_dir = os.path.dirname(model_path)
+            needed.update(
+                name for name in z.namelist()
+                if name.endswith(".mtl") and os.path.dirname(name) == model_dir
+            )
+    if selected_additional & CADefs.AdditionalElements.BackHeadTex:
+        needed.update(additional_paths[CADefs.AdditionalElements.BackHeadTex].values())
+    extracted = extract_members(zip_path, sorted(needed), target_dir)
+
+    def local(member):
+        return extracted.get(member) or _target_path(target_dir, member)
+    return (
+        local(model_path),
+        {key: local(value) for key, value in texture_paths.items()},
+        {
+            key: {kind: local(path) for kind, path in value.items()} if isinstance(value, dict) else local(value)
+            for key, value in additional_paths.items()
+        },
+    )
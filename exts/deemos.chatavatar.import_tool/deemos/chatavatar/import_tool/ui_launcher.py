@@ -1,50 +1,169 @@
 import sys
+import hashlib
+import threading
 from PySide6.QtWidgets import QApplication
 import Load_UI, web_funcs
+from ChatAvatarPack.utils import process_alive
 import argparse
 
-from PySide6.QtNetwork import QNetworkAccessManager, QNetworkRequest, QNetworkReply
-from PySide6.QtCore import QUrl, QObject, Signal, QTimer
+from PySide6.QtNetwork import QLocalServer, QLocalSocket
+from PySide6.QtCore import QObject, Signal, QTimer
 
-class Pinger(QObject):
-    requestFinished = Signal(bool)  # 发送请求是否成功的信号
+# Parent process checks, the launcher quits after this many failed checks in a row
+PARENT_CHECK_INTERVAL_MS = 2000
+PARENT_MISSED_CHECKS_TOLERATED = 2
 
-    def __init__(self, url, parent=None):
-        super(Pinger, self).__init__(parent)
-        self.url = url
-        self.network_manager = QNetworkAccessManager(self)
-        self.network_manager.finished.connect(self.onRequestFinished)
+class CommandReader(QObject):
+    """Reads commands sent by the extension to a resident launcher, one per stdin line.
 
-    def send_ping(self):
-        req = QNetworkRequest(QUrl(self.url + "/ping"), transferTimeout=900)
-        self.network_manager.get(req)
+    stdin is a pipe from Kit, its end (closed) also means Kit is gone.
+    """
+    commandReceived = Signal(str)
+    closed = Signal()
 
-    def onRequestFinished(self, reply):
-        if reply.error() != QNetworkReply.NoError:
-            self.requestFinished.emit(False)
-        else:
-            self.requestFinished.emit(True)
+    def start(self):
+        threading.Thread(target=self.run, daemon=True).start()
 
+    def run(self):
+        for line in sys.stdin:
+            command = line.strip()
+            if command:
+                self.commandReceived.emit(command)
+        self.closed.emit()
+
+class ParentWatcher(QObject):
+    """Emits parentGone once the parent process has been found dead on consecutive checks."""
+    parentGone = Signal()
+
+    def __init__(self, pid, parent=None):
+        super(ParentWatcher, self).__init__(parent)
+        self.pid = pid
+        self.missed_checks = 0
+        self.timer = QTimer(self)
+        self.timer.timeout.connect(self.check)
+
+    def start(self):
+        self.timer.start(PARENT_CHECK_INTERVAL_MS)
+
+    def check(self):
+        if process_alive(self.pid):
+            self.missed_checks = 0
+            return
+        self.missed_checks += 1
+        if self.missed_checks > PARENT_MISSED_CHECKS_TOLERATED:
+            self.timer.stop()
+            self.parentGone.emit()
+
+class CommandServer(QObject):
+    """Single instance channel, later launcher invocations hand their commands over and exit."""
+    commandReceived = Signal(str)
+
+    def __init__(self, server_name, parent=None):
+        super(CommandServer, self).__init__(parent)
+        self.server_name = server_name
+        self.server = QLocalServer(self)
+        self.server.newConnection.connect(self.on_new_connection)
+
+    def listen(self):
+        # Only take over a name left behind by a launcher that crashed, not one that is busy
+        if not self.server.listen(self.server_name) and server_left_behind(self.server_name):
+            QLocalServer.removeServer(self.server_name)
+            self.server.listen(self.server_name)
+
+    def on_new_connection(self):
+        while self.server.hasPendingConnections():
+            socket = self.server.nextPendingConnection()
+            socket.readyRead.connect(lambda socket=socket: self.read_commands(socket))
+            socket.disconnected.connect(lambda socket=socket: self.read_commands(socket))
+            socket.disconnected.connect(socket.deleteLater)
+            self.read_commands(socket)
+
+    def read_commands(self, socket):
+        while socket.canReadLine():
+            command = bytes(socket.readLine()).decode("utf-8").strip()
+            if command:
+                self.commandReceived.emit(command)
+
+def instance_server_name(url):
+    # One launcher per Kit instance, told apart by their server url
+    return f"chatavatar_import_tool_{hashlib.sha1(url.encode()).hexdigest()[:12]}"
+
+def server_left_behind(server_name):
+    socket = QLocalSocket()
+    socket.connectToServer(server_name)
+    if socket.waitForConnected(500):
+        socket.disconnectFromServer()
+        return False
+    return socket.error() in (
+        QLocalSocket.LocalSocketError.ServerNotFoundError,
+        QLocalSocket.LocalSocketError.ConnectionRefusedError,
+    )
+
+def send_to_running_instance(server_name, commands):
+    socket = QLocalSocket()
+    socket.connectToServer(server_name)
+    if not socket.waitForConnected(500):
+        return False
+    for command in commands:
+        socket.write(f"{command}\n".encode("utf-8"))
+    socket.waitForBytesWritten(1000)
+    socket.disconnectFromServer()
+    return True
+
+def handle_command(app, window, command):
+    name, _, argument = command.partition(" ")
+    if name == "show":
+        window.showNormal()
+        window.raise_()
+        window.activateWindow()
+    elif name == "open" and argument:
+        handle_command(app, window, "show")
+        window.open_zip(argument)
+    elif name == "quit":
+        app.quit()
 
 def parse_args():
     parser = argparse.ArgumentParser(description='Process host and port.')
     parser.add_argument('--url', required=True, type=str, help='Request url')
+    parser.add_argument('--resident', action='store_true', help='Hide instead of exiting when the window is closed, take commands from stdin')
+    parser.add_argument('--hidden', action='store_true', help='Start without showing the window, until a "show" command')
+    parser.add_argument('--open', type=str, help='Zip file of a pack to open')
+    parser.add_argument('--parent-pid', type=int, help='Quit once this process (Kit) has exited')
+    parser.add_argument('--unpack', choices=['local', 'temp', 'memory', 'zip'], default='local', help='Where packs are extracted, "zip" leaves extraction to Kit')
     
     args = parser.parse_args()
     return args
 
 def main(args):
-    web_op_handler = web_funcs.WebFuncs(url=args.url)
-    pinger = Pinger(url=args.url)
-    pinger.requestFinished.connect(lambda success: app.quit() if not success else None)
-
     app = QApplication(sys.argv)
-    window = Load_UI.CustomWindow(web_op_handler, "local")
-    window.show()
 
-    timer = QTimer()
-    timer.timeout.connect(pinger.send_ping)
-    timer.start(1000)
+    # Reuse the window of a running launcher if there is one
+    commands = [] if args.hidden else ["show"]
+    if args.open:
+        commands.append(f"open {args.open}")
+    server_name = instance_server_name(args.url)
+    if send_to_running_instance(server_name, commands):
+        sys.exit(0)
+
+    web_op_handler = web_funcs.WebFuncs(url=args.url)
+
+    window = Load_UI.CustomWindow(web_op_handler, args.unpack, resident=args.resident)
+    command_server = CommandServer(server_name)
+    command_server.commandReceived.connect(lambda command: handle_command(app, window, command))
+    command_server.listen()
+    if args.resident:
+        app.setQuitOnLastWindowClosed(False)
+        command_reader = CommandReader()
+        command_reader.commandReceived.connect(lambda command: handle_command(app, window, command))
+        command_reader.closed.connect(app.quit)
+        command_reader.start()
+    # No polling of the server, a busy Kit must not close the window
+    if args.parent_pid:
+        parent_watcher = ParentWatcher(args.parent_pid)
+        parent_watcher.parentGone.connect(app.quit)
+        parent_watcher.start()
+    for command in commands:
+        handle_command(app, window, command)
 
     sys.exit(app.exec())
 
@@ -0,0 +1,119 @@
+# Thin helpers to author layers directly through the Sdf API.
+# Authoring specs inside one Sdf.ChangeBlock sends a single change notification
+# for the whole batch, instead of one per prim/attribute as with the Usd API.
+
+import numpy as np
+from pxr import Sdf, Vt
+
+def layer_format_args(path):
+    # ".usd" would follow USD_DEFAULT_FILE_FORMAT, always ask for crate
+    if path.endswith(".usd"):
+        return {"format": "usdc"}
+    return {}
+
+def create_layer(path):
+    # CreateNew refuses identifiers that are still held in the layer registry
+    layer = Sdf.Layer.Find(path)
+    if layer is not None:
+        layer.Clear()
+        return layer
+    return Sdf.Layer.CreateNew(path, args=layer_format_args(path))
+
+def set_stage_metadata(layer, default_prim=None, meters_per_unit=None, up_axis=None, time_codes_per_second=None, time_code_range=None):
+    if time_codes_per_second is not None:
+        layer.timeCodesPerSecond = time_codes_per_second
+        layer.framesPerSecond = time_codes_per_second
+    if time_code_range is not None:
+        layer.startTimeCode, layer.endTimeCode = map(float, time_code_range)
+    if default_prim is not None:
+        layer.defaultPrim = default_prim
+    if meters_per_unit is not None:
+        layer.pseudoRoot.SetInfo("metersPerUnit", meters_per_unit)
+    if up_axis is not None:
+        layer.pseudoRoot.SetInfo("upAxis", up_axis)
+
+def define_prim(layer, path, type_name="", specifier=Sdf.SpecifierDef):
+    prim_spec = Sdf.CreatePrimInLayer(layer, path)
+    prim_spec.specifier = specifier
+    if type_name:
+        prim_spec.typeName = type_name
+    return prim_spec
+
+def over_prim(layer, path):
+    """Existing spec at path, or a new over (ancestors included)."""
+    return layer.GetPrimAtPath(path) or Sdf.CreatePrimInLayer(layer, path)
+
+def remove_prim(layer, path):
+    prim_spec = layer.GetPrimAtPath(path)
+    if prim_spec:
+        del layer.GetPrimAtPath(prim_spec.path.GetParentPath()).nameChildren[prim_spec.name]
+
+def set_attribute(prim_spec, name, type_name, value=None, uniform=False, **info):
+    attr_spec = prim_spec.attributes.get(name)
+    if attr_spec is None:
+        attr_spec = Sdf.AttributeSpec(
+            prim_spec,
+            name,
+            type_name,
+            Sdf.VariabilityUniform if uniform else Sdf.VariabilityVarying,
+        )
+    if value is not None:
+        attr_spec.default = value
+    for key, info_value in info.items():
+        attr_spec.SetInfo(key, info_value)
+    return attr_spec
+
+def set_time_samples(prim_spec, name, type_name, times, values):
+    """Time samples from an array with one row per time, one array conversion per sample."""
+    attr_spec = set_attribute(prim_spec, name, type_name)
+    array_type = type_name.type.pythonClass
+    layer = prim_spec.layer
+    for time, value in zip(times.tolist(), values):
+        layer.SetTimeSample(attr_spec.path, time, array_type.FromNumpy(np.ascontiguousarray(value)))
+    return attr_spec
+
+def set_custom_data(prim_spec, key, value):
+    custom_data = dict(prim_spec.GetInfo("customData"))
+    custom_data[key] = value
+    prim_spec.SetInfo("customData", custom_data)
+
+def set_relationship(prim_spec, name, targets):
+    rel_spec = prim_spec.relationships.get(name)
+    if rel_spec is None:
+        rel_spec = Sdf.RelationshipSpec(prim_spec, name, custom=False)
+    rel_spec.targetPathList.explicitItems = [Sdf.Path(str(target)) for target in targets]
+    return rel_spec
+
+def apply_api_schemas(prim_spec, schema_names):
+    list_op = prim_spec.GetInfo("apiSchemas")
+    prepended = list(list_op.prependedItems)
+    for schema_name in schema_names:
+        if schema_name not in prepended:
+            prepended.append(schema_name)
+    prim_spec.SetInfo("apiSchemas", Sdf.TokenListOp.Create(prependedItems=prepended))
+
+def bind_material(layer, prim_path, material_path):
+    prim_spec = over_prim(layer, prim_path)
+    apply_api_schemas(prim_spec, ["MaterialBindingAPI"])
+    set_relationship(prim_spec, "material:binding", [material_path])
+
+def add_reference(prim_spec, asset_path, prim_path=None):
+    reference = Sdf.Reference(asset_path, Sdf.Path(prim_path) if prim_path else Sdf.Path())
+    prim_spec.referenceList.Prepend(reference)
+
+def add_payload(prim_spec, asset_path, prim_path=None):
+    payload = Sdf.Payload(asset_path, Sdf.Path(prim_path) if prim_path else Sdf.Path())
+    prim_spec.payloadList.Prepend(payload)
+
+def set_xform_ops(prim_spec, translate, orient, scale):
+    """Author float precision translate/orient/scale ops, orient as a Gf.Quatf."""
+    set_attribute(prim_spec, "xformOp:translate", Sdf.ValueTypeNames.Float3, translate)
+    set_attribute(prim_spec, "xformOp:orient", Sdf.ValueTypeNames.Quatf, orient)
+    set_attribute(prim_spec, "xformOp:scale", Sdf.ValueTypeNames.Float3, scale)
+    set_attribute(
+        prim_spec,
+        "xformOpOrder",
+        Sdf.ValueTypeNames.TokenArray,
+        Vt.TokenArray(["xformOp:translate", "xformOp:orient", "xformOp:scale"]),
+        uniform=True,
+    )
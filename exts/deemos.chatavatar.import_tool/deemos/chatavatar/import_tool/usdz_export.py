@@ -0,0 +1,147 @@
+# Imports packed into single USDZ files, to move avatars to another machine.
+# The import is flattened into one crate layer, the files its asset paths point to
+# are stored next to it once per content. Entries are stored uncompressed with
+# their data 64-byte aligned as USDZ requires, so USD can memory-map the package.
+
+from __future__ import annotations
+import os
+import struct
+import hashlib
+import tempfile
+import zipfile
+from typing import Dict, Optional
+
+from pxr import Sdf, Usd
+
+from . import import_manifest
+
+ALIGNMENT = 64
+# Extra field holding the alignment padding, the id USD's own writer uses
+PADDING_HEADER_ID = 0x1986
+ASSET_DIRECTORY = "assets"
+CHUNK_SIZE = 1 << 20
+
+class AlignedZipWriter:
+    """Writes ZIP_STORED entries whose data starts at a multiple of ALIGNMENT."""
+    def __init__(self, path: str):
+        self._zip = zipfile.ZipFile(path, "w", zipfile.ZIP_STORED)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        self._zip.close()
+
+    def write_file(self, name: str, source_path: str):
+        """Stream source_path into the entry name."""
+        info = zipfile.ZipInfo(name)
+        info.compress_type = zipfile.ZIP_STORED
+        info.file_size = os.path.getsize(source_path)
+        # Local file header is 30 bytes, then the name and the extra field
+        data_offset = self._zip.fp.tell() + 30 + len(name.encode("utf-8")) + 4
+        padding = -data_offset % ALIGNMENT
+        info.extra = struct.pack("<HH", PADDING_HEADER_ID, padding) + bytes(padding)
+        with open(source_path, "rb") as source, self._zip.open(info, "w") as target:
+            while True:
+                chunk = source.read(CHUNK_SIZE)
+                if not chunk:
+                    break
+                target.write(chunk)
+
+def file_digest(path: str) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        while True:
+            chunk = f.read(CHUNK_SIZE)
+            if not chunk:
+                break
+            digest.update(chunk)
+    return digest.hexdigest()
+
+class _AssetCollector:
+    """Points asset paths of a layer into the package, {entry name: file} of what has to be stored."""
+    def __init__(self):
+        self.files: Dict[str, str] = {}
+        self._names_by_path: Dict[str, str] = {}
+        self._names_by_digest: Dict[str, str] = {}
+
+    def entry_name(self, path: str) -> Optional[str]:
+        if not path or not os.path.isfile(path):
+            # MDL modules and the like, found through search paths
+            return None
+        path = os.path.normpath(path)
+        if path in self._names_by_path:
+            return self._names_by_path[path]
+        digest = file_digest(path)
+        name = self._names_by_digest.get(digest)
+        if name is None:
+            name = f"{ASSET_DIRECTORY}/{os.path.basename(path)}"
+            if name in self.files:
+                name = f"{ASSET_DIRECTORY}/{digest[:12]}_{os.path.basename(path)}"
+            self._names_by_digest[digest] = name
+            self.files[name] = path
+        self._names_by_path[path] = name
+        return name
+
+    def repath(self, asset_path: Sdf.AssetPath) -> Sdf.AssetPath:
+        name = self.entry_name(asset_path.resolvedPath or asset_path.path)
+        return Sdf.AssetPath(f"./{name}") if name is not None else asset_path
+
+    def repath_value(self, value):
+        if isinstance(value, Sdf.AssetPath):
+            return self.repath(value)
+        return Sdf.AssetPathArray([self.repath(asset_path) for asset_path in value])
+
+    def collect(self, layer: Sdf.Layer):
+        asset_types = (Sdf.ValueTypeNames.Asset, Sdf.ValueTypeNames.AssetArray)
+        def visit(path: Sdf.Path):
+            if not path.IsPropertyPath():
+                return
+            attr_spec = layer.GetAttributeAtPath(path)
+            if attr_spec is None or attr_spec.typeName not in asset_types:
+                return
+            if attr_spec.HasDefaultValue():
+                attr_spec.default = self.repath_value(attr_spec.default)
+            for time in layer.ListTimeSamplesForPath(path):
+                layer.SetTimeSample(path, time, self.repath_value(layer.QueryTimeSample(path, time)))
+        with Sdf.ChangeBlock():
+            layer.Traverse(Sdf.Path.absoluteRootPath, visit)
+
+def export_import(import_dir: str, usdz_path: Optional[str] = None) -> str:
+    """Pack the import in import_dir into usdz_path, <import id>.usdz in import_dir by default.
+
+    The current variant selections, e.g. the LOD, are what gets flattened.
+    """
+    manifest = import_manifest.read_manifest(import_dir)
+    if manifest is None:
+        raise FileNotFoundError(f"No import in {import_dir}")
+    if usdz_path is None:
+        usdz_path = os.path.join(import_dir, f"{manifest['import_id']}.usdz")
+
+    stage = Usd.Stage.Open(manifest["main_layer"], Usd.Stage.LoadAll)
+    # Asset paths come out anchored, i.e. absolute
+    layer = stage.Flatten()
+    collector = _AssetCollector()
+    collector.collect(layer)
+
+    os.makedirs(os.path.dirname(os.path.abspath(usdz_path)), exist_ok=True)
+    partial_path = f"{usdz_path}.partial"
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        root_layer_name = f"{manifest['import_id']}.usdc"
+        root_layer_path = os.path.join(tmp_dir, root_layer_name)
+        layer.Export(root_layer_path)
+        try:
+            with AlignedZipWriter(partial_path) as writer:
+                # The root layer has to be the first entry
+                writer.write_file(root_layer_name, root_layer_path)
+                for name, source_path in collector.files.items():
+                    writer.write_file(name, source_path)
+            os.replace(partial_path, usdz_path)
+        except BaseException:
+            if os.path.exists(partial_path):
+                os.remove(partial_path)
+            raise
+    return usdz_path
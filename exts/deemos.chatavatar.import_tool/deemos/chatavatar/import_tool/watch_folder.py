@@ -0,0 +1,258 @@
+# Watch folders: pack zips dropped into configured directories are imported
+# without the launcher, with a preset of the folder instead of the user's picks.
+# Directories are watched through inotify on Linux and polled otherwise. A zip
+# is imported once its size and mtime stayed the same for SETTLE_S, what became
+# of it is recorded in the folder so it is not imported again after a restart.
+
+from __future__ import annotations
+import os
+import json
+import time
+import ctypes
+import ctypes.util
+import struct
+import asyncio
+from dataclasses import dataclass, replace
+from typing import Dict, List, Optional, Set, Tuple
+
+import carb
+
+from .ChatAvatarPack import defs as CADefs
+from .ChatAvatarPack.pack import Pack
+from . import import_scheduler, omni_funcs, pack_transfer
+
+STATE_NAME = ".chatavatar_watch.json"
+SETTLE_S = 2.0
+POLL_INTERVAL_S = 2.0
+# Wait before submitting again when the import queue is full
+BUSY_RETRY_S = 2.0
+# inotify(7)
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_Q_OVERFLOW = 0x00004000
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+INOTIFY_EVENT = struct.Struct("iIII")
+
+@dataclass(frozen=True)
+class Preset:
+    """What is imported from the packs of a folder."""
+    pack_info: CADefs.PackInfo = CADefs.PackInfo(CADefs.TextureResolution.TwoK, CADefs.Topology.Default)
+    # None for every additional element the pack has
+    additional: Optional[CADefs.AdditionalElements] = None
+    load: bool = False
+    lod: bool = False
+    # USDZ files of the imports are written there when set
+    output_dir: str = ""
+
+def preset_from_settings(entry: dict, default: Preset = Preset()) -> Preset:
+    """Preset of a watch_folders entry, fields it leaves out are the ones of default."""
+    preset = default
+    if "resolution" in entry or "topology" in entry:
+        preset = replace(preset, pack_info=CADefs.PackInfo(
+            CADefs.TextureResolution(int(entry.get("resolution", preset.pack_info.resolution.value))),
+            CADefs.Topology(entry.get("topology", preset.pack_info.topology.value)),
+        ))
+    if "additional" in entry:
+        elements = {element.friendly_name: element for element in CADefs.AdditionalElements.__members__.values()}
+        additional = CADefs.AdditionalElements.Nothing
+        for name in entry["additional"]:
+            additional |= elements[name]
+        preset = replace(preset, additional=additional)
+    for key in ("load", "lod", "output_dir"):
+        if key in entry:
+            preset = replace(preset, **{key: type(getattr(preset, key))(entry[key])})
+    return preset
+
+class _Inotify:
+    """Calls on_change(path) for files written or moved into directories, Linux only."""
+    def __init__(self, directories: List[str], on_change, on_overflow):
+        libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        self._on_change = on_change
+        self._on_overflow = on_overflow
+        self._fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self._fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        self._directories: Dict[int, str] = {}
+        try:
+            for directory in directories:
+                wd = libc.inotify_add_watch(self._fd, os.fsencode(directory), IN_CLOSE_WRITE | IN_MOVED_TO)
+                if wd < 0:
+                    raise OSError(ctypes.get_errno(), f"Cannot watch {directory}")
+                self._directories[wd] = directory
+            self._loop = asyncio.get_event_loop()
+            self._loop.add_reader(self._fd, self._read)
+        except BaseException:
+            os.close(self._fd)
+            raise
+
+    def _read(self):
+        try:
+            data = os.read(self._fd, 64 * 1024)
+        except BlockingIOError:
+            return
+        offset = 0
+        while offset < len(data):
+            wd, mask, _, name_length = INOTIFY_EVENT.unpack_from(data, offset)
+            offset += INOTIFY_EVENT.size
+            name = data[offset:offset + name_length].rstrip(b"\0")
+            offset += name_length
+            if mask & IN_Q_OVERFLOW:
+                # Events were dropped, e.g. in a burst of copies
+                self._on_overflow()
+            elif wd in self._directories and name:
+                self._on_change(os.path.join(self._directories[wd], os.fsdecode(name)))
+
+    def close(self):
+        self._loop.remove_reader(self._fd)
+        os.close(self._fd)
+
+class WatchFolders:
+    """Imports the pack zips showing up in folders, max_workers at a time."""
+    def __init__(self, folders: Dict[str, Preset], max_workers: int = import_scheduler.MAX_PREPARING):
+        self.folders = {os.path.abspath(directory): preset for directory, preset in folders.items()}
+        self.max_workers = max_workers
+        # Path: ((size, mtime), time it was first seen with them)
+        self._candidates: Dict[str, Tuple[Tuple[int, int], float]] = {}
+        self._queued: Set[str] = set()
+        self._queue: asyncio.Queue = asyncio.Queue()
+        self._states: Dict[str, dict] = {}
+        self._inotify: Optional[_Inotify] = None
+        self._tasks: List[asyncio.Future] = []
+
+    def start(self):
+        for directory in self.folders:
+            os.makedirs(directory, exist_ok=True)
+            self._states[directory] = self._read_state(directory)
+        try:
+            self._inotify = _Inotify(list(self.folders), self._changed, self.scan)
+        except (OSError, AttributeError, TypeError, NotImplementedError) as e:
+            carb.log_info(f"Polling watch folders every {POLL_INTERVAL_S}s: {e}")
+        self._tasks = [asyncio.ensure_future(self._settle_loop())] + [
+            asyncio.ensure_future(self._worker()) for _ in range(self.max_workers)
+        ]
+
+    def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        self._tasks = []
+        if self._inotify is not None:
+            self._inotify.close()
+            self._inotify = None
+
+    def scan(self):
+        for directory in self.folders:
+            with os.scandir(directory) as entries:
+                for entry in entries:
+                    if entry.is_file():
+                        self._changed(entry.path)
+
+    def _read_state(self, directory: str) -> dict:
+        try:
+            with open(os.path.join(directory, STATE_NAME), "r") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def _record(self, path: str, signature: Tuple[int, int], result: dict):
+        directory, name = os.path.split(path)
+        state = self._states[directory]
+        state[name] = {"size": signature[0], "mtime_ns": signature[1], **result}
+        state_path = os.path.join(directory, STATE_NAME)
+        with open(f"{state_path}.partial", "w") as f:
+            json.dump(state, f, indent=1)
+        os.replace(f"{state_path}.partial", state_path)
+
+    def _changed(self, path: str):
+        if not path.lower().endswith(".zip") or path in self._queued:
+            return
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            self._candidates.pop(path, None)
+            return
+        signature = (stat.st_size, stat.st_mtime_ns)
+        recorded = self._states[os.path.dirname(path)].get(os.path.basename(path))
+        if recorded is not None and (recorded["size"], recorded["mtime_ns"]) == signature:
+            return
+        candidate = self._candidates.get(path)
+        if candidate is None or candidate[0] != signature:
+            self._candidates[path] = (signature, time.monotonic())
+
+    async def _settle_loop(self):
+        self.scan()
+        while True:
+            await asyncio.sleep(POLL_INTERVAL_S if self._inotify is None else SETTLE_S / 2)
+            if self._inotify is None:
+                self.scan()
+            else:
+                # Only the zips still being written have to be looked at again
+                for path in list(self._candidates):
+                    self._changed(path)
+            now = time.monotonic()
+            for path, (_, since) in list(self._candidates.items()):
+                if now - since >= SETTLE_S:
+                    del self._candidates[path]
+                    self._queued.add(path)
+                    self._queue.put_nowait(path)
+
+    async def _worker(self):
+        while True:
+            path = await self._queue.get()
+            try:
+                stat = os.stat(path)
+                signature = (stat.st_size, stat.st_mtime_ns)
+                try:
+                    result = await self._import(path)
+                except (asyncio.CancelledError, FileNotFoundError):
+                    raise
+                except Exception as e:
+                    carb.log_error(f"Import of {path} from a watch folder failed: {type(e).__name__}: {e}")
+                    result = {"error": f"{type(e).__name__}: {e}"}
+                # A zip changed meanwhile is looked at again, _changed skips queued zips
+                self._record(path, signature, result)
+                self._queued.discard(path)
+                self._changed(path)
+            except FileNotFoundError:
+                pass
+            finally:
+                self._queued.discard(path)
+
+    async def _import(self, path: str) -> dict:
+        preset = self.folders[os.path.dirname(path)]
+        # Opening the pack reads the zip directory, off the event loop
+        pack = await asyncio.wrap_future(omni_funcs.bake_executor.submit(Pack, path, "zip"))
+        if preset.pack_info not in pack.available_packs:
+            raise CADefs.InvalidPack(f"No {CADefs.generate_pack_name(preset.pack_info)} in the pack")
+        selected_additional = pack.additional_elements
+        if preset.additional is not None:
+            selected_additional &= preset.additional
+        model_path, obj_name, texture_paths, additional_paths = pack.import_selection(preset.pack_info, selected_additional)
+        source_zip, extract_dir = pack_transfer.resolve_source(path, None, pack.pack_name)
+        key = ("watch_folder", path)
+        while True:
+            try:
+                future = import_scheduler.scheduler.submit(key, lambda: omni_funcs.import_pack(
+                    model_path=model_path,
+                    obj_name=obj_name,
+                    texture_paths=texture_paths,
+                    selected_pack=preset.pack_info,
+                    selected_additional=selected_additional,
+                    available_additional=pack.additional_elements,
+                    pack_name=pack.pack_name,
+                    additional_paths=additional_paths,
+                    source_zip=source_zip,
+                    extract_dir=extract_dir,
+                    load=preset.load,
+                    lod=preset.lod,
+                ))
+                break
+            except import_scheduler.QueueFull:
+                await asyncio.sleep(BUSY_RETRY_S)
+        import_id = await future
+        carb.log_info(f"Imported {path} from a watch folder as {import_id}")
+        result = {"import_id": import_id}
+        if preset.output_dir:
+            usdz_paths = await omni_funcs.export_avatars([import_id], preset.output_dir)
+            result["usdz_path"] = usdz_paths[import_id]
+        return result
@@ -3,36 +3,189 @@ from PySide6.QtWidgets import QMessageBox
 import json
 from ChatAvatarPack import defs as CADefs
 
-from http.client import HTTPConnection, HTTPSConnection
-from urllib.parse import urlparse
+from collections import deque
+from PySide6.QtCore import QObject, QUrl, QByteArray, QFile, QIODevice, QTimer, Signal
+from PySide6.QtNetwork import QNetworkAccessManager, QNetworkRequest, QNetworkReply
 
-class HTTPConnectionContextManager:
-    def __init__(self, host, port=None):
-        self.conn = HTTPConnection(host, port)
+# Transfer timeouts in ms, reset whenever data moves. 0 disables it: an import
+# gets no reply until the server is done, however long that takes.
+DEFAULT_TIMEOUT_MS = 10000
+IMPORT_TIMEOUT_MS = 0
+# Errors after which a request that is safe to repeat is sent once more,
+# e.g. a pooled keep-alive connection the server has already closed
+RETRY_ERRORS = frozenset([
+    QNetworkReply.RemoteHostClosedError,
+    QNetworkReply.TemporaryNetworkFailureError,
+    QNetworkReply.OperationCanceledError,
+    QNetworkReply.TimeoutError, # transfer timeout
+])
+# Times a request refused with 429 (import queue of the server full) is sent again,
+# after the delay the server asks for
+BUSY_RETRIES = 60
+LOOPBACK_HOSTS = frozenset(["localhost", "127.0.0.1", "::1"])
 
-    def __enter__(self):
-        return self.conn
+def reply_json(reply):
+    if reply.error() != QNetworkReply.NoError:
+        return None
+    try:
+        return json.loads(bytes(reply.readAll()).decode())
+    except ValueError:
+        return None
 
-    def __exit__(self, exc_type, exc_val, exc_tb):
-        self.conn.close()
+class WebFuncs(QObject):
+    """Talks to the extension's server without blocking the Qt event loop.
 
-class HTTPSConnectionContextManager:
-    def __init__(self, host, port=None):
-        self.conn = HTTPSConnection(host, port)
+    QNetworkAccessManager keeps connections to the server alive and reuses them
+    (TLS sessions included) for every request of the session.
+    Imports are queued and sent one at a time, the stage is edited by one import at a time anyway.
+    Packs opened in "zip" mode are passed to the server as their zip path, or uploaded
+    once if the server runs on another machine.
+    """
+    importStarted = Signal(dict)         # import job
+    importFinished = Signal(dict, dict)  # import job, response body
+    queueChanged = Signal(int)           # number of imports not finished yet
 
-    def __enter__(self):
-        return self.conn
+    def __init__(self, url, parent=None, upload=None):
+        super(WebFuncs, self).__init__(parent)
+        self.url = url.rstrip("/")
+        self.upload = upload if upload is not None else QUrl(self.url).host() not in LOOPBACK_HOSTS
+        # Zip path: {"upload_id", "error", "callbacks"}, callbacks only while the upload runs
+        self.uploads = {}
+        self.network_manager = QNetworkAccessManager(self)
+        self.import_queue = deque()
+        self.current_import = None
+        self.response_body = None
+        self.connect_ahead()
 
-    def __exit__(self, exc_type, exc_val, exc_tb):
-        self.conn.close()
+    def connect_ahead(self):
+        """Open the pooled connection (and TLS handshake) before the first request needs it."""
+        parsed_url = QUrl(self.url)
+        if parsed_url.scheme() == "https":
+            self.network_manager.connectToHostEncrypted(parsed_url.host(), parsed_url.port(443))
+        else:
+            self.network_manager.connectToHost(parsed_url.host(), parsed_url.port(80))
+
+    def post_json(self, path, payload, callback=None, timeout_ms=DEFAULT_TIMEOUT_MS, retries=0, busy_retries=BUSY_RETRIES):
+        """callback(reply, body) once finished, body is None when the request failed.
+
+        retries: times a request is sent again after a connection error, only for requests
+        that are safe to repeat. Requests the server refused as too busy did nothing and
+        are always sent again, up to busy_retries times.
+        """
+        data = QByteArray(json.dumps(payload).encode())
+        req = QNetworkRequest(QUrl(self.url + path))
+        req.setHeader(QNetworkRequest.ContentTypeHeader, "application/json")
+        req.setTransferTimeout(timeout_ms)
+        reply = self.network_manager.post(req, data)
+
+        def on_finished():
+            reply.deleteLater()
+            if reply.error() in RETRY_ERRORS and retries > 0:
+                self.post_json(path, payload, callback, timeout_ms, retries - 1, busy_retries)
+                return
+            if reply.attribute(QNetworkRequest.HttpStatusCodeAttribute) == 429 and busy_retries > 0:
+                try:
+                    delay_s = float(bytes(reply.rawHeader(b"Retry-After")).decode())
+                except ValueError:
+                    delay_s = 1
+                QTimer.singleShot(
+                    int(delay_s * 1000),
+                    lambda: self.post_json(path, payload, callback, timeout_ms, retries, busy_retries - 1),
+                )
+                return
+            if callback is not None:
+                callback(reply, reply_json(reply))
+        reply.finished.connect(on_finished)
+        return reply
+
+    def from_zip(self, pack):
+        """Whether the server reads pack from its zip. Packs extracted only while open are,
+        imports generated next to their extraction would be removed with it."""
+        return pack is not None and (pack.unpack_mode == "zip" or pack.ephemeral)
+
+    def server_path(self, pack, path):
+        return pack.member_name(path) if self.from_zip(pack) else path
+
+    def needs_upload(self, pack):
+        return self.from_zip(pack) and self.upload
+
+    def upload_pack(self, pack, callback):
+        """Stream the zip of pack to the server once, callback() when the upload is done or failed."""
+        upload = self.uploads.get(pack.original_zip_filepath)
+        if upload is not None and upload["error"] is None:
+            if "callbacks" in upload:
+                upload["callbacks"].append(callback)
+            else:
+                callback()
+            return
+        upload = self.uploads[pack.original_zip_filepath] = {"upload_id": None, "error": None, "callbacks": [callback]}
+
+        def finish(upload_id, error):
+            upload["upload_id"], upload["error"] = upload_id, error
+            for callback in upload.pop("callbacks"):
+                callback()
+
+        zip_file = QFile(pack.original_zip_filepath)
+        if not zip_file.open(QIODevice.ReadOnly):
+            finish(None, zip_file.errorString())
+            return
+        req = QNetworkRequest(QUrl(self.url + "/upload"))
+        req.setHeader(QNetworkRequest.ContentTypeHeader, "application/zip")
+        req.setHeader(QNetworkRequest.ContentLengthHeader, zip_file.size())
+        req.setTransferTimeout(DEFAULT_TIMEOUT_MS)
+        # Read from the file as the connection takes it, the zip is never held in memory
+        reply = self.network_manager.post(req, zip_file)
+        zip_file.setParent(reply)
 
-class WebFuncs:
-    def __init__(self, url):
-        parsed_result = urlparse(url)
-        self.host = parsed_result.hostname
-        self.port = parsed_result.port
-        self.path = parsed_result.path
-        self.scheme = parsed_result.scheme
+        def on_finished():
+            reply.deleteLater()
+            body = reply_json(reply)
+            if body is None:
+                finish(None, f"{reply.error().name}: {reply.errorString()}")
+            elif not body["success"]:
+                finish(None, body["error_message"])
+            else:
+                finish(body["upload_id"], None)
+        reply.finished.connect(on_finished)
+
+    def pack_source(self, pack):
+        """Request fields telling the server where the files of pack are."""
+        if not self.from_zip(pack):
+            return {}
+        if not self.upload:
+            return {"source_zip": pack.original_zip_filepath}
+        return {"upload_id": self.uploads[pack.original_zip_filepath]["upload_id"]}
+
+    def pack_id(self, pack):
+        return pack.unpack_path or pack.original_zip_filepath
+
+    def open_pack(self, qwindow, pack):
+        # Speculatively convert every model of the pack while the user picks options
+        source_paths = [
+            self.server_path(pack, path) for path in [
+                pack.pack_file_paths(pack_info)["model"] for pack_info in pack.available_packs
+            ] + [
+                value for value in pack.additional_elements_paths().values()
+                if isinstance(value, str) and value.endswith((".fbx", ".obj"))
+            ]
+        ]
+
+        def preconvert():
+            if self.needs_upload(pack) and self.uploads[pack.original_zip_filepath]["error"] is not None:
+                return
+            self.post_json(
+                "/preconvert",
+                {"pack_id": self.pack_id(pack), "source_paths": source_paths, "pack_name": pack.pack_name, **self.pack_source(pack)},
+                retries=1,
+            )
+        # Uploaded right away, imports of the pack have to wait for it
+        if self.needs_upload(pack):
+            self.upload_pack(pack, preconvert if source_paths else (lambda: None))
+        elif source_paths:
+            preconvert()
+
+    def close_pack(self, qwindow, pack):
+        self.post_json("/preconvert/cancel", {"pack_id": self.pack_id(pack)}, retries=1)
 
     def import_pack(
         self,
@@ -44,35 +197,86 @@ class WebFuncs:
         available_additional: CADefs.AdditionalElements,
         pack_name: str,
         additional_paths,
+        update: bool = False,
+        pack=None,
+        lod: bool = False,
     ):
-        ConnectionContextManager = {
-            "http": HTTPConnectionContextManager,
-            "https": HTTPSConnectionContextManager
-        }[self.scheme]
-
-        with ConnectionContextManager(self.host, self.port) as conn:
-            data = json.dumps({
-                "model_path": model_path,
-                "obj_name": obj_name,
-                "texture_paths": texture_paths,
-                "selected_pack_resolution": selected_pack.resolution.value,
-                "selected_pack_topology": selected_pack.topology.value,
-                "selected_additional": selected_additional.value,
-                "available_additional": available_additional.value,
-                "pack_name": pack_name,
-                "additional_paths": [
-                    {
-                        "part": key.value,
-                        "value": value
-                    }
-                    for key, value in additional_paths.items()
-                ]
-            })
-            headers = {'Content-type': 'application/json'}
-            conn.request("POST", self.path + "/import", body=data, headers=headers)
-            response = conn.getresponse()
-            self.response_body = json.loads(response.read().decode())
-            return f"{response.status} ({response.reason}): {self.response_body}"
+        """Queue an import, importStarted/importFinished are emitted when it is sent/done.
+
+        pack is kept open until the import is done, so a pack unpacked to a temp dir outlives its queued imports.
+        """
+        if pack is not None:
+            pack.retain()
+        self.import_queue.append({
+            "model_path": model_path,
+            "obj_name": obj_name,
+            "texture_paths": texture_paths,
+            "selected_pack": selected_pack,
+            "selected_additional": selected_additional,
+            "additional_elements": available_additional,
+            "pack_name": pack_name,
+            "additional_paths": additional_paths,
+            "update": update,
+            "pack": pack,
+            "lod": lod,
+        })
+        self.send_next_import()
+        self.queueChanged.emit(self.pending_imports())
+
+    def pending_imports(self):
+        return len(self.import_queue) + (self.current_import is not None)
+
+    def send_next_import(self):
+        if self.current_import is not None or not self.import_queue:
+            return
+        pack = self.import_queue[0]["pack"]
+        upload = self.uploads.get(pack.original_zip_filepath) if self.needs_upload(pack) else None
+        if self.needs_upload(pack) and (upload is None or "callbacks" in upload):
+            # Sent once the pack is on the server
+            self.upload_pack(pack, self.send_next_import)
+            return
+        job = self.current_import = self.import_queue.popleft()
+        self.importStarted.emit(job)
+        if upload is not None and upload["error"] is not None:
+            # Uploaded again by the next import or opening of the pack
+            del self.uploads[pack.original_zip_filepath]
+            self.on_import_finished(None, {"success": False, "error_message": f"Upload failed: {upload['error']}"})
+            return
+        self.post_json("/import", {
+            "model_path": self.server_path(pack, job["model_path"]),
+            "obj_name": job["obj_name"],
+            "texture_paths": {key: self.server_path(pack, value) for key, value in job["texture_paths"].items()},
+            "selected_pack_resolution": job["selected_pack"].resolution.value,
+            "selected_pack_topology": job["selected_pack"].topology.value,
+            "selected_additional": job["selected_additional"].value,
+            "available_additional": job["additional_elements"].value,
+            "pack_name": job["pack_name"],
+            "additional_paths": [
+                {
+                    "part": key.value,
+                    "value": {kind: self.server_path(pack, path) for kind, path in value.items()}
+                    if isinstance(value, dict) else self.server_path(pack, value)
+                }
+                for key, value in job["additional_paths"].items()
+            ],
+            "update": job["update"],
+            "lod": job["lod"],
+            **self.pack_source(pack),
+        }, self.on_import_finished, timeout_ms=IMPORT_TIMEOUT_MS)
+
+    def on_import_finished(self, reply, body):
+        job, self.current_import = self.current_import, None
+        if job["pack"] is not None:
+            job["pack"].close()
+        if body is None:
+            body = {
+                "success": False,
+                "error_message": f"{reply.error().name}: {reply.errorString()}",
+            }
+        self.response_body = body
+        self.importFinished.emit(job, body)
+        self.send_next_import()
+        self.queueChanged.emit(self.pending_imports())
 
     def pre_import(
         self,
@@ -112,4 +316,5 @@ class WebFuncs:
                 f"Asset import failed! ({self.response_body['error_message']})\nDetailed error message can be found in your omni kit app's console window."
             )
         msg_box.setStandardButtons(QMessageBox.Ok)
-        msg_box.exec()
+        # Not exec(), queued imports keep going while the box is shown
+        msg_box.open()